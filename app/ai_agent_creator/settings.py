@@ -13,6 +13,7 @@ import json
 from pathlib import Path
 
 from celery.schedules import crontab
+from kombu import Exchange, Queue
 from dotenv import load_dotenv
 import os
 
@@ -154,6 +155,23 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REDIS_HOST = get_env('REDIS_HOST', 'redis://localhost:6379')
 
+# Задачи агента отправляются в очередь с eta = scheduled_time на AI_AGENT_DISPATCH_HORIZON минут вперёд,
+# run_scheduled_ai_tasks делает это раз в AI_AGENT_DISPATCH_INTERVAL минут. Горизонт должен быть меньше
+# visibility_timeout брокера Redis (1 час), иначе ожидающее сообщение будет доставлено повторно
+AI_AGENT_DISPATCH_INTERVAL = int(get_env("AI_AGENT_DISPATCH_INTERVAL", 10))
+AI_AGENT_DISPATCH_HORIZON = int(get_env("AI_AGENT_DISPATCH_HORIZON", 30))
+# Через сколько минут после scheduled_time задача в QUEUED считается потерянной и отправляется заново
+AI_AGENT_QUEUED_GRACE = int(get_env("AI_AGENT_QUEUED_GRACE", 30))
+# Повторы упавшей задачи агента: продолжение с последнего чекпоинта через AI_AGENT_RETRY_BACKOFF * 2^n секунд,
+# но не позже AI_AGENT_RETRY_BACKOFF_MAX
+AI_AGENT_MAX_RETRIES = int(get_env("AI_AGENT_MAX_RETRIES", 3))
+AI_AGENT_RETRY_BACKOFF = int(get_env("AI_AGENT_RETRY_BACKOFF", 60))
+AI_AGENT_RETRY_BACKOFF_MAX = int(get_env("AI_AGENT_RETRY_BACKOFF_MAX", 900))
+# Лимиты времени задачи агента, секунды: после мягкого агент останавливается между шагами графа (чекпоинт сохранён),
+# за минуту до жёсткого прерывается зависший шаг, по жёсткому Celery завершает процесс воркера
+AI_AGENT_SOFT_TIME_LIMIT = int(get_env("AI_AGENT_SOFT_TIME_LIMIT", 1800))
+AI_AGENT_TIME_LIMIT = int(get_env("AI_AGENT_TIME_LIMIT", 2400))
+
 # Celery Configuration
 CELERY_CONFIGURATION = {
     "broker_url": f"{REDIS_HOST}/0",
@@ -171,7 +189,12 @@ CELERY_CONFIGURATION = {
         },
         'run_scheduled_ai_tasks': {
             'task': 'run_scheduled_ai_tasks',
-            'schedule': crontab(minute='*/1'),  # Запуск каждую минуту
+            # Отправка задач на горизонт вперёд и сверка потерянных сообщений
+            'schedule': crontab(minute=f'*/{AI_AGENT_DISPATCH_INTERVAL}'),
+        },
+        'compact_ai_state': {
+            'task': 'compact_ai_state',
+            'schedule': crontab(minute='*/15'),  # Чистка старых чекпоинтов порциями
         },
     },
     "beat_scheduler": "django_celery_beat.schedulers.DatabaseScheduler",
@@ -188,3 +211,45 @@ REST_FRAMEWORK = {
 }
 
 GEMINI_API_KEY = get_env("GEMINI_API_KEY", None)
+
+# Политика хранения чекпоинтов агента (на каждый тред):
+# удаляются чекпоинты старше KEEP_DAYS дней, кроме KEEP_LAST последних
+CHECKPOINT_RETENTION_KEEP_LAST = int(get_env("CHECKPOINT_RETENTION_KEEP_LAST", 20))
+CHECKPOINT_RETENTION_KEEP_DAYS = int(get_env("CHECKPOINT_RETENTION_KEEP_DAYS", 7))
+# Сколько тредов обрабатывает один запуск compact_ai_state
+CHECKPOINT_COMPACTION_BATCH = int(get_env("CHECKPOINT_COMPACTION_BATCH", 20))
+
+# На сколько дней вперёд (начиная с завтра) schedule_ai_tasks планирует задачи
+SCHEDULE_DAYS_AHEAD = int(get_env("SCHEDULE_DAYS_AHEAD", 2))
+# Сколько задач run_scheduled_ai_tasks забирает и отправляет в очередь одним UPDATE
+SCHEDULER_CLAIM_BATCH = int(get_env("SCHEDULER_CLAIM_BATCH", 200))
+
+# Сколько задач агента выполняет один воркер на общем event loop (run_ai_agents_async), 1 - по одной задаче (run_ai_agent)
+AI_AGENT_SESSIONS_PER_WORKER = int(get_env("AI_AGENT_SESSIONS_PER_WORKER", 1))
+
+# Лимиты вызовов внешних API: redis - общие для всех воркеров Celery (ключи в RATE_LIMIT_REDIS_URL), local - на процесс
+RATE_LIMIT_BACKEND = get_env("RATE_LIMIT_BACKEND", "redis")
+RATE_LIMIT_REDIS_URL = get_env("RATE_LIMIT_REDIS_URL", f"{REDIS_HOST}/0")
+# Вызовов в минуту на один GitHub токен (лимиты Gemini на ключ и модель - AIModels.requests_per_minute)
+GIT_CALLS_PER_MINUTE = int(get_env("GIT_CALLS_PER_MINUTE", 10))
+GITHUB_CALLS_PER_MINUTE = int(get_env("GITHUB_CALLS_PER_MINUTE", 30))
+
+# Аренда репозитория и чата задачей агента (ai_integration.helpers.lease): redis - общая для всех воркеров, local - на процесс
+LEASE_BACKEND = get_env("LEASE_BACKEND", "redis")
+LEASE_REDIS_URL = get_env("LEASE_REDIS_URL", f"{REDIS_HOST}/0")
+# Через сколько секунд аренда упавшего воркера освобождается сама (живой воркер продлевает её каждые TTL/3)
+AI_AGENT_LEASE_TTL = int(get_env("AI_AGENT_LEASE_TTL", 300))
+# Число очередей ai_agent_<n>: задачи одного репозитория всегда в одной очереди, 1 - очередь по умолчанию
+AI_AGENT_QUEUE_SHARDS = int(get_env("AI_AGENT_QUEUE_SHARDS", 1))
+if AI_AGENT_QUEUE_SHARDS > 1:
+    # Воркер без -Q (как в docker-compose.yml) слушает все очереди task_queues: очередь по умолчанию и все шарды
+    # Как очереди, которые Celery создаёт сам: у каждой свой exchange и routing key, иначе сообщение попадёт во все
+    CELERY_CONFIGURATION["task_queues"] = [
+        Queue(name, Exchange(name), routing_key=name)
+        for name in ["celery", *(f"ai_agent_{shard}" for shard in range(AI_AGENT_QUEUE_SHARDS))]
+    ]
+
+# find_in_files без индекса проверяет файлы в стольких процессах, 0 - по числу ядер
+CODE_SEARCH_WORKERS = int(get_env("CODE_SEARCH_WORKERS", 0))
+# После стольких поисков без индекса в одной сессии строится триграммный индекс (сохраняется в .git репозитория)
+CODE_SEARCH_INDEX_AFTER = int(get_env("CODE_SEARCH_INDEX_AFTER", 2))
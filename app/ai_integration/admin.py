@@ -4,6 +4,7 @@ import pickle
 from django.contrib import admin
 from django.utils.safestring import mark_safe
 
+from ai_integration.helpers.state_serializer import StateSerializer
 from ai_integration.models import (
     AIStateBlobs,
     AIStateWrites,
@@ -13,27 +14,43 @@ from ai_integration.models import (
 )
 
 
+class AIStateAdmin(admin.ModelAdmin):
+    list_display = ("id", "record_id", "unpacked_key")
+    search_fields = ("record_id",)
+
+    def unpacked_key(self, obj):
+        try:
+            return repr(pickle.loads(obj.key))
+        except Exception as e:
+            return f"Ошибка при десериализации: {e}"
+
+    unpacked_key.short_description = "Ключ"
+
+
 # Register your models here.
 @admin.register(AIStateBlobs)
 class AIStateBlobsAdmin(admin.ModelAdmin):
-    pass
+    list_display = ("id", "thread_id", "checkpoint_ns", "channel", "version", "type")
+    search_fields = ("thread_id", "channel")
 
 @admin.register(AIStateWrites)
 class AIStateWritesAdmin(admin.ModelAdmin):
-    pass
+    list_display = ("id", "thread_id", "checkpoint_ns", "checkpoint_id", "task_id", "idx", "channel")
+    search_fields = ("thread_id", "checkpoint_id", "task_id")
 
 @admin.register(AIStateStorage)
 class AIStateStorageAdmin(admin.ModelAdmin):
-    pass
+    list_display = ("id", "thread_id", "checkpoint_ns", "checkpoint_id", "parent_checkpoint_id", "created_at")
+    search_fields = ("thread_id", "checkpoint_id")
 
 @admin.register(AIStateDefault)
-class AIStateDefaultAdmin(admin.ModelAdmin):
+class AIStateDefaultAdmin(AIStateAdmin):
     readonly_fields = ["unpacked_data"]
 
     def unpacked_data(self, obj):
         try:
-            raw_data = pickle.loads(obj.data)
-            formatted = json.dumps(raw_data, indent=4, ensure_ascii=False)
+            raw_data = StateSerializer().loads(obj.data)
+            formatted = json.dumps({repr(pickle.loads(obj.key)): raw_data}, indent=4, ensure_ascii=False)
             return mark_safe(f"<pre>{formatted}</pre>")
         except Exception as e:
             return f"Ошибка при десериализации: {e}"
@@ -44,3 +61,10 @@ class AIStateDefaultAdmin(admin.ModelAdmin):
 class AIAgentTaskAdmin(admin.ModelAdmin):
     list_display = ("id", "project_theme", "status", "scheduled_time", "ai_model")
     search_fields = ("project_theme", "status", "scheduled_time", "ai_model")
+    list_filter = ("status",)
+    actions = ["cancel_tasks"]
+
+    @admin.action(description="Отменить выбранные задачи")
+    def cancel_tasks(self, request, queryset):
+        cancelled = sum(task.cancel() for task in queryset)
+        self.message_user(request, f"Отменено задач: {cancelled}")
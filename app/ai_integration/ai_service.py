@@ -1,5 +1,8 @@
 import logging
+from contextlib import aclosing
+from typing import Any, Iterator, AsyncIterator
 
+from asgiref.sync import sync_to_async
 from langchain_core.messages import SystemMessage
 
 from ai_integration.helpers.agent_helper import AIAutomation
@@ -21,16 +24,19 @@ class AIService:
                  github_email: str,
                  model: AIModels = AIModels.GEMINI_2_0_FLASH):
         logger.info(f"model: {model}")
+        context_budget = model.context_budget
         model = model_factory(model=model)
         self.todo_list_storage = DjangoDBDict.db_dict_factory(record_id=chat_id, table_name=AIStateDefault)()
+        # Результаты push/PR/merge по tool_call_id: повтор прерванного хода их не выполняет второй раз
+        self.tool_results = DjangoDBDict.db_dict_factory(record_id=f"{chat_id}:tool_results", table_name=AIStateDefault)()
         automation = AIAutomation(
             repo_url=repo_url,
             github_token=github_token,
             github_username=github_username,
             github_email=github_email,
-            todo_list_storage=self.todo_list_storage,
-            rate_limit=10
+            todo_list_storage=self.todo_list_storage
         )
+        self._automation = automation
         system_message = SystemMessage(content=system_prompt)
 
         self._agent = LLMAgent(
@@ -44,6 +50,8 @@ class AIService:
                 automation.find_in_files,
                 automation.get_function_defs,
                 automation.get_class_structure,
+                automation.find_symbol,
+                automation.list_symbols,
                 automation.run_linter,
                 automation.delete_file,
                 automation.get_project_structure,
@@ -59,9 +67,52 @@ class AIService:
                 automation.update_todo_list,
                 automation.get_todo_list
             ],
-            chat_id=chat_id
+            chat_id=chat_id,
+            context_budget=context_budget,
+            tool_results=self.tool_results
         )
 
+    def can_resume(self) -> bool:
+        """Прошлый запуск оборвался посреди хода, и его можно продолжить с чекпоинта"""
+        return self._agent.can_resume()
+
+    def stream(self, human_message: str = "Продолжай", resume: bool = False) -> Iterator[dict[str, Any]]:
+        """
+        События агента (LLMAgent.stream), todo list сохраняется после каждого ответа инструмента.
+        resume=True продолжает прерванный ход с чекпоинта вместо нового сообщения human_message
+        """
+        try:
+            for event in self._agent.stream(
+                content=None if resume else human_message,
+                attachments=None,
+                temperature=0.1
+            ):
+                if event["type"] == "tool_result":
+                    self.todo_list_storage.sync_data()
+                yield event
+        finally:
+            self.todo_list_storage.sync_data()
+
+    async def astream(self, human_message: str = "Продолжай", resume: bool = False) -> AsyncIterator[dict[str, Any]]:
+        """
+        Асинхронная версия stream. Инструменты привязаны к своей сессии AIAutomation,
+        поэтому несколько сессий на одном event loop работают каждая со своим репозиторием
+        """
+        sync_todo_list = sync_to_async(self.todo_list_storage.sync_data)
+        try:
+            # aclosing: при остановке между шагами стрим графа закрывается сразу, а не при сборке мусора
+            async with aclosing(self._agent.astream(
+                content=None if resume else human_message,
+                attachments=None,
+                temperature=0.1
+            )) as events:
+                async for event in events:
+                    if event["type"] == "tool_result":
+                        await sync_todo_list()
+                    yield event
+        finally:
+            await sync_todo_list()
+
     def invoke(self, human_message: str = "Продолжай"):
         try:
             response = self._agent.invoke(
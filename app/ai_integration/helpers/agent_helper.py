@@ -1,54 +1,141 @@
-import ast
 import logging
 import os
 
 import re
 import subprocess
+import time
+from functools import cached_property
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Optional
 
+from django.conf import settings
 from git import Repo, GitCommandError
 from github import Github, Repository
-from langchain_core.tools import tool
 
+from ai_integration.helpers.code_search import CodeSearchIndex, scan
+from ai_integration.helpers.project_tree import ProjectTreeIndex
+from ai_integration.helpers.symbol_index import SymbolIndex
 from ai_integration.helpers.rate_limit import (
-    rate_limited_tools_per_minute,
-    rate_limiter,
+    QuotaState,
+    ToolCategory,
+    key_fingerprint,
+    rate_limited_tool,
 )
 
 logger = logging.getLogger(__name__)
 
+class SessionTool:
+    """
+    Инструмент сессии AIAutomation: automation.read_file - BaseTool этой сессии, он создаётся при первом
+    обращении и остаётся в экземпляре. self внутри - репозиторий, GitHub и todo list сессии, лимиты
+    считаются по её токену. Общего состояния у инструментов разных сессий нет, поэтому несколько агентов
+    в одном процессе (потоки, asyncio task) не переключают друг другу репозиторий.
+    """
+
+    def __init__(self, func: Callable[..., Any], **options: Any):
+        self.func = func
+        self.options = options
+        self.name = func.__name__
+
+    def __set_name__(self, owner: type, name: str):
+        self.name = name
+
+    def __get__(self, instance: Optional["AIAutomation"], owner: Optional[type] = None):
+        if instance is None:
+            return self
+        bound_tool = rate_limited_tool(
+            self.func.__get__(instance, owner),
+            scope=instance.quota_scope,
+            observer=instance.github_quota,
+            **self.options,
+        )
+        # Атрибут экземпляра важнее дескриптора без __set__: следующие обращения берут готовый инструмент
+        instance.__dict__[self.name] = bound_tool
+        return bound_tool
+
+
+def session_tool(func: Optional[Callable[..., Any]] = None, **options: Any):
+    """@session_tool или @session_tool(category=..., read_only=..., side_effect=...), параметры - как у rate_limited_tool"""
+    if func is None:
+        return lambda func: SessionTool(func, **options)
+    return SessionTool(func, **options)
+
+
 class AIAutomation:
-    github: Github = None
-    repo_path: str = None
-    repo_url: str = None
-    todo_list_storage: dict = None
-
-    def __init__(self, repo_url: str, github_token: str,github_username: str, github_email: str, todo_list_storage: dict, rate_limit: int):
-        AIAutomation.todo_list_storage = todo_list_storage
-        rate_limiter.update_rate_limit(new_limit=rate_limit)
-        AIAutomation.github = Github(github_token)
+    # Поисков find_in_files без индекса в этой сессии
+    _scan_searches = 0
+
+    def __init__(self, repo_url: str, github_token: str,github_username: str, github_email: str, todo_list_storage: dict):
+        self.todo_list_storage = todo_list_storage
+        # Лимиты git/GitHub считаются на токен: задачи с одним токеном делят квоту и в разных воркерах
+        self.quota_scope = key_fingerprint(github_token)
+        self.github = Github(github_token)
         repo_name, user_name = self._extract_repo_name_from_url(repo_url)
-        AIAutomation.repo_path = os.path.join("./repos/",user_name, repo_name)
-        AIAutomation.repo_url = repo_url
+        self.repo_path = os.path.join("./repos/",user_name, repo_name)
+        self.repo_url = repo_url
         self._clone_repository(
             repo_url=repo_url,
-            local_path=AIAutomation.repo_path,
+            local_path=self.repo_path,
             github_username=github_username,
             github_email=github_email
         )
 
+    def github_quota(self, category: ToolCategory) -> Optional[QuotaState]:
+        """Остаток квоты GitHub по заголовкам X-RateLimit-* последнего ответа (PyGithub хранит их в requester)"""
+        if category != ToolCategory.GITHUB:
+            return None
+        remaining, limit = self.github.requester.rate_limiting
+        if limit < 0:
+            return None
+        return QuotaState(remaining=remaining, reset_in=self.github.requester.rate_limiting_resettime - time.time())
+
+    @cached_property
+    def project_tree(self) -> ProjectTreeIndex:
+        """Дерево рабочей копии с кэшем между вызовами get_project_structure"""
+        return ProjectTreeIndex(self.repo_path)
+
+    @cached_property
+    def code_index(self) -> CodeSearchIndex:
+        """Триграммный индекс для find_in_files, загружается с диска при первом поиске"""
+        return CodeSearchIndex.load(self.repo_path)
+
+    @cached_property
+    def symbol_index(self) -> SymbolIndex:
+        """Классы и функции python файлов для get_function_defs, get_class_structure, find_symbol и list_symbols"""
+        return SymbolIndex.load(self.repo_path)
+
+    def _search_index(self) -> Optional[CodeSearchIndex]:
+        """
+        Индекс для find_in_files, если он уже есть (в сессии или на диске) или сессия ищет часто.
+        None - разовый поиск: файлы сканируются параллельно, без построения индекса
+        """
+        if "code_index" in self.__dict__ or CodeSearchIndex.exists(self.repo_path):
+            return self.code_index
+        if self._scan_searches >= settings.CODE_SEARCH_INDEX_AFTER:
+            return self.code_index
+        self._scan_searches += 1
+        return None
+
+    def _files_changed(self, *paths: str):
+        """Сообщает индексу поиска о файлах, изменённых инструментами (пути внутри repo_path)"""
+        if "code_index" in self.__dict__:
+            self.code_index.notify_changed(os.path.relpath(path, self.repo_path) for path in paths)
+
+    def _worktree_changed(self):
+        """Рабочая копия изменена git операцией: индекс поиска сверится с git перед следующим поиском"""
+        if "code_index" in self.__dict__:
+            self.code_index.notify_git_changed()
+
     @staticmethod
     def _get_pull_request(repo: Repository.Repository, pr_number: int):
         return repo.get_pull(pr_number)
 
-    @staticmethod
-    def _get_repository() -> Optional[Repository.Repository]:
+    def _get_repository(self) -> Optional[Repository.Repository]:
         try:
-            repo_name, _ = AIAutomation._extract_repo_name_from_url(AIAutomation.repo_url)
-            return AIAutomation.github.get_user().get_repo(repo_name)  # Assuming user's repo
+            repo_name, _ = self._extract_repo_name_from_url(self.repo_url)
+            return self.github.get_user().get_repo(repo_name)  # Assuming user's repo
         except Exception as e:
-            logger.error(f"Error getting repository {AIAutomation.repo_url}: {e}")
+            logger.error(f"Error getting repository: {e}")
             return None
 
     @staticmethod
@@ -75,7 +162,7 @@ class AIAutomation:
         """
         try:
             # Получаем данные пользователя из GitHub API
-            github_user = AIAutomation.github.get_user()
+            github_user = self.github.get_user()
             git_user_name = github_username or github_user.name or github_user.login  # Имя или логин
             git_user_email = github_email or github_user.email or f"{github_user.login}@users.noreply.github.com"  # Email или заглушка
 
@@ -117,10 +204,8 @@ class AIAutomation:
             logger.error(f"Error cloning/pulling {repo_url}: {e}")
             return None
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def create_file(path: str, create_dir: bool = True) -> bool:
+    @session_tool
+    def create_file(self, path: str, create_dir: bool = True) -> bool:
         """
         Создание файла в дирректории проекта, можно передавать вместе в путем до файла,
         если дирректории не существует, она будет создана, если передать параметр create_dir = True
@@ -130,21 +215,20 @@ class AIAutomation:
         :return:
         """
         logger.info(f"create_file: path='{path}', create_dir={create_dir}")
-        path = os.path.join(AIAutomation.repo_path, path)
+        path = os.path.join(self.repo_path, path)
         try:
             file_path = Path(path)
             if create_dir:
                 file_path.parent.mkdir(parents=True, exist_ok=True)
             file_path.touch(exist_ok=True)
+            self._files_changed(path)
             return True
         except Exception as e:
             logger.error(f"Ошибка при создании файла '{path}': {e}")
             return False
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def create_folder(path: str) -> bool:
+    @session_tool
+    def create_folder(self, path: str) -> bool:
         """
         Создание дирректории, поддерживается передача пути до конечной дирректори,
         если какой-либо дирректории не существует в пути, она будет создана
@@ -153,7 +237,7 @@ class AIAutomation:
         :return:
         """
         logger.info(f"create_folder: path='{path}'")
-        path = os.path.join(AIAutomation.repo_path, path)
+        path = os.path.join(self.repo_path, path)
         try:
             Path(path).mkdir(parents=True, exist_ok=True)
             return True
@@ -161,10 +245,8 @@ class AIAutomation:
             logger.error(f"Ошибка при создании директории '{path}': {e}")
             return False
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def read_file(path: str) -> str:
+    @session_tool(read_only=True)
+    def read_file(self, path: str) -> str:
         """
         Чтение файла
 
@@ -172,7 +254,7 @@ class AIAutomation:
         :return:
         """
         logger.info(f"read_file: path='{path}'")
-        path = os.path.join(AIAutomation.repo_path, path)
+        path = os.path.join(self.repo_path, path)
         try:
             with open(path, 'r', encoding='utf-8') as file:
                 content = file.read()
@@ -182,10 +264,8 @@ class AIAutomation:
             logger.error(f"Ошибка при чтении файла '{path}': {e}")
             return ""
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def update_file(path: str, data: str, append: bool = False) -> str:
+    @session_tool
+    def update_file(self, path: str, data: str, append: bool = False) -> str:
         """
         Обновление существущего файла по пути path данными из data.
         Если указать append = True, то данные data будут просто добавлены в
@@ -197,20 +277,19 @@ class AIAutomation:
         :return:
         """
         logger.info(f"update_file: path='{path}', append={append}, data_length={len(data)}")
-        path = os.path.join(AIAutomation.repo_path, path)
+        path = os.path.join(self.repo_path, path)
         try:
             mode = 'a' if append else 'w'
             with open(path, mode, encoding='utf-8') as file:
                 file.write(data)
+            self._files_changed(path)
             return "Данные успешно записаны"
         except Exception as e:
             logger.error(f"Ошибка при записи в файл '{path}': {e}")
             return f"Ошибка при записи файла: {e}"
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def delete_file(path: str) -> bool:
+    @session_tool
+    def delete_file(self, path: str) -> bool:
         """
         Удаление файла по указанному пути path
 
@@ -218,11 +297,12 @@ class AIAutomation:
         :return:
         """
         logger.info(f"delete_file: path='{path}'")
-        path = os.path.join(AIAutomation.repo_path, path)
+        path = os.path.join(self.repo_path, path)
         try:
             file_path = Path(path)
             if file_path.is_file():
                 file_path.unlink()
+                self._files_changed(path)
                 return True
             else:
                 logger.warning(f"Файл не найден или не является обычным файлом: '{path}'")
@@ -231,126 +311,144 @@ class AIAutomation:
             logger.error(f"Ошибка при удалении файла '{path}': {e}")
             return False
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def get_project_structure(root_path: str = ".", max_depth: int = 3) -> str:
+    @session_tool(read_only=True)
+    def get_project_structure(self, root_path: str = ".", max_depth: int = 3) -> str:
         """
-        Возвращает иерархическую структуру файлов и папок начиная с root_path, исключая указанные файлы и директории.
+        Возвращает иерархическую структуру файлов и папок начиная с root_path, без файлов из .gitignore.
+        Большие директории сокращаются до "… ещё N записей".
 
         :param root_path: путь до корня проекта или поддиректории
         :param max_depth: максимальная глубина обхода (по умолчанию 3)
         :return: текстовое дерево структуры проекта
         """
-        exclude = [".git",".venv"]
         logger.info(f"get_project_structure: root_path='{root_path}', max_depth={max_depth}")
-        root_path = os.path.join(AIAutomation.repo_path, root_path)
-
-        def walk(path, prefix="", depth=0):
-            if depth > max_depth:
-                return ""
-            result = ""
-            try:
-                entries = sorted([e for e in os.listdir(path) if e not in exclude])
-                for i, entry in enumerate(entries):
-                    full_path = os.path.join(path, entry)
-                    connector = "└── " if i == len(entries) - 1 else "├── "
-                    result += f"{prefix}{connector}{entry}\n"
-                    if os.path.isdir(full_path):
-                        extension = "    " if i == len(entries) - 1 else "│   "
-                        result += walk(full_path, prefix + extension, depth + 1)
-            except Exception as e:
-                logger.error(f"Ошибка при обходе директории '{path}': {e}")
-                result += f"{prefix}└── [Ошибка доступа: {e}]\n"
-            return result
-
-        result = walk(root_path)
-        # logger.info(f"get_project_structure: result='{result}'")
-        return result
-
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def find_in_files(directory: str, pattern: str, extensions: list[str] = [".py"]) -> list[str]:
+        return self.project_tree.render(root_path, max_depth=max_depth)
+
+    @session_tool(read_only=True)
+    def find_in_files(
+        self,
+        directory: str,
+        pattern: str,
+        extensions: list[str] = [".py"],
+        max_results: int = 100,
+        context_lines: int = 0,
+    ) -> list[str]:
         """
         Поиск по тексту или регулярному выражению в указанных файлах директории
 
         :param directory: путь до директории, где искать
         :param pattern: текст или регулярное выражение
         :param extensions: список расширений файлов, например ['.py', '.txt']
-        :return: список совпадений вида: путь:строка: содержимое
+        :param max_results: после скольких совпадений остановить поиск
+        :param context_lines: сколько строк до и после совпадения показать
+        :return: список совпадений вида: путь:строка: содержимое (путь от корня репозитория),
+            строки контекста вида: путь-строка- содержимое
         """
         logger.info(f"find_in_files: directory='{directory}', pattern='{pattern}', extensions={extensions}")
-        results = []
-        regex = re.compile(pattern)
-        directory = os.path.join(AIAutomation.repo_path, directory)
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if any(file.endswith(ext) for ext in extensions):
-                    path = os.path.join(root, file)
-                    try:
-                        with open(path, "r", encoding="utf-8") as f:
-                            for i, line in enumerate(f, 1):
-                                if regex.search(line):
-                                    results.append(f"{path}:{i}: {line.strip()}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при чтении файла '{path}': {e}")
-        logger.info(f"find_in_files: result='{results}'")
+        workers = settings.CODE_SEARCH_WORKERS or os.cpu_count() or 1
+        try:
+            index = self._search_index()
+            if index is None:
+                results = scan(self.repo_path, pattern, directory, extensions, max_results, context_lines, workers)
+            else:
+                results = index.search(
+                    pattern,
+                    directory=directory,
+                    extensions=extensions,
+                    max_results=max_results,
+                    context_lines=context_lines,
+                    workers=workers,
+                )
+        except re.error as e:
+            return [f"Ошибка в регулярном выражении: {e}"]
+        logger.info(f"find_in_files: {len(results)} lines")
         return results
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def get_function_defs(path: str) -> list[str]:
+    @session_tool(read_only=True)
+    def get_function_defs(self, path: str) -> list[str]:
         """
-        Возвращает список всех функций в файле с указанием строки
+        Возвращает список всех функций в файле (включая async, методы и вложенные) с сигнатурой и строками
 
         :param path: путь до python-файла
-        :return: список строк вида 'имя_функции (строка)'
+        :return: список строк вида 'def имя_функции(аргументы) -> результат (lines начало-конец)'
         """
         logger.info(f"get_function_defs: path='{path}'")
         try:
-            path = os.path.join(AIAutomation.repo_path, path)
-            with open(path, "r", encoding="utf-8") as f:
-                tree = ast.parse(f.read())
-            result = [f"{node.name} (line {node.lineno})" for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)]
-            logger.info(f"find_in_files: result='{result}'")
+            result = [symbol.describe() for symbol in self.symbol_index.symbols(path) if symbol.kind != "class"]
+            logger.info(f"get_function_defs: result='{result}'")
             return result
         except Exception as e:
             logger.error(f"Ошибка при парсинге AST в '{path}': {e}")
             return []
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def get_class_structure(path: str) -> list[str]:
+    @session_tool(read_only=True)
+    def get_class_structure(self, path: str) -> list[str]:
         """
         Возвращает описание всех классов и их методов в файле
 
         :param path: путь до python-файла
-        :return: список строк вида 'Class MyClass: methods: [...]'
+        :return: список строк вида 'Class MyClass(Base) (lines начало-конец): methods: [...]'
         """
         logger.info(f"get_class_structure: path='{path}'")
         try:
-            path = os.path.join(AIAutomation.repo_path, path)
-            with open(path, "r", encoding="utf-8") as f:
-                tree = ast.parse(f.read())
-
+            symbols = self.symbol_index.symbols(path)
             result = []
-            for node in ast.walk(tree):
-                if isinstance(node, ast.ClassDef):
-                    methods = [n.name for n in node.body if isinstance(n, ast.FunctionDef)]
-                    result.append(f"Class {node.name} (line {node.lineno}): methods: {methods}")
+            for cls in symbols:
+                if cls.kind == "class":
+                    methods = [symbol.name[len(cls.name) + 1:] for symbol in symbols if symbol.method and symbol.name.rpartition(".")[0] == cls.name]
+                    result.append(f"Class {cls.name}{cls.signature} (lines {cls.line}-{cls.end_line}): methods: {methods}")
             logger.info(f"get_class_structure: result='{result}'")
             return result
         except Exception as e:
             logger.error(f"Ошибка при анализе классов в '{path}': {e}")
             return []
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def run_linter(path: str) -> str:
+    @session_tool(read_only=True)
+    def find_symbol(self, name: str, directory: str = ".", max_results: int = 50) -> list[str]:
+        """
+        Ищет объявления класса или функции по имени во всех python-файлах директории
+
+        :param name: имя класса или функции, для метода - 'Class.method' или просто 'method'
+        :param directory: путь до директории, где искать
+        :param max_results: сколько объявлений вернуть
+        :return: список строк вида 'путь:строка: def имя(аргументы) (lines начало-конец)'
+        """
+        logger.info(f"find_symbol: name='{name}', directory='{directory}'")
+        try:
+            found = self.symbol_index.find(name, directory)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске символа '{name}': {e}")
+            return []
+        result = [f"{path}:{symbol.line}: {symbol.describe()}" for path, symbol in found[:max_results]]
+        if len(found) > max_results:
+            result.append(f"… ещё {len(found) - max_results} объявлений, уточните name или directory")
+        logger.info(f"find_symbol: {len(found)} found")
+        return result
+
+    @session_tool(read_only=True)
+    def list_symbols(self, directory: str = ".", max_results: int = 300) -> list[str]:
+        """
+        Возвращает классы, функции и методы верхнего уровня всех python-файлов директории
+
+        :param directory: путь до директории
+        :param max_results: сколько строк вернуть
+        :return: список строк вида 'путь:строка: class Name(Base) (lines начало-конец)'
+        """
+        logger.info(f"list_symbols: directory='{directory}'")
+        try:
+            # Вложенные в функции объявления не показываются, методы классов - да
+            symbols = [(path, symbol) for path, symbol in self.symbol_index.directory_symbols(directory) if symbol.method or "." not in symbol.name]
+        except Exception as e:
+            logger.error(f"Ошибка при чтении символов '{directory}': {e}")
+            return []
+        result = [f"{path}:{symbol.line}: {symbol.describe()}" for path, symbol in symbols[:max_results]]
+        if len(symbols) > max_results:
+            result.append(f"… ещё {len(symbols) - max_results} символов, укажите directory")
+        logger.info(f"list_symbols: {len(symbols)} symbols")
+        return result
+
+    @session_tool(read_only=True)
+    def run_linter(self, path: str) -> str:
         """
         Запускает линтер ruff для указанного пути
 
@@ -359,7 +457,7 @@ class AIAutomation:
         """
         logger.info(f"run_linter: path='{path}'")
         try:
-            path = os.path.join(AIAutomation.repo_path, path)
+            path = os.path.join(self.repo_path, path)
             result = subprocess.run(
                 ["ruff", path],
                 capture_output=True,
@@ -376,10 +474,8 @@ class AIAutomation:
             logger.error(f"Ошибка при запуске линтера: {e}")
             return str(e)
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def list_git_branches() -> str:
+    @session_tool(category=ToolCategory.GIT, read_only=True)
+    def list_git_branches(self) -> str:
         """
         Возвращает список локальных и удалённых веток, а также текущую ветку.
 
@@ -387,7 +483,7 @@ class AIAutomation:
         """
         try:
             logger.info("list_git_branches")
-            repo = Repo(AIAutomation.repo_path)
+            repo = Repo(self.repo_path)
             current_branch = repo.active_branch.name
             local_branches = [head.name for head in repo.heads]
             remote_branches = [ref.name for ref in repo.remotes.origin.refs]
@@ -402,10 +498,8 @@ class AIAutomation:
             logger.error(f"Ошибка при получении веток: {e}")
             return str(e)
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def create_and_checkout_branch(branch_name: str) -> str:
+    @session_tool(category=ToolCategory.GIT)
+    def create_and_checkout_branch(self, branch_name: str) -> str:
         """
         Создаёт новую ветку и переключается на неё
 
@@ -413,7 +507,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"create_and_checkout_branch branch_name: {branch_name}")
-            repo = Repo(AIAutomation.repo_path)
+            repo = Repo(self.repo_path)
             new_branch = repo.create_head(branch_name)
             new_branch.checkout()
             result = f"Создана и активирована ветка: {branch_name}"
@@ -423,10 +517,8 @@ class AIAutomation:
             logger.error(f"Ошибка при создании ветки: {e}")
             return str(e)
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def checkout_branch(branch_name: str) -> str:
+    @session_tool(category=ToolCategory.GIT)
+    def checkout_branch(self, branch_name: str) -> str:
         """
         Переключается на указанную ветку
 
@@ -434,8 +526,9 @@ class AIAutomation:
         """
         try:
             logger.info(f"checkout_branch branch_name: {branch_name}")
-            repo = Repo(AIAutomation.repo_path)
+            repo = Repo(self.repo_path)
             repo.git.checkout(branch_name)
+            self._worktree_changed()
             result = f"Переключено на ветку: {branch_name}"
             logger.info(f"checkout_branch result: {result}")
             return result
@@ -443,10 +536,8 @@ class AIAutomation:
             logger.error(f"Ошибка при переключении ветки: {e}")
             return str(e)
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def delete_branch(branch_name: str) -> str:
+    @session_tool(category=ToolCategory.GIT)
+    def delete_branch(self, branch_name: str) -> str:
         """
         Удаляет локальную ветку
 
@@ -454,7 +545,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"delete_branch branch_name: {branch_name}")
-            repo = Repo(AIAutomation.repo_path)
+            repo = Repo(self.repo_path)
             # Удаление локальной ветки
             repo.delete_head(branch_name, force=False)
             # Удаление удалённой ветки
@@ -467,10 +558,8 @@ class AIAutomation:
             logger.error(f"Ошибка при удалении ветки: {e}")
             return str(e)
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def commit_and_push_changes(branch_name: str, commit_message: str) -> (bool, str):
+    @session_tool(category=ToolCategory.GIT, side_effect=True)
+    def commit_and_push_changes(self, branch_name: str, commit_message: str) -> (bool, str):
         """
         Закоммитить изменения и сразу запушить их в ветку {branch_name}
 
@@ -480,7 +569,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"commit_and_push_changes branch_name: {branch_name}, commit_message: {commit_message}")
-            local_repo = Repo(AIAutomation.repo_path)
+            local_repo = Repo(self.repo_path)
             local_repo.git.add(A=True)  # Add all changed files
             local_repo.index.commit(commit_message)
             origin = local_repo.remotes.origin
@@ -495,10 +584,8 @@ class AIAutomation:
             return False, f"Error committing/pushing to {branch_name}: {e}"
 
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def create_pull_request(head_branch: str, title: str, body: str = "", base_branch: str = 'main') -> int | str:
+    @session_tool(category=ToolCategory.GITHUB, side_effect=True)
+    def create_pull_request(self, head_branch: str, title: str, body: str = "", base_branch: str = 'main') -> int | str:
         """
         Создаёт pull request в GitHub
 
@@ -510,7 +597,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"create_pull_request head_branch: {head_branch}, title: {title}, body: {body}, base_branch: {base_branch}")
-            repo = AIAutomation._get_repository()
+            repo = self._get_repository()
             pull_request = repo.create_pull(title=title, body=body, head=head_branch, base=base_branch)
             logger.info(f"Pull request '{title}' created: {pull_request.html_url}, {pull_request.number}")
             return pull_request.number
@@ -518,10 +605,8 @@ class AIAutomation:
             logger.error(f"Ошибка при создании PR: {e}")
             return f"Ошибка: {e}"
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def create_code_review(pr_number: int, body: str) -> str:
+    @session_tool(category=ToolCategory.GITHUB)
+    def create_code_review(self, pr_number: int, body: str) -> str:
         """
         Оставляет комментарий в pull request
 
@@ -531,7 +616,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"create_code_review pr_number: {pr_number}, body: {body}")
-            repo = AIAutomation._get_repository()
+            repo = self._get_repository()
             pr = AIAutomation._get_pull_request(repo, pr_number)
             pr.create_review(body=body, event="COMMENT")
             logger.info(f"Комментарий к PR {pr.number} добавлен")
@@ -540,10 +625,8 @@ class AIAutomation:
             logger.error(f"Ошибка при создании ревью: {e}")
             return f"Ошибка: {e}"
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def approve_pull_request(pr_number: int) -> str:
+    @session_tool(category=ToolCategory.GITHUB)
+    def approve_pull_request(self, pr_number: int) -> str:
         """
         Одобряет pull request
 
@@ -552,7 +635,7 @@ class AIAutomation:
         """
         try:
             logger.info(f"approve_pull_request pr_number: {pr_number}")
-            repo = AIAutomation._get_repository()
+            repo = self._get_repository()
             pr = AIAutomation._get_pull_request(repo, pr_number)
             pr.create_review(event="APPROVE")
             logger.info(f"PR {pr.number} одобрен")
@@ -561,10 +644,8 @@ class AIAutomation:
             logger.error(f"Ошибка при одобрении PR: {e}")
             return f"Ошибка: {e}"
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def merge_pull_request_and_checkout(pr_number: int, commit_message: str = "") -> str:
+    @session_tool(category=ToolCategory.GITHUB, side_effect=True)
+    def merge_pull_request_and_checkout(self, pr_number: int, commit_message: str = "") -> str:
         """
         Мержит pull request в основную ветку main и переключается на нее
 
@@ -574,17 +655,18 @@ class AIAutomation:
         """
         try:
             logger.info(f"merge_pull_request_and_checkout pr_number: {pr_number}, commit_message: {commit_message}")
-            repo = AIAutomation._get_repository()
+            repo = self._get_repository()
             pr = AIAutomation._get_pull_request(repo, pr_number)
             result = pr.merge(commit_message=commit_message)
             if result.merged:
                 # после успешного мержа, подтягиваем изменения локально
-                local_repo = Repo(AIAutomation.repo_path)
+                local_repo = Repo(self.repo_path)
                 # local_repo.remotes.origin.pull('main')
                 local_repo.git.checkout("main")
                 local_repo.git.fetch("origin")  # Получить последние изменения
                 # local_repo.git.pull("origin", "main", "--rebase")  # Использовать rebase для синхронизации
                 local_repo.git.reset("--hard", "origin/main") #удалит все локальные изменения в ветке main и синхронизирует её с удалённой.
+                self._worktree_changed()
                 logger.info(f"PR {pr.number} успешно смержен")
                 return "Pull request успешно смержен и выполнен checkout в main"
             else:
@@ -595,10 +677,8 @@ class AIAutomation:
             return f"Ошибка: {e}"
 
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def update_todo_list(tasks: dict) -> dict:
+    @session_tool
+    def update_todo_list(self, tasks: dict) -> dict:
         """
         Агент передаёт список задач целиком, они заменяют предыдущие.
         Пример структуры task:
@@ -620,21 +700,19 @@ class AIAutomation:
         :return: тот же самый список который созранился в базе
         """
         logger.info(f"update_todo_list tasks: {tasks}")
-        AIAutomation.todo_list_storage.clear()
-        AIAutomation.todo_list_storage.update(tasks)
-        logger.info(f"update_todo_list: {AIAutomation.todo_list_storage}")
-        return AIAutomation.todo_list_storage
+        self.todo_list_storage.clear()
+        self.todo_list_storage.update(tasks)
+        logger.info(f"update_todo_list: {self.todo_list_storage}")
+        return self.todo_list_storage
 
-    @staticmethod
-    @tool
-    @rate_limited_tools_per_minute
-    def get_todo_list() -> dict:
+    @session_tool(read_only=True)
+    def get_todo_list(self) -> dict:
         """
         Получить список запланированных задач в виде dict:
 
         :return:
         Пример структуры ответа: {"add_logger" : {"desc": "Добавить логгер", "done": False},"add_exit": {"desc": "Добавить use case выхода", "done": True}}
         """
-        logger.info(f"get_todo_list tasks: {AIAutomation.todo_list_storage}")
-        return AIAutomation.todo_list_storage
+        logger.info(f"get_todo_list tasks: {self.todo_list_storage}")
+        return self.todo_list_storage
 
@@ -1,68 +1,142 @@
 import logging
 import uuid
-from typing import Sequence, Any, Optional
+from typing import Sequence, Any, Optional, NotRequired, Iterator, AsyncIterator, MutableMapping
 
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.language_models import LanguageModelLike, BaseChatModel
-from langchain_core.messages import SystemMessage, trim_messages, RemoveMessage
+from langchain_core.messages import SystemMessage, RemoveMessage, BaseMessage, AIMessage, ToolMessage, HumanMessage
 from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.outputs import LLMResult
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.errors import GraphRecursionError
-from langgraph.graph.message import REMOVE_ALL_MESSAGES
 from langgraph.prebuilt import create_react_agent
+from langgraph.prebuilt.chat_agent_executor import AgentState
 
 from ai_agent_creator.settings import GEMINI_API_KEY
-from ai_integration.helpers.db_dict_factory import DjangoDBDict
+from ai_integration.helpers.django_checkpointer import DjangoCheckpointSaver
+from ai_integration.helpers.message_trimmer import MessageTrimmer
+from ai_integration.helpers.rate_limit import AIMDPolicy, QuotaRateLimiter, RateLimitFeedback, key_fingerprint
+from ai_integration.helpers.summarizer import HistorySummarizer
+from ai_integration.helpers.tool_executor import OrderedToolNode
 from ai_integration.helpers.ai_model_enum import AIModels
 
 logger = logging.getLogger(__name__)
 
+# Короче этого текст сообщения при жёсткой обрезке истории не режется
+HARD_TRIM_MIN_CHARS = 200
+
 
 def model_factory(model: AIModels) -> BaseChatModel:
     # model = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
     # model = ChatGoogleGenerativeAI(model='gemini-2.0-flash-lite')
     # model = ChatGoogleGenerativeAI(model="gemini-2.5-flash-preview-04-17")
     # model = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite-preview-06-17")
-    return ChatGoogleGenerativeAI(model=model.value, api_key=GEMINI_API_KEY)
+    # Лимит стартует с model.requests_per_minute и подстраивается по ответам 429 (RateLimitFeedback)
+    rate_limiter = QuotaRateLimiter(
+        key=f"gemini:{model.value}:{key_fingerprint(GEMINI_API_KEY)}",
+        requests_per_minute=model.requests_per_minute,
+        policy=AIMDPolicy.around(model.requests_per_minute),
+    )
+    return ChatGoogleGenerativeAI(
+        model=model.value,
+        api_key=GEMINI_API_KEY,
+        rate_limiter=rate_limiter,
+        callbacks=[RateLimitFeedback(rate_limiter)],
+    )
+
+class AgentStateWithSummary(AgentState):
+    # Сводка сообщений, удалённых из истории, хранится в чекпоинте вместе с messages
+    summary: NotRequired[str]
+
 
 class LLMAgent:
     def __init__(self,
                  model: LanguageModelLike,
                  tools: Sequence[BaseTool],
                  system_message: SystemMessage,
-                 chat_id: str
+                 chat_id: str,
+                 context_budget: int = 100000,
+                 summary_model: Optional[BaseChatModel] = None,
+                 tool_results: Optional[MutableMapping[str, str]] = None
                  ):
+        """
+        :param context_budget: сколько токенов отправлять модели за вызов (AIModels.context_budget).
+            Когда история перестаёт влезать, старые сообщения сворачиваются в сводку,
+            и в истории остаётся примерно половина бюджета
+        :param summary_model: модель для сводки, по умолчанию model
+        :param tool_results: результаты вызовов с внешним эффектом (см. OrderedToolNode),
+            чтобы продолжение прерванного хода не повторяло push, PR и merge
+        """
         self._model = model
+        self._summarizer = HistorySummarizer(summary_model or model, max_tokens=context_budget // 10)
+        history_budget = context_budget - self._summarizer.max_tokens - count_tokens_approximately([system_message])
+
+        # Кэш токенов живёт вместе с агентом (один агент = один chat_id), каждое сообщение считается один раз
+        self._trimmer = MessageTrimmer(max_tokens=history_budget)
+        self._keep_trimmer = MessageTrimmer(max_tokens=history_budget // 2)
+        # Жёсткая обрезка одного хода: хвост может начинаться и с ответа модели, без задачи хода
+        self._hard_trimmer = MessageTrimmer(max_tokens=history_budget, start_on=("human", "ai"))
 
         # This function will be called every time before the node that calls LLM
         def pre_model_hook(state):
-            trimmed_messages = trim_messages(
-                state["messages"],
-                strategy="last",
-                token_counter=count_tokens_approximately,
-                max_tokens=100000,
-                start_on="human",
-                end_on=("human", "tool"),
-                include_system=True
-            )
+            messages = state["messages"]
+            trimmed_messages = self._trimmer.trim(messages)
+            if not messages or (trimmed_messages and trimmed_messages[0].id == messages[0].id):
+                return {}
+
+            # История не влезает в бюджет: сворачиваем старые сообщения в сводку одним вызовом,
+            # чтобы следующие шаги снова шли без суммаризации, пока история не вырастет
+            kept = self._keep_trimmer.trim(messages) or trimmed_messages
+            start = next((i for i, message in enumerate(messages) if message.id == kept[0].id), 0) if kept else 0
+            shortened: list[BaseMessage] = []
+            if start > 0:
+                dropped = messages[:start]
+            else:
+                # Граница по сообщению человека не находится: вся история - один ход (задача по расписанию -
+                # один промпт и десятки вызовов инструментов). Сворачиваем старые группы вызовов этого хода
+                dropped = self._dropped_tool_groups(messages)
+                if not dropped:
+                    dropped, shortened = self._hard_trim(messages)
+                    if not dropped and not shortened:
+                        return {}
+            dropped_ids = [message.id for message in dropped]
+            for trimmer in (self._trimmer, self._keep_trimmer, self._hard_trimmer):
+                trimmer.forget([*dropped_ids, *(message.id for message in shortened)])
+            update: dict[str, Any] = {
+                # Укороченные копии заменяют сообщения с тем же id (add_messages)
+                "messages": [*(RemoveMessage(id=message_id) for message_id in dropped_ids), *shortened],
+            }
+            if dropped:
+                try:
+                    update["summary"] = self._summarizer.fold(state.get("summary", ""), dropped)
+                except Exception as e:
+                    # Без сводки агент продолжает работу, как при обычной обрезке истории
+                    logger.error(f"summarize error, {len(dropped)} messages dropped without summary: {e}")
             # pprint.pp(trimmed_messages)
+            # Удаляем из истории только вытесненные сообщения: оставшиеся объекты не меняются,
+            # и чекпоинтер пишет дельту канала messages, а не всю историю заново
+            return update
 
-            # return {"llm_input_messages": trimmed_messages} #обрезать только для модели, но историю хранить всю
-            return {"messages": [RemoveMessage(REMOVE_ALL_MESSAGES)] + trimmed_messages}# обрезать историю в том числе
+        def prompt(state) -> list[BaseMessage]:
+            summary = state.get("summary")
+            if not summary:
+                return [system_message, *state["messages"]]
+            return [system_message, self._summarizer.as_message(summary), *state["messages"]]
 
-        # Единый record_id для всех таблиц
-        factory = DjangoDBDict.db_dict_factory(record_id=chat_id)
-        self.checkpointer = InMemorySaver(factory=factory)
+        # Чекпоинты читаются из базы по запросу, thread_id = chat_id
+        self.checkpointer = DjangoCheckpointSaver()
         logger.info(f"init agent system_message: {system_message}")
         self._agent = create_react_agent(
-            prompt=system_message,
+            prompt=prompt,
             pre_model_hook=pre_model_hook,
+            state_schema=AgentStateWithSummary,
             model=model,
-            tools=tools,
+            # Все вызовы инструментов одного хода выполняются в одном узле (version="v1"):
+            # read-only параллельно, изменяющие по порядку
+            tools=OrderedToolNode(tools, tool_results=tool_results),
+            version="v1",
             checkpointer=self.checkpointer
         )
 
@@ -74,46 +148,205 @@ class LLMAgent:
             "callbacks": [self._tracer],
         }
 
+    def _dropped_tool_groups(self, messages: Sequence[BaseMessage]) -> list[BaseMessage]:
+        """
+        Сообщения, которые нужно свернуть, когда история не режется по сообщению человека: всё до последнего
+        сообщения человека и самые старые группы (AIMessage с вызовами + их ToolMessage) после него,
+        пока остаток не влезет в половину бюджета. Сообщение человека (задача хода) и последняя группа остаются
+        """
+        human = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)), None)
+        first = 0 if human is None else human + 1
+        # Группа начинается с ответа модели, ToolMessage не отрываются от вызова, который их породил
+        boundaries = [i for i in range(first, len(messages)) if isinstance(messages[i], AIMessage)]
+        if not boundaries:
+            return []
+        budget = self._keep_trimmer.max_tokens
+        if human is not None:
+            budget -= self._keep_trimmer.count(messages[human])
+        cut = boundaries[-1]
+        tail = sum(self._keep_trimmer.count(message) for message in messages[cut:])
+        for boundary, next_boundary in zip(reversed(boundaries[:-1]), reversed(boundaries[1:])):
+            tokens = sum(self._keep_trimmer.count(message) for message in messages[boundary:next_boundary])
+            if tail + tokens > budget:
+                break
+            tail += tokens
+            cut = boundary
+        if human is None:
+            return list(messages[:cut])
+        return [*messages[:human], *messages[human + 1:cut]]
+
+    def _hard_trim(self, messages: Sequence[BaseMessage]) -> tuple[list[BaseMessage], list[BaseMessage]]:
+        """
+        Обрезка одного хода, когда целые группы вызовов свернуть нельзя: задача хода вместе с последней группой
+        не влезает в бюджет. Возвращает (сообщения, которые нужно свернуть, укороченные копии оставшихся).
+        Остаётся самый длинный хвост, который влезает и начинается с сообщения человека или модели (ToolMessage
+        не отрываются от вызова); если не влезает и последняя группа, остаётся весь ход с последнего сообщения
+        человека, и у его сообщений обрезается текст
+        """
+        kept = self._hard_trimmer.trim(messages)
+        if kept:
+            start = next(i for i, message in enumerate(messages) if message.id == kept[0].id)
+            logger.warning(f"history does not fit the budget with the turn prompt, {start} messages dropped")
+            return list(messages[:start]), []
+
+        start = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)), 0)
+        tail = list(messages[start:])
+        limit = max((len(message.content) for message in tail if isinstance(message.content, str)), default=0)
+        shortened = tail
+        while limit > HARD_TRIM_MIN_CHARS and count_tokens_approximately(shortened) > self._trimmer.max_tokens:
+            limit //= 2
+            shortened = [self._shorten(message, limit) for message in tail]
+        shortened = [copy for copy, message in zip(shortened, tail) if copy is not message]
+        logger.warning(f"last turn does not fit the budget, {start} messages dropped, {len(shortened)} shortened")
+        return list(messages[:start]), shortened
+
+    @staticmethod
+    def _shorten(message: BaseMessage, limit: int) -> BaseMessage:
+        if not isinstance(message.content, str) or len(message.content) <= limit:
+            return message
+        content = f"{message.content[:limit]}... [обрезано {len(message.content) - limit} символов]"
+        return message.model_copy(update={"content": content})
+
     def upload_file(self, file):
         print(f"upload file {file} to LLM")
         file_uploaded_id = self._model.upload_file(file).id_  # type: ignore
         return file_uploaded_id
 
-    def invoke(
-        self,
-        content: str,
-        attachments: list[str]|None=None,
-        temperature: float=0.1
-    ) -> str:
-        """Отправляет сообщение в чат"""
+    def can_resume(self) -> bool:
+        """В чекпоинте чата есть незавершённый ход (прерван ошибкой или падением воркера)"""
+        return bool(self._agent.get_state(self._config).next)
+
+    @staticmethod
+    def _input(content: Optional[str], attachments: list[str]|None, temperature: float) -> Optional[dict]:
+        if content is None:
+            # Без нового сообщения граф продолжает с последнего чекпоинта: незавершённые узлы
+            # выполняются заново, уже записанные результаты (pending writes) повторно не считаются
+            logger.info("resume from checkpoint")
+            return None
         message: dict = {
             "role": "user",
             "content": content,
             **({"attachments": attachments} if attachments else {})
         }
+        logger.info(f"invoke {message}")
+        return {
+            "messages": [message],
+            "temperature": temperature
+        }
+
+    def stream(
+        self,
+        content: Optional[str],
+        attachments: list[str]|None=None,
+        temperature: float=0.1
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Отправляет сообщение в чат и отдаёт события по мере выполнения ReAct цикла:
+        llm_message (текст ответа модели), tool_call (модель вызвала инструмент), tool_result (ответ инструмента).
+        Чекпоинт пишется после каждого шага графа, поэтому если перестать читать стрим (break),
+        выполненные шаги сохранены, и следующий вызов продолжит ту же историю.
+        content=None продолжает прерванный ход с чекпоинта (см. can_resume), не добавляя сообщение.
+        """
+        updates = self._agent.stream(
+            input=self._input(content, attachments, temperature),
+            config=self._config,
+            stream_mode="updates"
+        )
         try:
-            logger.info(f"invoke {message}")
-            self._agent.invoke(
-                input = {
-                    "messages": [message],
-                    "temperature": temperature
-                },
-                config=self._config
-            )
-            # Логика для просмотра reasoning
-            # print("REASONING TRACE:")
-            # for step in self._tracer.steps:
-            #     print(step)
+            for update in updates:
+                yield from self._update_events(update)
         except GraphRecursionError:
+            logger.warning("⚠️ Достигнут лимит reasoning.")
+        except Exception as e:
+            logger.error(f"InvokeError: {e}")
+            raise e
+        finally:
+            # Закрытие стрима дожидается записи последнего чекпоинта
+            updates.close()
 
+    async def astream(
+        self,
+        content: Optional[str],
+        attachments: list[str]|None=None,
+        temperature: float=0.1
+    ) -> AsyncIterator[dict[str, Any]]:
+        """Асинхронная версия stream: пока агент ждёт модель или инструменты, event loop обслуживает другие сессии"""
+        updates = self._agent.astream(
+            input=self._input(content, attachments, temperature),
+            config=self._config,
+            stream_mode="updates"
+        )
+        try:
+            async for update in updates:
+                for event in self._update_events(update):
+                    yield event
+        except GraphRecursionError:
             logger.warning("⚠️ Достигнут лимит reasoning.")
         except Exception as e:
             logger.error(f"InvokeError: {e}")
             raise e
+        finally:
+            await updates.aclose()
+
+    def _update_events(self, update: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        for node, values in update.items():
+            if not isinstance(values, dict):
+                continue
+            for message in values.get("messages", []):
+                yield from self._message_events(node, message)
+
+    @staticmethod
+    def _message_events(node: str, message: BaseMessage) -> Iterator[dict[str, Any]]:
+        if isinstance(message, AIMessage):
+            if message.text():
+                yield {"type": "llm_message", "node": node, "content": message.text()}
+            for tool_call in message.tool_calls:
+                yield {
+                    "type": "tool_call",
+                    "node": node,
+                    "tool": tool_call["name"],
+                    "args": tool_call["args"],
+                    "tool_call_id": tool_call["id"],
+                }
+        elif isinstance(message, ToolMessage):
+            yield {
+                "type": "tool_result",
+                "node": node,
+                "tool": message.name,
+                "content": message.content,
+                "status": message.status,
+                "tool_call_id": message.tool_call_id,
+            }
+
+    def invoke(
+        self,
+        content: str,
+        attachments: list[str]|None=None,
+        temperature: float=0.1
+    ) -> str:
+        """Отправляет сообщение в чат"""
+        for _ in self.stream(content=content, attachments=attachments, temperature=temperature):
+            pass
+        # Логика для просмотра reasoning
+        # print("REASONING TRACE:")
+        # for step in self._tracer.steps:
+        #     print(step)
 
         result = self.checkpointer.get(config=self._config).get("channel_values")
         return result
 
+    async def ainvoke(
+        self,
+        content: str,
+        attachments: list[str]|None=None,
+        temperature: float=0.1
+    ) -> dict:
+        """Асинхронная версия invoke"""
+        async for _ in self.astream(content=content, attachments=attachments, temperature=temperature):
+            pass
+        checkpoint = await self.checkpointer.aget(config=self._config)
+        return checkpoint.get("channel_values")
+
 
 class ReasoningTracer(BaseCallbackHandler):
     def __init__(self):
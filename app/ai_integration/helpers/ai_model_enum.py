@@ -8,3 +8,34 @@ class AIModels(Enum):
     # GEMINI_2_5_FLASH_PREVIEW_04_17 = "gemini-2.5-flash-preview-04-17"
     GEMINI_2_5_FLASH_LITE_PREVIEW_06_17 = "gemini-2.5-flash-lite-preview-06-17" #Самый худший вариант
     GEMINI_2_0_FLASH_PREVIEW_IMAGE_GENERATION = "gemini-2.0-flash-preview-image-generation"
+
+    @property
+    def context_budget(self) -> int:
+        """Сколько токенов истории (с системным промптом и сводкой) отправляется модели за один вызов"""
+        return CONTEXT_BUDGETS.get(self, DEFAULT_CONTEXT_BUDGET)
+
+    @property
+    def requests_per_minute(self) -> int:
+        """Лимит запросов к модели в минуту на один API ключ (общий для всех воркеров, см. QuotaRateLimiter)"""
+        return REQUESTS_PER_MINUTE.get(self, DEFAULT_REQUESTS_PER_MINUTE)
+
+
+DEFAULT_CONTEXT_BUDGET = 32000
+# Старые сообщения сворачиваются в сводку (HistorySummarizer), когда история перестаёт влезать в бюджет
+CONTEXT_BUDGETS: dict[AIModels, int] = {
+    AIModels.GEMINI_2_5_FLASH: 64000,
+    AIModels.GEMINI_2_0_FLASH: 48000,
+    AIModels.GEMINI_2_0_FLASH_LITE: 24000,
+    AIModels.GEMINI_2_5_FLASH_LITE_PREVIEW_06_17: 24000,
+    AIModels.GEMINI_2_0_FLASH_PREVIEW_IMAGE_GENERATION: 16000,
+}
+
+DEFAULT_REQUESTS_PER_MINUTE = 10
+# Бесплатный tier Gemini API
+REQUESTS_PER_MINUTE: dict[AIModels, int] = {
+    AIModels.GEMINI_2_5_FLASH: 10,
+    AIModels.GEMINI_2_0_FLASH: 15,
+    AIModels.GEMINI_2_0_FLASH_LITE: 30,
+    AIModels.GEMINI_2_5_FLASH_LITE_PREVIEW_06_17: 15,
+    AIModels.GEMINI_2_0_FLASH_PREVIEW_IMAGE_GENERATION: 10,
+}
@@ -0,0 +1,661 @@
+import bisect
+import logging
+import math
+import mmap
+import os
+import pickle
+import re
+import subprocess
+import threading
+import time
+from array import array
+from collections import deque
+from contextlib import closing
+from functools import lru_cache
+from typing import Iterable, Optional, Union
+
+import billiard
+from billiard.exceptions import WorkerLostError
+from billiard.pool import Pool
+
+try:
+    import re._parser as sre_parse
+    from re._constants import AT, BRANCH, LITERAL, MAX_REPEAT, MIN_REPEAT, SUBPATTERN
+except ImportError:  # Python < 3.11
+    import sre_parse
+    from sre_constants import AT, BRANCH, LITERAL, MAX_REPEAT, MIN_REPEAT, SUBPATTERN
+
+logger = logging.getLogger(__name__)
+
+# Файлы больше этого размера не индексируются по триграммам: они всегда кандидаты и проверяются целиком
+MAX_FILE_SIZE = 1024 * 1024
+# Файлы больше этого размера и бинарные (NUL в начале) не ищутся совсем
+MAX_SCAN_FILE_SIZE = 32 * 1024 * 1024
+BINARY_SNIFF = 8192
+# Файлы от этого размера читаются через mmap: отбор по литералам идёт по отображённой памяти без копии
+MMAP_THRESHOLD = 256 * 1024
+# Меньше стольких файлов проверяются в текущем процессе: передача в пул процессов дороже самого поиска
+PARALLEL_MIN_FILES = 256
+# Не индексируются и не ищутся никогда, даже вне git репозитория
+EXCLUDE = frozenset({".git", ".venv", "venv", "node_modules", "__pycache__"})
+# Вариантов литералов (a|b)(c|d)... больше этого - фильтр по триграммам для части шаблона не строится
+MAX_ALTERNATIVES = 16
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _literal_alternatives(parsed) -> Optional[list[list[str]]]:
+    """
+    Литералы, без которых регулярное выражение не совпадёт: список вариантов (ветки |),
+    в каждом - строки, которые все должны встретиться. None - литералов не нашлось.
+    """
+    alternatives: list[list[str]] = [[]]
+    run: list[str] = []
+
+    def flush():
+        if run:
+            for alternative in alternatives:
+                alternative.append("".join(run))
+            run.clear()
+
+    def extend(nested: Optional[list[list[str]]]):
+        nonlocal alternatives
+        flush()
+        if not nested:
+            return
+        if len(alternatives) * len(nested) > MAX_ALTERNATIVES:
+            return
+        alternatives = [alternative + extra for alternative in alternatives for extra in nested]
+
+    for op, av in parsed:
+        if op is LITERAL:
+            run.append(chr(av))
+        elif op is SUBPATTERN:
+            extend(_literal_alternatives(av[-1]))
+        elif op is BRANCH:
+            branches = [_literal_alternatives(branch) for branch in av[1]]
+            # Ветка без литералов может совпасть с чем угодно: ограничения нет
+            if all(branches):
+                extend([alternative for branch in branches for alternative in branch])
+            else:
+                flush()
+        elif op in (MAX_REPEAT, MIN_REPEAT) and av[0] >= 1:
+            # Повтор хотя бы один раз: содержимое встречается, но соседние литералы не примыкают к нему
+            extend(_literal_alternatives(av[2]))
+        elif op is AT:
+            flush()
+        else:
+            flush()
+    flush()
+    alternatives = [[literal for literal in alternative if literal] for alternative in alternatives]
+    return alternatives if any(alternatives) else None
+
+
+def required_trigrams(pattern: str) -> Optional[list[set[str]]]:
+    """
+    Триграммы (в нижнем регистре) для отбора файлов: файл может совпасть, только если содержит
+    все триграммы хотя бы одного варианта. None - шаблон слишком общий, проверять нужно все файлы.
+    """
+    try:
+        alternatives = _literal_alternatives(sre_parse.parse(pattern))
+    except Exception:
+        return None
+    if not alternatives:
+        return None
+    result = [set().union(*(trigrams(literal.lower()) for literal in alternative)) for alternative in alternatives]
+    # Вариант без триграмм (литералы короче 3 символов) ничего не отсекает
+    return None if not all(result) else result
+
+
+# (?i) в начале шаблона или (?i:...) внутри: литералы совпадают без учёта регистра
+_SCOPED_IGNORECASE = re.compile(r"\(\?[aiLmsux]*i")
+
+
+def literal_prefilter(pattern: str) -> Optional[re.Pattern]:
+    """
+    bytes регулярное выражение из обязательных литералов pattern (самый длинный литерал каждого варианта):
+    файл, где оно не нашлось, не может совпасть, и его не нужно декодировать. None - отбора нет
+    (литералов нет или шаблон без учёта регистра).
+    """
+    try:
+        if re.compile(pattern).flags & re.IGNORECASE or _SCOPED_IGNORECASE.search(pattern):
+            return None
+        alternatives = _literal_alternatives(sre_parse.parse(pattern))
+        if not alternatives or not all(alternatives):
+            return None
+        literals = sorted({max(alternative, key=len).encode("utf-8") for alternative in alternatives}, key=len, reverse=True)
+    except Exception:
+        return None
+    # Невалидный UTF-8 декодируется в U+FFFD, в байтах файла такого литерала нет
+    if any("\ufffd".encode("utf-8") in literal for literal in literals):
+        return None
+    return re.compile(b"|".join(re.escape(literal) for literal in literals))
+
+
+@lru_cache(maxsize=32)
+def _compile(pattern: str) -> tuple[re.Pattern, Optional[re.Pattern]]:
+    return re.compile(pattern), literal_prefilter(pattern)
+
+
+# Совпадение для сборки результата: (нужен ли разделитель "--" перед ним, строки контекста и совпадения)
+Match = tuple[bool, list[str]]
+
+
+def _grep(path: str, text: str, regex: re.Pattern, context_lines: int, limit: int) -> list[Match]:
+    """Построчная проверка файла, как grep: "путь:строка: текст" и context_lines строк вокруг ("путь-строка- текст")"""
+    lines = text.splitlines()
+    matches: list[Match] = []
+    last_shown = -1
+    for i, line in enumerate(lines):
+        if not regex.search(line):
+            continue
+        shown: list[str] = []
+        separator = False
+        if context_lines:
+            start = max(i - context_lines, last_shown + 1)
+            # Разделитель между несмежными группами строк, в том числе разных файлов
+            separator = last_shown < 0 or start > last_shown + 1
+            shown.extend(f"{path}-{j + 1}- {lines[j].rstrip()}" for j in range(start, i))
+        shown.append(f"{path}:{i + 1}: {line.strip()}")
+        last_shown = i
+        if context_lines:
+            end = min(i + context_lines, len(lines) - 1)
+            # Строки после совпадения, до следующего совпадения в них
+            for j in range(i + 1, end + 1):
+                if regex.search(lines[j]):
+                    break
+                shown.append(f"{path}-{j + 1}- {lines[j].rstrip()}")
+                last_shown = j
+        matches.append((separator, shown))
+        if len(matches) >= limit:
+            break
+    return matches
+
+
+def _search_file(repo_path: str, path: str, regex: re.Pattern, prefilter: Optional[re.Pattern], context_lines: int, limit: int) -> list[Match]:
+    """
+    Совпадения в одном файле. Бинарные и слишком большие файлы пропускаются, большие читаются через mmap;
+    файл без литералов шаблона отбрасывается по байтам, без декодирования.
+    """
+    data: Union[bytes, mmap.mmap, None] = None
+    try:
+        with open(os.path.join(repo_path, path), "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if not size or size > MAX_SCAN_FILE_SIZE:
+                return []
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size >= MMAP_THRESHOLD else file.read()
+        if b"\0" in data[:BINARY_SNIFF]:
+            return []
+        if prefilter is not None and not prefilter.search(data):
+            return []
+        return _grep(path, str(data, "utf-8", "replace"), regex, context_lines, limit)
+    except (OSError, ValueError) as e:
+        # Удалённый после листинга файл, директория подмодуля, файл без прав на чтение
+        logger.debug(f"find_in_files skips '{path}': {e}")
+        return []
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _search_chunk(repo_path: str, paths: list[str], pattern: str, context_lines: int, limit: int) -> list[Match]:
+    """Часть списка файлов; в пуле процессов выполняется в дочернем процессе"""
+    regex, prefilter = _compile(pattern)
+    matches: list[Match] = []
+    for path in paths:
+        matches.extend(_search_file(repo_path, path, regex, prefilter, context_lines, limit - len(matches)))
+        if len(matches) >= limit:
+            break
+    return matches
+
+
+_pool: Optional[Pool] = None
+_pool_workers = 0
+_pool_unavailable = False
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> Optional[Pool]:
+    """
+    Пул процессов поиска, общий для всех сессий процесса: процессы запускаются один раз через forkserver
+    (fork многопоточного воркера небезопасен). Пул из billiard, а не concurrent.futures: воркер Celery -
+    демонический дочерний процесс prefork пула, и multiprocessing не даёт ему запускать свои процессы.
+    None - пул недоступен, тогда поиск идёт в текущем процессе.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool_unavailable:
+            return None
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.terminate()
+            methods = billiard.get_all_start_methods()
+            context = billiard.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = Pool(processes=workers, context=context)
+            _pool_workers = workers
+        return _pool
+
+
+def _pool_failed(e: BaseException):
+    global _pool, _pool_unavailable
+    logger.warning(f"find_in_files process pool is not available, searching in one process: {e!r}")
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+        _pool = None
+        _pool_unavailable = True
+
+
+def _parallel_chunks(
+    repo_path: str, paths: list[str], pattern: str, context_lines: int, limit: int, workers: int
+) -> Iterable[list[Match]]:
+    """
+    Совпадения по частям списка файлов, которые проверяются параллельно в пуле процессов. Части отдаются
+    по порядку, поэтому результат тот же, что у последовательного поиска. В пуле одновременно не больше
+    двух частей на процесс: когда вызывающий прекращает итерацию (набрано limit совпадений), остальные
+    части не отправляются.
+    """
+    pool = _get_pool(workers)
+    if pool is None:
+        yield _search_chunk(repo_path, paths, pattern, context_lines, limit)
+        return
+    # Несколько частей на процесс: быстрые части не ждут самую медленную, а остановка срабатывает раньше
+    size = max(16, math.ceil(len(paths) / (workers * 4)))
+    chunks = iter(range(0, len(paths), size))
+    pending = deque()
+
+    def submit():
+        start = next(chunks, None)
+        if start is not None:
+            args = (repo_path, paths[start:start + size], pattern, context_lines, limit)
+            pending.append(pool.apply_async(_search_chunk, args))
+
+    for _ in range(workers * 2):
+        submit()
+    while pending:
+        result = pending.popleft()
+        submit()
+        yield result.get()
+
+
+def search_files(
+    repo_path: str,
+    paths: list[str],
+    pattern: str,
+    max_results: int = 100,
+    context_lines: int = 0,
+    workers: int = 1,
+) -> list[str]:
+    """
+    Совпадения pattern в файлах paths (относительно repo_path) в их порядке. Поиск останавливается на
+    max_results совпадениях; при workers > 1 и большом списке файлы проверяются в пуле процессов.
+    """
+    _compile(pattern)
+    if workers > 1 and len(paths) >= PARALLEL_MIN_FILES:
+        try:
+            with closing(_parallel_chunks(repo_path, paths, pattern, context_lines, max_results, workers)) as chunks:
+                return _collect(chunks, max_results)
+        # WorkerLostError - процесс пула завершился во время поиска (OOM killer)
+        except (WorkerLostError, OSError) as e:
+            _pool_failed(e)
+    return _collect([_search_chunk(repo_path, paths, pattern, context_lines, max_results)], max_results)
+
+
+def _collect(chunks: Iterable[list[Match]], max_results: int) -> list[str]:
+    results: list[str] = []
+    matches = 0
+    for chunk in chunks:
+        for separator, lines in chunk:
+            if separator and results:
+                results.append("--")
+            results.extend(lines)
+            matches += 1
+            if matches >= max_results:
+                results.append(f"… поиск остановлен на {max_results} совпадениях, уточните pattern или directory")
+                return results
+    return results
+
+
+def filter_paths(paths: Iterable[str], directory: str = ".", extensions: Optional[Iterable[str]] = None) -> list[str]:
+    """Файлы внутри directory (относительно корня репозитория) с одним из расширений extensions"""
+    prefix = os.path.normpath(directory).replace(os.sep, "/")
+    prefix = "" if prefix == "." else prefix.rstrip("/") + "/"
+    extensions = tuple(extensions) if extensions else None
+    return [path for path in paths if path.startswith(prefix) and (not extensions or path.endswith(extensions))]
+
+
+def _split(output: bytes) -> list[str]:
+    return [path for path in output.decode("utf-8", "surrogateescape").split("\0") if path]
+
+
+def walk_files(repo_path: str, directory: str = ".") -> list[str]:
+    """Все файлы directory вне git: os.walk без EXCLUDE, пути относительно repo_path"""
+    files = []
+    for root, dirs, names in os.walk(os.path.join(repo_path, directory)):
+        dirs[:] = [name for name in dirs if name not in EXCLUDE]
+        relative_root = os.path.relpath(root, repo_path)
+        for name in names:
+            files.append(os.path.normpath(os.path.join(relative_root, name)).replace(os.sep, "/"))
+    return files
+
+
+def list_files(repo_path: str, directory: str = ".") -> list[str]:
+    """Файлы directory для поиска без индекса: отслеживаемые и неигнорируемые по git, вне git - walk_files"""
+    directory = os.path.normpath(directory)
+    if os.path.isabs(directory) or directory.split(os.sep)[0] == "..":
+        return []
+    try:
+        output = subprocess.run(
+            ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--", directory],
+            cwd=repo_path,
+            capture_output=True,
+            check=True,
+            timeout=60,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return sorted(walk_files(repo_path, directory))
+    # Файл с конфликтом слияния выводится по разу на каждую стадию
+    return sorted(set(_split(output)))
+
+
+def scan(
+    repo_path: str,
+    pattern: str,
+    directory: str = ".",
+    extensions: Optional[Iterable[str]] = None,
+    max_results: int = 100,
+    context_lines: int = 0,
+    workers: int = 1,
+) -> list[str]:
+    """Разовый поиск без индекса: все файлы directory, параллельно по workers процессам"""
+    _compile(pattern)
+    paths = filter_paths(list_files(repo_path, directory), directory, extensions)
+    return search_files(repo_path, paths, pattern, max_results, context_lines, workers)
+
+
+class CodeSearchIndex:
+    """
+    Триграммный индекс рабочей копии для find_in_files: по литералам регулярного выражения выбираются
+    файлы-кандидаты, и только они читаются и проверяются построчно.
+
+    Индекс хранится в .git/ai_agent_code_index.pickle и при загрузке догоняет рабочую копию по git:
+    git diff от проиндексированного коммита, git status и файлы, которые были изменены при прошлой синхронизации.
+    Записи инструментов агента сообщаются через notify_changed, git операции (checkout, merge) - через
+    notify_git_changed, поэтому между ними поиск не запускает git. Вне git репозитория индекс сверяет mtime всех файлов.
+
+    Файлы больше MAX_FILE_SIZE не разбираются на триграммы и проверяются при каждом поиске.
+    Списки файлов для триграмм - отсортированные array('I') идентификаторов. Изменённый файл получает новый
+    идентификатор, старый помечается удалённым; когда удалённых становится больше живых, списки пересобираются.
+    """
+    VERSION = 2
+    FILE_NAME = "ai_agent_code_index.pickle"
+    # Как часто сохранять индекс после небольших изменений; потерянные изменения догоняются по git при загрузке
+    SAVE_INTERVAL = 60
+
+    def __init__(self, repo_path: str):
+        self.repo_path = os.path.abspath(repo_path)
+        self.head: Optional[str] = None
+        # Путь -> (идентификатор, st_mtime_ns, st_size)
+        self.files: dict[str, tuple[int, int, int]] = {}
+        # Идентификатор -> путь, None - файл удалён или изменён
+        self.paths: list[Optional[str]] = []
+        self.postings: dict[str, array] = {}
+        # Файлы больше MAX_FILE_SIZE: без триграмм, кандидаты для любого шаблона
+        self.large: set[str] = set()
+        # Изменённые относительно HEAD файлы при прошлой синхронизации: после checkout они могут стать чистыми
+        self.worktree_changes: set[str] = set()
+        self._removed = 0
+        # Индекс изменился после загрузки или сохранения
+        self._dirty = False
+        self._git_stale = True
+        self._changed_paths: set[str] = set()
+        self._saved_at = 0.0
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> dict:
+        state = {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+        state["_removed"] = self._removed
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["repo_path"])
+        self.__dict__.update(state)
+
+    @property
+    def index_path(self) -> Optional[str]:
+        git_dir = os.path.join(self.repo_path, ".git")
+        return os.path.join(git_dir, self.FILE_NAME) if os.path.isdir(git_dir) else None
+
+    @classmethod
+    def exists(cls, repo_path: str) -> bool:
+        """Индекс уже сохранён на диск: загрузить его дешевле, чем сканировать файлы"""
+        index_path = cls(repo_path).index_path
+        return index_path is not None and os.path.exists(index_path)
+
+    @classmethod
+    def load(cls, repo_path: str) -> "CodeSearchIndex":
+        """Индекс с диска, если он есть и той же версии; сверка с рабочей копией - при первом поиске"""
+        index = cls(repo_path)
+        index_path = index.index_path
+        if index_path is None or not os.path.exists(index_path):
+            return index
+        try:
+            with open(index_path, "rb") as file:
+                version, loaded = pickle.load(file)
+            if version == cls.VERSION and isinstance(loaded, cls):
+                loaded.repo_path = index.repo_path
+                return loaded
+        except Exception as e:
+            logger.warning(f"code index {index_path} is broken, rebuilding: {e}")
+        return index
+
+    def save(self):
+        index_path = self.index_path
+        if index_path is None:
+            return
+        with self._lock:
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                pickle.dump((self.VERSION, self), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+            self._saved_at = time.monotonic()
+            self._dirty = False
+
+    def notify_changed(self, paths: Iterable[str]):
+        """Файлы, изменённые инструментами агента (пути относительно репозитория)"""
+        with self._lock:
+            self._changed_paths.update(os.path.normpath(path).replace(os.sep, "/") for path in paths)
+
+    def notify_git_changed(self):
+        """Рабочая копия изменена git операцией (checkout, merge, pull)"""
+        with self._lock:
+            self._git_stale = True
+
+    def _git(self, *args: str) -> Optional[bytes]:
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=self.repo_path, capture_output=True, check=True, timeout=60
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def _git_files(self) -> Optional[list[str]]:
+        output = self._git("ls-files", "-z", "--cached", "--others", "--exclude-standard")
+        return None if output is None else _split(output)
+
+    def _worktree_changes(self) -> Optional[set[str]]:
+        output = self._git("status", "--porcelain=v1", "-z", "--untracked-files=all")
+        if output is None:
+            return None
+        changes: set[str] = set()
+        entries = _split(output)
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            changes.add(entry[3:])
+            # Переименование и копирование: следующим элементом идёт исходный путь
+            if entry[0] in "RC":
+                i += 1
+                if i < len(entries):
+                    changes.add(entries[i])
+            i += 1
+        return changes
+
+    def _remove(self, path: str):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            self.paths[entry[0]] = None
+            self.large.discard(path)
+            self._removed += 1
+            self._dirty = True
+
+    def _index_file(self, path: str):
+        """(Пере)индексирует файл; удалённый, бинарный или больше MAX_SCAN_FILE_SIZE файл убирается из индекса"""
+        full_path = os.path.join(self.repo_path, path)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            self._remove(path)
+            return
+        entry = self.files.get(path)
+        if entry is not None and entry[1:] == (stat.st_mtime_ns, stat.st_size):
+            return
+        self._remove(path)
+        if not os.path.isfile(full_path) or stat.st_size > MAX_SCAN_FILE_SIZE:
+            return
+        large = stat.st_size > MAX_FILE_SIZE
+        try:
+            with open(full_path, "rb") as file:
+                data = file.read(BINARY_SNIFF if large else -1)
+        except OSError:
+            return
+        if b"\0" in data[:BINARY_SNIFF]:
+            return
+        file_id = len(self.paths)
+        self._dirty = True
+        self.paths.append(path)
+        self.files[path] = (file_id, stat.st_mtime_ns, stat.st_size)
+        if large:
+            self.large.add(path)
+            return
+        postings = self.postings
+        for trigram in trigrams(data.decode("utf-8", "replace").lower()):
+            posting = postings.get(trigram)
+            if posting is None:
+                postings[trigram] = array("I", (file_id,))
+            else:
+                posting.append(file_id)
+
+    def _rebuild(self, files: list[str]):
+        self.files, self.paths, self.postings, self.large, self._removed = {}, [], {}, set(), 0
+        for path in sorted(files):
+            self._index_file(path)
+
+    def _compact(self):
+        """Убирает из списков идентификаторы удалённых и изменённых файлов"""
+        paths = self.paths
+        for trigram, posting in list(self.postings.items()):
+            alive = array("I", (file_id for file_id in posting if paths[file_id] is not None))
+            if alive:
+                self.postings[trigram] = alive
+            else:
+                del self.postings[trigram]
+        self._removed = 0
+
+    def _sync_git(self) -> bool:
+        """Сверка с рабочей копией по git; False - не git репозиторий"""
+        head_output = self._git("rev-parse", "--verify", "-q", "HEAD")
+        if head_output is None and self._git("rev-parse", "--git-dir") is None:
+            return False
+        head = head_output.decode().strip() if head_output else None
+        worktree_changes = self._worktree_changes() or set()
+        if not self.files or self.head is None:
+            files = self._git_files()
+            if files is None:
+                return False
+            self._rebuild(files)
+        else:
+            changed = self.worktree_changes | worktree_changes
+            if head != self.head:
+                diff = self._git("diff", "--name-only", "-z", self.head, head or "")
+                if diff is None:
+                    # Проиндексированного коммита больше нет (force push, новый клон): строим заново
+                    self.head = None
+                    return self._sync_git()
+                changed |= set(_split(diff))
+            for path in changed:
+                self._index_file(path)
+        if (head, worktree_changes) != (self.head, self.worktree_changes):
+            self._dirty = True
+        self.head = head
+        self.worktree_changes = worktree_changes
+        return True
+
+    def refresh(self):
+        """Догоняет рабочую копию: git синхронизация после notify_git_changed (и при загрузке), затем записи инструментов"""
+        with self._lock:
+            if self._git_stale:
+                if not self._sync_git():
+                    # Без git сверяем все файлы по mtime и размеру
+                    current = set(walk_files(self.repo_path))
+                    for path in set(self.files) - current:
+                        self._remove(path)
+                    for path in current:
+                        self._index_file(path)
+                self._git_stale = False
+            for path in self._changed_paths:
+                self._index_file(path)
+            # Запись инструмента - тоже изменение относительно HEAD: следующая git синхронизация перепроверит файл
+            self.worktree_changes |= self._changed_paths
+            self._changed_paths.clear()
+            if self._removed > len(self.files):
+                self._compact()
+            if self._dirty and (not self._saved_at or time.monotonic() - self._saved_at > self.SAVE_INTERVAL):
+                try:
+                    self.save()
+                except OSError as e:
+                    logger.warning(f"code index is not saved: {e}")
+
+    def candidates(self, pattern: str) -> list[str]:
+        """Файлы, в которых pattern может совпасть, по алфавиту"""
+        with self._lock:
+            self.refresh()
+            alternatives = required_trigrams(pattern)
+            if alternatives is None:
+                return sorted(self.files)
+            file_ids: set[int] = set()
+            for required in alternatives:
+                postings = sorted((self.postings.get(trigram, array("I")) for trigram in required), key=len)
+                if not postings[0]:
+                    continue
+                # Самый короткий список проверяется по остальным двоичным поиском
+                for file_id in postings[0]:
+                    if all(_contains(posting, file_id) for posting in postings[1:]):
+                        file_ids.add(file_id)
+            found = {path for path in (self.paths[file_id] for file_id in file_ids) if path is not None}
+            return sorted(found | self.large)
+
+    def search(
+        self,
+        pattern: str,
+        directory: str = ".",
+        extensions: Optional[Iterable[str]] = None,
+        max_results: int = 100,
+        context_lines: int = 0,
+        workers: int = 1,
+    ) -> list[str]:
+        """
+        Совпадения pattern построчно, как grep: "путь:строка: текст", с context_lines строками вокруг
+        ("путь-строка- текст", группы разделены "--"). Поиск останавливается на max_results совпадениях.
+        Кандидатов проверяет search_files, при workers > 1 - в пуле процессов.
+        """
+        _compile(pattern)
+        paths = filter_paths(self.candidates(pattern), directory, extensions)
+        return search_files(self.repo_path, paths, pattern, max_results, context_lines, workers)
+
+
+def _contains(posting: array, file_id: int) -> bool:
+    i = bisect.bisect_left(posting, file_id)
+    return i < len(posting) and posting[i] == file_id
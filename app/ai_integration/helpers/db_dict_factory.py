@@ -1,22 +1,151 @@
+import hashlib
 import logging
 import pickle
 import sqlite3
 from collections import defaultdict
-from typing import Type
+from typing import Type, Any, Iterable, Optional
 
 
-from ai_integration.models import (
-    AIStateDefault,
-    AIStateStorage,
-    AIStateWrites,
-    AIStateBlobs,
-    AIState,
-)
+from ai_integration.helpers.state_serializer import StateSerializer
+from ai_integration.models import AIStateDefault, AIState
 
 logger = logging.getLogger(__name__)
 
+# Фиксированный протокол, чтобы хэш ключа не менялся между версиями python
+PICKLE_PROTOCOL = 4
+# Значения этих типов нельзя изменить по ссылке, поэтому чтение такого ключа не делает его "грязным"
+IMMUTABLE_TYPES = (tuple, str, bytes, int, float, bool, type(None))
 
-class DBDict(defaultdict):
+
+class DeltaDict(defaultdict):
+    """
+    Базовый словарь с отслеживанием изменённых ключей.
+    Каждый ключ хранится отдельной строкой, sync_data пишет только те ключи,
+    значения которых изменились с момента последней загрузки/синхронизации.
+    Ключи сериализуются pickle (нужен стабильный хэш и исходные типы), значения - через serializer.
+    """
+
+    def __init__(self, default_factory, serializer: Optional[StateSerializer] = None):
+        super().__init__(default_factory)
+        self.serializer = serializer or StateSerializer()
+        self._dirty: set = set()
+        self._deleted: dict[str, Any] = {}
+        self._synced: dict[str, bytes] = {}  # key_hash -> digest последних записанных данных
+
+    @staticmethod
+    def _key_hash(key) -> str:
+        return hashlib.sha256(pickle.dumps(key, protocol=PICKLE_PROTOCOL)).hexdigest()
+
+    @staticmethod
+    def _digest(data: bytes) -> bytes:
+        return hashlib.sha256(data).digest()
+
+    def _load_row(self, key_data: bytes, data: bytes):
+        key = pickle.loads(key_data)
+        dict.__setitem__(self, key, self.serializer.loads(data))
+        self._synced[self._key_hash(key)] = self._digest(bytes(data))
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        # Вложенные структуры (writes, storage) меняются по ссылке через обращение к ключу
+        if not isinstance(value, IMMUTABLE_TYPES):
+            self._dirty.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._mark_deleted(key)
+
+    def _mark_deleted(self, key):
+        self._dirty.discard(key)
+        key_hash = self._key_hash(key)
+        if key_hash in self._synced:
+            self._deleted[key_hash] = key
+
+    def pop(self, key, *args):
+        if key in self:
+            self._mark_deleted(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._mark_deleted(key)
+        return key, value
+
+    def clear(self):
+        for key in list(self.keys()):
+            self._mark_deleted(key)
+        super().clear()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def _collect_changes(self) -> list[tuple[str, bytes, bytes, bytes]]:
+        """
+        :return: список (key_hash, key_data, data, digest) для ключей, которые нужно записать
+        """
+        changed = []
+        for key in self._dirty:
+            if not dict.__contains__(self, key):
+                continue
+            data = self.serializer.dumps(dict.__getitem__(self, key))
+            key_hash = self._key_hash(key)
+            digest = self._digest(data)
+            if self._synced.get(key_hash) != digest:
+                changed.append((key_hash, pickle.dumps(key, protocol=PICKLE_PROTOCOL), data, digest))
+        return changed
+
+    def _write_rows(self, changed: list[tuple[str, bytes, bytes, bytes]], deleted: Iterable[str]):
+        raise NotImplementedError
+
+    def sync_data(self):
+        try:
+            changed = self._collect_changes()
+            deleted = [key_hash for key_hash in self._deleted if key_hash not in {c[0] for c in changed}]
+            if changed or deleted:
+                logger.info(
+                    f"Syncing {self._name()} from {self.record_id}: "
+                    f"{len(changed)} changed, {len(deleted)} deleted of {len(self)} keys"
+                )
+                self._write_rows(changed, deleted)
+            for key_hash, _, _, digest in changed:
+                self._synced[key_hash] = digest
+            for key_hash in deleted:
+                self._synced.pop(key_hash, None)
+            self._dirty.clear()
+            self._deleted.clear()
+        except Exception as e:
+            logger.error(f"Sync error in {self._name()}: {e}")
+
+    def _name(self) -> str:
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # print(f"Результат: {self.__class__.__name__}: {self}")
+        self.sync_data()
+
+    def __del__(self):
+        try:
+            # print(f"Результат: {self.__class__.__name__}: {self}")
+            self.sync_data()
+        except AttributeError as e:
+            logger.error(f"Error: {e}")
+
+
+class DBDict(DeltaDict):
     @classmethod
     def db_dict_factory(
         cls, db_path="mydatabase.db", record_id="default_id"
@@ -37,78 +166,68 @@ class DBDict(defaultdict):
         return create_db_dict
 
     def __init__(self, default_factory, db_path, table_name, record_id):
-        super().__init__(default_factory)
-        self.table_name = table_name
+        # Значения InMemorySaver - кортежи и defaultdict, поэтому нужен pickle
+        super().__init__(default_factory, serializer=StateSerializer(codec="pickle"))
+        self.table_name = f"{table_name}_items"
         self.record_id = record_id
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
-        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (id TEXT PRIMARY KEY, data TEXT)")
+        self.cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table_name} "
+            f"(id TEXT, key_hash TEXT, key BLOB, data BLOB, PRIMARY KEY (id, key_hash))"
+        )
         try:
             self.load_from_db()
         except Exception as e:
             logger.error(f"Error: {e}")
 
+    def _name(self) -> str:
+        return self.table_name
+
     def load_from_db(self):
         try:
-            self.cursor.execute(f"SELECT data FROM {self.table_name} WHERE id = ?", (self.record_id,))
-            result = self.cursor.fetchone()
-            if result:
-                data = pickle.loads(result[0])
-                super().update(data)
+            self.cursor.execute(f"SELECT key, data FROM {self.table_name} WHERE id = ?", (self.record_id,))
+            for key_data, data in self.cursor.fetchall():
+                self._load_row(key_data, data)
         except Exception as e:
             logger.error(f"load_from_db error in {self.table_name}, {e}")
         logger.info(f"Loaded {self.table_name} from {self.record_id}")
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        self.sync_data()
-
-    def sync_data(self):
-        try:
-            data = pickle.dumps(dict(self))
-            self.cursor.execute(f"INSERT OR REPLACE INTO {self.table_name} (id, data) VALUES (?, ?)", (self.record_id, data))
-            self.conn.commit()
-        except Exception as e:
-            logger.error(f"Sync error in {self.table_name}: {e}")
-
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        # print(f"Результат: {self.__class__.__name__}: {self}")
-        self.sync_data()
+    def _write_rows(self, changed, deleted):
+        self.cursor.executemany(
+            f"INSERT OR REPLACE INTO {self.table_name} (id, key_hash, key, data) VALUES (?, ?, ?, ?)",
+            [(self.record_id, key_hash, key_data, data) for key_hash, key_data, data, _ in changed],
+        )
+        self.cursor.executemany(
+            f"DELETE FROM {self.table_name} WHERE id = ? AND key_hash = ?",
+            [(self.record_id, key_hash) for key_hash in deleted],
+        )
+        self.conn.commit()
 
 
-    def __del__(self):
-        try:
-            # print(f"Результат: {self.__class__.__name__}: {self}")
-            self.sync_data()
-        except AttributeError as e:
-            logger.error(f"Error: {e}")
-
-
-class DjangoDBDict(defaultdict):
+class DjangoDBDict(DeltaDict):
     @classmethod
-    def db_dict_factory(cls, record_id="default_id", table_name=None):
+    def db_dict_factory(
+        cls,
+        record_id="default_id",
+        table_name: Type[AIState] = AIStateDefault,
+        serializer: Optional[StateSerializer] = None,
+    ):
+        # Чекпоинты графа хранит DjangoCheckpointSaver, здесь только произвольные словари (todo_list и т.п.)
         def create_db_dict(default_factory=None):
-            if table_name:
-                model_name=table_name
-            elif default_factory is None:
-                model_name = AIStateBlobs
-            elif default_factory is dict:
-                model_name = AIStateWrites
-            elif callable(default_factory) and default_factory() == defaultdict(dict):
-                model_name = AIStateStorage
-            else:
-                model_name = AIStateDefault
-            instance = cls(default_factory=default_factory, model_name=model_name, record_id=record_id)
+            model_name = table_name
+            instance = cls(
+                default_factory=default_factory,
+                model_name=model_name,
+                record_id=record_id,
+                serializer=serializer,
+            )
             return instance
 
         return create_db_dict
 
-    def __init__(self, default_factory, model_name: Type[AIState], record_id):
-        super().__init__(default_factory)
+    def __init__(self, default_factory, model_name: Type[AIState], record_id, serializer: Optional[StateSerializer] = None):
+        super().__init__(default_factory, serializer=serializer)
         self.model_name = model_name
         self.record_id = record_id
 
@@ -117,45 +236,28 @@ class DjangoDBDict(defaultdict):
         except Exception as e:
             logger.error(f"Error: {e}")
 
-    #Для случаев автоматической синхронизации при каждом обновлении словаря
-    # def __setitem__(self, key, value):
-    #     super().__setitem__(key, value)
-    #     self.sync_data()
-    #
-    # def update(self, *args, **kwargs):
-    #     super().update(*args, **kwargs)
-    #     self.sync_data()
+    def _name(self) -> str:
+        return self.model_name.__name__
 
     def load_from_db(self):
         try:
-            self.model_orm, _ = self.model_name.objects.get_or_create(id=self.record_id)
-            if self.model_orm.data:
-                data = pickle.loads(self.model_orm.data)
-                super().update(data)
+            rows = self.model_name.objects.filter(record_id=self.record_id).values_list("key", "data")
+            for key_data, data in rows.iterator():
+                self._load_row(bytes(key_data), bytes(data))
         except Exception as e:
             logger.error(f"load_from_db error in {self.model_name}, {e}")
         logger.info(f"Loaded {self.model_name} from {self.record_id}")
 
-    def sync_data(self):
-        try:
-            logger.info(f"Syncing {self.model_name} from {self.record_id}")
-            data = pickle.dumps(dict(self))
-            if data != self.model_orm.data:
-                self.model_orm.data = data
-                self.model_orm.save()
-        except Exception as e:
-            logger.error(f"Sync error in {self.model_name}: {e}")
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        # print(f"Результат: {self.__class__.__name__}: {self}")
-        self.sync_data()
-
-    def __del__(self):
-        try:
-            # print(f"Результат: {self.__class__.__name__}: {self}")
-            self.sync_data()
-        except AttributeError as e:
-            logger.error(f"Error: {e}")
\ No newline at end of file
+    def _write_rows(self, changed, deleted):
+        if changed:
+            self.model_name.objects.bulk_create(
+                [
+                    self.model_name(record_id=self.record_id, key_hash=key_hash, key=key_data, data=data)
+                    for key_hash, key_data, data, _ in changed
+                ],
+                update_conflicts=True,
+                unique_fields=["record_id", "key_hash"],
+                update_fields=["data"],
+            )
+        if deleted:
+            self.model_name.objects.filter(record_id=self.record_id, key_hash__in=deleted).delete()
@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import logging
+import random
+from collections import defaultdict
+from collections.abc import AsyncIterator, Iterator, Sequence
+from datetime import timedelta
+from functools import partial
+from typing import Any, Optional
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    SerializerProtocol,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+from ai_integration.helpers.state_serializer import CompressedSerializer
+from ai_integration.models import AIStateStorage, AIStateWrites, AIStateBlobs
+
+logger = logging.getLogger(__name__)
+
+
+class DjangoCheckpointSaver(BaseCheckpointSaver[str]):
+    """
+    Checkpointer LangGraph поверх моделей Django.
+    Чекпоинты, версии каналов и pending writes хранятся отдельными строками,
+    при чтении загружается только запрошенный (или последний) чекпоинт.
+    По умолчанию значения сжимаются (CompressedSerializer), несжатые строки читаются как раньше.
+
+    Каналы-списки (messages) пишутся дельтами относительно предыдущей версии, записанной этим же
+    экземпляром: сколько элементов отброшено с начала и какие добавлены в конец. Элементы сравниваются
+    по идентичности объектов (add_messages сохраняет объекты неизменённых сообщений), поэтому
+    объём записи на шаг пропорционален новым сообщениям. Через MAX_DELTA_CHAIN дельт пишется полный снимок.
+    """
+    MAX_DELTA_CHAIN = 20
+
+    def __init__(self, *, serde: Optional[SerializerProtocol] = None) -> None:
+        super().__init__(serde=serde or CompressedSerializer())
+        # (thread_id, checkpoint_ns, channel) -> (версия, значение, версия снимка, длина цепочки дельт)
+        self._last_values: dict[tuple[str, str, str], tuple[str, Any, str, int]] = {}
+
+    @staticmethod
+    def _thread_config(thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> RunnableConfig:
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }
+        }
+
+    @staticmethod
+    def _apply_delta(value: list, delta: dict) -> list:
+        return value[delta["drop"]:] + list(delta["append"])
+
+    def _resolve_blob(self, row: AIStateBlobs) -> Any:
+        """Восстанавливает значение, записанное дельтой, по цепочке до полного снимка"""
+        chain = {
+            version: (type_, bytes(data), base_version)
+            for version, type_, data, base_version in AIStateBlobs.objects.filter(
+                thread_id=row.thread_id,
+                checkpoint_ns=row.checkpoint_ns,
+                channel=row.channel,
+                version__gte=row.snapshot_version,
+                version__lte=row.version,
+            ).values_list("version", "type", "data", "base_version")
+        }
+        deltas = []
+        version = row.version
+        while True:
+            if version not in chain:
+                raise ValueError(f"Broken delta chain for {row.thread_id}/{row.channel}: missing version {version}")
+            type_, data, base_version = chain[version]
+            if base_version is None:
+                value = self.serde.loads_typed((type_, data))
+                break
+            deltas.append(self.serde.loads_typed((type_, data)))
+            version = base_version
+        for delta in reversed(deltas):
+            value = self._apply_delta(value, delta)
+        return value
+
+    def _load_blobs(
+        self, thread_id: str, checkpoint_ns: str, versions: ChannelVersions, remember: bool = False
+    ) -> dict[str, Any]:
+        if not versions:
+            return {}
+        wanted = {(channel, str(version)) for channel, version in versions.items()}
+        rows = AIStateBlobs.objects.filter(
+            thread_id=thread_id,
+            checkpoint_ns=checkpoint_ns,
+            channel__in=list(versions.keys()),
+            version__in=[str(version) for version in versions.values()],
+        )
+        channel_values: dict[str, Any] = {}
+        for row in rows:
+            if (row.channel, row.version) not in wanted or row.type == "empty":
+                continue
+            if row.base_version is None:
+                value = self.serde.loads_typed((row.type, bytes(row.data)))
+                snapshot_version, depth = row.version, 0
+            else:
+                value = self._resolve_blob(row)
+                # Длина цепочки точно не известна, считаем её максимальной - следующая запись будет снимком
+                snapshot_version, depth = row.snapshot_version, self.MAX_DELTA_CHAIN
+            channel_values[row.channel] = value
+            if remember:
+                self._last_values[(thread_id, checkpoint_ns, row.channel)] = (row.version, value, snapshot_version, depth)
+        return channel_values
+
+    def _list_delta(self, previous: Optional[tuple[str, Any, str, int]], value: Any) -> Optional[tuple[int, list]]:
+        """
+        :return: (сколько элементов отбросить с начала предыдущего значения, что добавить в конец)
+        или None, если выгоднее записать полный снимок
+        """
+        if previous is None or previous[3] >= self.MAX_DELTA_CHAIN:
+            return None
+        old = previous[1]
+        if not isinstance(value, list) or not isinstance(old, list) or not old or not value:
+            return None
+        drop = next((i for i, item in enumerate(old) if item is value[0]), None)
+        if drop is None:
+            return None
+        kept = len(old) - drop
+        if kept > len(value) or any(a is not b for a, b in zip(old[drop:], value[:kept])):
+            return None
+        append = value[kept:]
+        if len(append) * 2 > len(value):
+            return None
+        return drop, append
+
+    def _make_blob(
+        self, thread_id: str, checkpoint_ns: str, channel: str, version: str, values: dict[str, Any]
+    ) -> tuple[AIStateBlobs, Optional[tuple[str, Any, str, int]]]:
+        """
+        :return: строка blob и новая запись _last_values канала (None - убрать из кэша). Запись применяется
+        только после коммита put: иначе следующая дельта сошлётся на base_version, которой нет в базе
+        """
+        key = (thread_id, checkpoint_ns, channel)
+        blob = AIStateBlobs(thread_id=thread_id, checkpoint_ns=checkpoint_ns, channel=channel, version=version)
+        if channel not in values:
+            blob.type, blob.data = "empty", b""
+            return blob, None
+
+        value = values[channel]
+        previous = self._last_values.get(key)
+        delta = self._list_delta(previous, value)
+        if delta is None:
+            blob.type, blob.data = self.serde.dumps_typed(value)
+            return blob, (version, value, version, 0)
+        drop, append = delta
+        previous_version, _, snapshot_version, depth = previous
+        blob.type, blob.data = self.serde.dumps_typed({"drop": drop, "append": append})
+        blob.base_version = previous_version
+        blob.snapshot_version = snapshot_version
+        return blob, (version, value, snapshot_version, depth + 1)
+
+    def _remember(self, last_values: dict[tuple[str, str, str], Optional[tuple[str, Any, str, int]]]) -> None:
+        for key, last_value in last_values.items():
+            if last_value is None:
+                self._last_values.pop(key, None)
+            else:
+                self._last_values[key] = last_value
+
+    def _load_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list[tuple[str, str, Any]]:
+        rows = AIStateWrites.objects.filter(
+            thread_id=thread_id,
+            checkpoint_ns=checkpoint_ns,
+            checkpoint_id=checkpoint_id,
+        ).order_by("task_id", "idx").values_list("task_id", "channel", "type", "data")
+        return [
+            (task_id, channel, self.serde.loads_typed((type_, bytes(data))))
+            for task_id, channel, type_, data in rows
+        ]
+
+    def _make_tuple(
+        self, row: AIStateStorage, metadata: Optional[CheckpointMetadata] = None, remember: bool = False
+    ) -> CheckpointTuple:
+        checkpoint: Checkpoint = self.serde.loads_typed((row.type, bytes(row.checkpoint)))
+        if metadata is None:
+            metadata = self.serde.loads_typed((row.metadata_type, bytes(row.metadata)))
+        return CheckpointTuple(
+            config=self._thread_config(row.thread_id, row.checkpoint_ns, row.checkpoint_id),
+            checkpoint={
+                **checkpoint,
+                "channel_values": self._load_blobs(
+                    row.thread_id, row.checkpoint_ns, checkpoint["channel_versions"], remember=remember
+                ),
+            },
+            metadata=metadata,
+            parent_config=(
+                self._thread_config(row.thread_id, row.checkpoint_ns, row.parent_checkpoint_id)
+                if row.parent_checkpoint_id
+                else None
+            ),
+            pending_writes=self._load_writes(row.thread_id, row.checkpoint_ns, row.checkpoint_id),
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id: str = config["configurable"]["thread_id"]
+        checkpoint_ns: str = config["configurable"].get("checkpoint_ns", "")
+        queryset = AIStateStorage.objects.filter(thread_id=thread_id, checkpoint_ns=checkpoint_ns)
+        if checkpoint_id := get_checkpoint_id(config):
+            queryset = queryset.filter(checkpoint_id=checkpoint_id)
+        row = queryset.order_by("-checkpoint_id").first()
+        if row is None:
+            return None
+        # Последний чекпоинт - база для дельт следующих записей
+        return self._make_tuple(row, remember=not checkpoint_id)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        queryset = AIStateStorage.objects.all()
+        if config:
+            queryset = queryset.filter(thread_id=config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                queryset = queryset.filter(checkpoint_ns=checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                queryset = queryset.filter(checkpoint_id=checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            queryset = queryset.filter(checkpoint_id__lt=before_checkpoint_id)
+        queryset = queryset.order_by("thread_id", "checkpoint_ns", "-checkpoint_id")
+        if not filter and limit is not None:
+            queryset = queryset[:limit]
+
+        for row in queryset.iterator():
+            metadata = self.serde.loads_typed((row.metadata_type, bytes(row.metadata)))
+            if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            yield self._make_tuple(row, metadata=metadata)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        c = checkpoint.copy()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        values: dict[str, Any] = c.pop("channel_values")  # type: ignore[misc]
+        blobs, last_values = [], {}
+        for channel, version in new_versions.items():
+            blob, last_values[(thread_id, checkpoint_ns, channel)] = self._make_blob(
+                thread_id, checkpoint_ns, channel, str(version), values
+            )
+            blobs.append(blob)
+        type_, data = self.serde.dumps_typed(c)
+        metadata_type, metadata_data = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with transaction.atomic():
+            if blobs:
+                AIStateBlobs.objects.bulk_create(blobs, ignore_conflicts=True)
+            AIStateStorage.objects.update_or_create(
+                thread_id=thread_id,
+                checkpoint_ns=checkpoint_ns,
+                checkpoint_id=checkpoint["id"],
+                defaults={
+                    "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
+                    "type": type_,
+                    "checkpoint": data,
+                    "metadata_type": metadata_type,
+                    "metadata": metadata_data,
+                },
+            )
+            # База для следующих дельт - только записанные версии: при откате кэш остаётся прежним
+            transaction.on_commit(partial(self._remember, last_values))
+        return self._thread_config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # Обычные записи не перезаписываются (повторный запуск задачи), специальные (idx < 0) - заменяются
+        regular, special = [], []
+        for idx, (channel, value) in enumerate(writes):
+            write_idx = WRITES_IDX_MAP.get(channel, idx)
+            type_, data = self.serde.dumps_typed(value)
+            row = AIStateWrites(
+                thread_id=thread_id,
+                checkpoint_ns=checkpoint_ns,
+                checkpoint_id=checkpoint_id,
+                task_id=task_id,
+                idx=write_idx,
+                channel=channel,
+                type=type_,
+                data=data,
+                task_path=task_path,
+            )
+            (regular if write_idx >= 0 else special).append(row)
+        with transaction.atomic():
+            if regular:
+                AIStateWrites.objects.bulk_create(regular, ignore_conflicts=True)
+            if special:
+                AIStateWrites.objects.bulk_create(
+                    special,
+                    update_conflicts=True,
+                    unique_fields=["thread_id", "checkpoint_ns", "checkpoint_id", "task_id", "idx"],
+                    update_fields=["channel", "type", "data", "task_path"],
+                )
+
+    def delete_thread(self, thread_id: str) -> None:
+        with transaction.atomic():
+            AIStateStorage.objects.filter(thread_id=thread_id).delete()
+            AIStateWrites.objects.filter(thread_id=thread_id).delete()
+            AIStateBlobs.objects.filter(thread_id=thread_id).delete()
+        for key in [key for key in self._last_values if key[0] == thread_id]:
+            del self._last_values[key]
+
+    @staticmethod
+    def threads_to_prune(keep_last: int, keep_days: int, limit: int) -> list[tuple[str, str]]:
+        """
+        Треды (thread_id, checkpoint_ns), в которых есть чекпоинты вне политики хранения,
+        начиная с тех, где лежат самые старые чекпоинты.
+        """
+        cutoff = timezone.now() - timedelta(days=keep_days)
+        rows = (
+            AIStateStorage.objects.values("thread_id", "checkpoint_ns")
+            .annotate(total=Count("id"), oldest=Min("created_at"))
+            .filter(total__gt=keep_last, oldest__lt=cutoff)
+            .order_by("oldest")
+            .values_list("thread_id", "checkpoint_ns")[:limit]
+        )
+        return list(rows)
+
+    def _materialize_deltas(self, blobs, live: set[str]) -> None:
+        """Живые дельты, цепочка которых проходит через удаляемые версии, переписываются полными снимками"""
+        deltas = list(blobs.filter(version__in=live, base_version__isnull=False))
+        if not deltas:
+            return
+        bases = dict(blobs.filter(base_version__isnull=False).values_list("version", "base_version"))
+        for row in deltas:
+            version = row.base_version
+            while version in live and version in bases:
+                version = bases[version]
+            if version in live:
+                continue
+            row.type, row.data = self.serde.dumps_typed(self._resolve_blob(row))
+            row.base_version = row.snapshot_version = None
+            row.save(update_fields=["type", "data", "base_version", "snapshot_version"])
+
+    def prune(self, thread_id: str, checkpoint_ns: str = "", keep_last: int = 20, keep_days: int = 7) -> dict[str, int]:
+        """
+        Удаляет чекпоинты треда, которые одновременно старше keep_days дней и не входят в keep_last последних,
+        их pending writes, а также версии каналов, на которые больше не ссылается ни один чекпоинт.
+
+        :return: количество удалённых строк по таблицам
+        """
+        keep_last = max(keep_last, 1)
+        cutoff = timezone.now() - timedelta(days=keep_days)
+        checkpoints = AIStateStorage.objects.filter(thread_id=thread_id, checkpoint_ns=checkpoint_ns)
+        last_ids = list(checkpoints.order_by("-checkpoint_id").values_list("checkpoint_id", flat=True)[:keep_last])
+        dead_ids = list(
+            checkpoints.filter(created_at__lt=cutoff)
+            .exclude(checkpoint_id__in=last_ids)
+            .values_list("checkpoint_id", flat=True)
+        )
+
+        # Версии каналов, на которые ссылаются оставшиеся чекпоинты
+        live_versions: dict[str, set[str]] = defaultdict(set)
+        kept = checkpoints.exclude(checkpoint_id__in=dead_ids).values_list("type", "checkpoint")
+        for type_, data in kept.iterator():
+            checkpoint = self.serde.loads_typed((type_, bytes(data)))
+            for channel, version in checkpoint["channel_versions"].items():
+                live_versions[channel].add(str(version))
+
+        deleted = {"checkpoints": 0, "writes": 0, "blobs": 0}
+        with transaction.atomic():
+            for start in range(0, len(dead_ids), 500):
+                chunk = dead_ids[start:start + 500]
+                deleted["writes"] += AIStateWrites.objects.filter(
+                    thread_id=thread_id, checkpoint_ns=checkpoint_ns, checkpoint_id__in=chunk
+                ).delete()[0]
+                deleted["checkpoints"] += checkpoints.filter(checkpoint_id__in=chunk).delete()[0]
+
+            # Версии растут монотонно, поэтому удаляем только версии ниже последней живой:
+            # новые версии, записанные параллельно работающим агентом, не трогаем
+            blobs = AIStateBlobs.objects.filter(thread_id=thread_id, checkpoint_ns=checkpoint_ns)
+            for channel, versions in live_versions.items():
+                self._materialize_deltas(blobs.filter(channel=channel), versions)
+                deleted["blobs"] += (
+                    blobs.filter(channel=channel, version__lt=max(versions))
+                    .exclude(version__in=versions)
+                    .delete()[0]
+                )
+        logger.info(f"prune {thread_id}/{checkpoint_ns}: {deleted}")
+        return deleted
+
+    # Асинхронные методы для ainvoke/astream: ORM Django синхронный, запросы выполняются
+    # в общем потоке sync_to_async, event loop на время запроса не блокируется
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await sync_to_async(self.get_tuple)(config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await sync_to_async(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )()
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await sync_to_async(self.put)(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await sync_to_async(self.put_writes)(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await sync_to_async(self.delete_thread)(thread_id)
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # Тот же формат версий, что и у InMemorySaver, чтобы сохранённые ранее треды продолжали работать
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        next_v = current_v + 1
+        next_h = random.random()
+        return f"{next_v:032}.{next_h:016}"
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Optional, Sequence, Union
+
+from django.conf import settings
+from redis import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseBusy(Exception):
+    """Ресурс (репозиторий, чат) занят другой задачей агента"""
+
+
+class LocalLeaseBackend:
+    """Аренды в памяти процесса: для тестов и запуска с одним воркером без Redis"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # ключ -> (token владельца, время истечения)
+        self.leases: dict[str, tuple[str, float]] = {}
+
+    def acquire(self, key: str, token: str, ttl: float) -> bool:
+        with self.lock:
+            now = self.clock()
+            owner = self.leases.get(key)
+            if owner is not None and owner[0] != token and owner[1] > now:
+                return False
+            self.leases[key] = (token, now + ttl)
+            return True
+
+    def renew(self, key: str, token: str, ttl: float) -> bool:
+        with self.lock:
+            owner = self.leases.get(key)
+            if owner is None or owner[0] != token:
+                return False
+            self.leases[key] = (token, self.clock() + ttl)
+            return True
+
+    def release(self, key: str, token: str) -> bool:
+        with self.lock:
+            owner = self.leases.get(key)
+            if owner is None or owner[0] != token:
+                return False
+            del self.leases[key]
+            return True
+
+
+class RedisLeaseBackend:
+    """
+    Аренды в Redis, общие для всех воркеров: SET NX PX с token владельца.
+    Продление и освобождение - Lua скриптами с проверкой token, чужую (перехваченную после истечения) аренду они не трогают.
+    """
+    # KEYS[1] - ключ, ARGV[1] - token, ARGV[2] - ttl (мс)
+    RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+    # KEYS[1] - ключ, ARGV[1] - token
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, client, prefix: str = "lease"):
+        self.client = client
+        self.prefix = prefix
+        self._renew = client.register_script(self.RENEW_SCRIPT)
+        self._release = client.register_script(self.RELEASE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisLeaseBackend":
+        return cls(Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2), **kwargs)
+
+    def acquire(self, key: str, token: str, ttl: float) -> bool:
+        full_key = f"{self.prefix}:{key}"
+        if self.client.set(full_key, token, nx=True, px=int(ttl * 1000)):
+            return True
+        # Повторный захват своей же аренды (например, после рестарта heartbeat) просто её продлевает
+        return self.renew(key, token, ttl)
+
+    def renew(self, key: str, token: str, ttl: float) -> bool:
+        return bool(self._renew(keys=[f"{self.prefix}:{key}"], args=[token, int(ttl * 1000)]))
+
+    def release(self, key: str, token: str) -> bool:
+        return bool(self._release(keys=[f"{self.prefix}:{key}"], args=[token]))
+
+
+LeaseBackend = Union[LocalLeaseBackend, RedisLeaseBackend]
+
+
+def create_lease_backend() -> LeaseBackend:
+    """Backend аренд из настроек: LEASE_BACKEND = redis (общий для воркеров) или local"""
+    if getattr(settings, "LEASE_BACKEND", "local") == "redis":
+        return RedisLeaseBackend.from_url(settings.LEASE_REDIS_URL)
+    return LocalLeaseBackend()
+
+
+lease_backend: LeaseBackend = create_lease_backend()
+
+
+class Lease:
+    """
+    Аренда набора ключей (репозиторий, чат) с истечением: пока задача агента жива, фоновый поток
+    продлевает аренду каждые ttl/3, если воркер упал - ключи освобождаются сами через ttl.
+    Ключи захватываются в отсортированном порядке, при неудаче уже захваченные отпускаются (LeaseBusy).
+
+        with Lease(["repo:1", "chat:theme-repo"]):
+            ...
+    """
+
+    def __init__(self, keys: Sequence[str], ttl: Optional[float] = None, backend: Optional[LeaseBackend] = None):
+        self.keys = sorted(set(keys))
+        self.ttl = ttl or settings.AI_AGENT_LEASE_TTL
+        self.backend = backend or lease_backend
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def acquire(self):
+        acquired = []
+        try:
+            for key in self.keys:
+                if not self.backend.acquire(key, self.token, self.ttl):
+                    raise LeaseBusy(f"{key} is leased by another task")
+                acquired.append(key)
+        except (LeaseBusy, RedisError):
+            for key in acquired:
+                self.backend.release(key, self.token)
+            raise
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name=f"lease-{self.token[:8]}", daemon=True)
+        self._heartbeat.start()
+        logger.info(f"[Lease] acquired {self.keys}")
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            for key in self.keys:
+                try:
+                    if not self.backend.renew(key, self.token, self.ttl):
+                        logger.error(f"[Lease] {key} was lost, another task may use it")
+                except RedisError as e:
+                    logger.warning(f"[Lease] renew {key} failed: {e}")
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout=5)
+            self._heartbeat = None
+        for key in self.keys:
+            try:
+                self.backend.release(key, self.token)
+            except RedisError as e:
+                logger.warning(f"[Lease] release {key} failed, it expires in {self.ttl}s: {e}")
+        logger.info(f"[Lease] released {self.keys}")
+
+    def __enter__(self) -> "Lease":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def repository_lease_keys(repository_id: Optional[int], chat_id: str) -> list[str]:
+    """Рабочая копия ./repos/<user>/<repo> и чекпоинты чата меняются только одной задачей одновременно"""
+    return [f"repo:{repository_id}", f"chat:{chat_id}"]
+
+
+def agent_queue(repository_id: Optional[int]) -> Optional[str]:
+    """
+    Очередь Celery для задач репозитория: при AI_AGENT_QUEUE_SHARDS > 1 задачи одного репозитория всегда
+    попадают в один шард ai_agent_<n> (воркер с --concurrency 1 на шард выполняет их по очереди),
+    разные репозитории - в разные шарды параллельно. None - очередь по умолчанию.
+    """
+    shards = settings.AI_AGENT_QUEUE_SHARDS
+    if shards <= 1:
+        return None
+    return f"ai_agent_{(repository_id or 0) % shards}"
@@ -0,0 +1,141 @@
+import logging
+from collections import deque
+from typing import Callable, Sequence, Union
+
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately, _is_message_type
+
+logger = logging.getLogger(__name__)
+
+MessageTypes = Union[str, Sequence[str]]
+
+
+class MessageTrimmer:
+    """
+    Аналог trim_messages(strategy="last", include_system=True) с кэшем токенов по id сообщения.
+    Каждое сообщение считается один раз за всё время жизни треда, а окно, которое влезает в max_tokens,
+    сдвигается между вызовами: добавляются новые сообщения в конце и выталкиваются старые в начале.
+    Шаг агента стоит O(новых сообщений), а не O(всей истории) как у trim_messages.
+    token_counter должен быть аддитивным (как count_tokens_approximately).
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        token_counter: Callable[[list[BaseMessage]], int] = count_tokens_approximately,
+        start_on: MessageTypes = "human",
+        end_on: MessageTypes = ("human", "tool"),
+    ):
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+        self.start_on = start_on
+        self.end_on = end_on
+        # id сообщения -> (маркер содержимого, количество токенов)
+        self._counts: dict[str, tuple[int, int]] = {}
+        # Хвост истории (id, токены) с прошлого вызова, который влезал в бюджет
+        self._window: deque[tuple[str, int]] = deque()
+        self._window_tokens = 0
+        self._budget = None
+
+    @staticmethod
+    def _content_marker(message: BaseMessage) -> int:
+        # Сообщение с тем же id может быть заменено (add_messages), дешёвая проверка что содержимое то же
+        return len(message.content) + len(getattr(message, "tool_calls", None) or ())
+
+    def count(self, message: BaseMessage) -> int:
+        if message.id is None:
+            return self.token_counter([message])
+        marker = self._content_marker(message)
+        cached = self._counts.get(message.id)
+        if cached is None or cached[0] != marker:
+            cached = (marker, self.token_counter([message]))
+            self._counts[message.id] = cached
+        return cached[1]
+
+    def forget(self, message_ids: Sequence[str]):
+        """Убрать из кэша сообщения, удалённые из истории или заменённые (add_messages с тем же id)"""
+        forgotten = set(message_ids)
+        for message_id in forgotten:
+            self._counts.pop(message_id, None)
+        # Токены заменённого сообщения в окне устарели: окно собирается заново из кэша
+        if any(message_id in forgotten for message_id, _ in self._window):
+            self._reset_window()
+
+    def _last_seen_index(self, messages: Sequence[BaseMessage], first: int):
+        if not self._window or self._window[-1][0] is None:
+            return None
+        last_id = self._window[-1][0]
+        for i in range(len(messages) - 1, first - 1, -1):
+            if messages[i].id == last_id:
+                return i
+        return None
+
+    def _reset_window(self):
+        self._window.clear()
+        self._window_tokens = 0
+
+    def _window_start(self, messages: Sequence[BaseMessage], first: int, budget: int) -> int:
+        """
+        Сдвигает окно до конца messages и возвращает индекс начала самого длинного хвоста messages[first:],
+        который влезает в budget
+        """
+        pos = self._last_seen_index(messages, first) if budget == self._budget else None
+        if pos is None:
+            self._reset_window()
+            pos = first - 1
+        else:
+            # Начало истории могло быть удалено из state (RemoveMessage), выравниваем окно по концу
+            while len(self._window) > pos - first + 1:
+                self._window_tokens -= self._window.popleft()[1]
+            if self._window and messages[pos - len(self._window) + 1].id != self._window[0][0]:
+                self._reset_window()
+                pos = first - 1
+
+        for message in messages[pos + 1:]:
+            tokens = self.count(message)
+            self._window.append((message.id, tokens))
+            self._window_tokens += tokens
+        while self._window and self._window_tokens > budget:
+            self._window_tokens -= self._window.popleft()[1]
+        self._budget = budget
+        return len(messages) - len(self._window)
+
+    def trim(self, messages: Sequence[BaseMessage]) -> list[BaseMessage]:
+        """
+        :return: system message (если первое) + самый длинный хвост истории, который влезает в max_tokens,
+        начинается с start_on и заканчивается на end_on
+        """
+        end = len(messages)
+        while end > 0 and not _is_message_type(messages[end - 1], self.end_on):
+            end -= 1
+        if end == 0:
+            return []
+
+        system_message = None
+        first = 0
+        if isinstance(messages[0], SystemMessage):
+            system_message = messages[0]
+            first = 1
+
+        budget = self.max_tokens
+        if system_message is not None:
+            budget = max(0, budget - self.count(system_message))
+
+        start = self._window_start(messages, first, budget)
+        # Сообщения после end в модель не уходят, освободившееся место занимаем более старыми сообщениями
+        total = self._window_tokens - sum(self.count(message) for message in messages[max(start, end):])
+        start = min(start, end)
+        while start > first:
+            tokens = self.count(messages[start - 1])
+            if total + tokens > budget:
+                break
+            total += tokens
+            start -= 1
+
+        while start < end and not _is_message_type(messages[start], self.start_on):
+            start += 1
+
+        result = list(messages[start:end])
+        if system_message is not None:
+            result.insert(0, system_message)
+        return result
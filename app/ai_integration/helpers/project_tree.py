@@ -0,0 +1,152 @@
+import logging
+import os
+import subprocess
+import threading
+from typing import Iterable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Не показываются никогда, даже если их нет в .gitignore
+EXCLUDE = frozenset({".git", ".venv"})
+
+
+class TreeEntry(NamedTuple):
+    name: str
+    is_dir: bool
+
+
+class ProjectTreeIndex:
+    """
+    Кэш дерева рабочей копии для get_project_structure.
+    Содержимое каждой директории читается через os.scandir и хранится вместе с её mtime: при следующем
+    вызове директория перечитывается, только если в ней добавили, удалили или переименовали запись,
+    остальные стоят одного stat. Игнорируемые пути берутся у git (все .gitignore, .git/info/exclude)
+    и пересчитываются после изменения какой-либо директории или файла правил: правка .gitignore на месте
+    не меняет mtime директории, поэтому mtime и размер самих .gitignore и .git/info/exclude входят в ключ кэша.
+    Вне git репозитория работают только EXCLUDE.
+    """
+
+    def __init__(self, repo_path: str, max_dir_entries: int = 100, max_lines: int = 500):
+        """
+        :param max_dir_entries: сколько записей одной директории показывать, остальные - строкой "… ещё N"
+        :param max_lines: предел строк всего дерева
+        """
+        self.repo_path = os.path.abspath(repo_path)
+        self.max_dir_entries = max_dir_entries
+        self.max_lines = max_lines
+        # Относительный путь директории ("" - корень) -> (st_mtime_ns, записи)
+        self._listings: dict[str, tuple[int, list[TreeEntry]]] = {}
+        self._ignored: frozenset[str] = frozenset()
+        # (путь, st_mtime_ns, st_size) файлов правил при последней проверке; проверяются раз за render
+        self._rules_stat: tuple = ()
+        self._rules_checked = False
+        # Список игнорируемых нужно пересчитать (изменилась директория); за один render - не больше одного раза
+        self._ignored_stale = True
+        self._ignored_refreshed = False
+        # Параллельные read-only вызовы (OrderedToolNode) обновляют кэш по очереди
+        self._lock = threading.Lock()
+
+    def _rules_files_stat(self) -> tuple:
+        """mtime и размер .git/info/exclude и .gitignore всех уже прочитанных директорий; отсутствующий файл - None"""
+        paths = [os.path.join(".git", "info", "exclude")]
+        paths.extend(
+            os.path.join(relative_path, ".gitignore")
+            for relative_path, (_, entries) in sorted(self._listings.items())
+            if TreeEntry(".gitignore", False) in entries
+        )
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(os.path.join(self.repo_path, path))
+                stats.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append((path, None))
+        return tuple(stats)
+
+    def _ignored_paths(self) -> frozenset[str]:
+        """Игнорируемые git пути относительно корня; игнорируемая директория приходит одной записью (--directory)"""
+        if not self._rules_checked:
+            self._rules_checked = True
+            rules_stat = self._rules_files_stat()
+            if rules_stat != self._rules_stat:
+                self._rules_stat = rules_stat
+                self._ignored_stale = True
+        if self._ignored_stale and not self._ignored_refreshed:
+            self._ignored_stale = False
+            self._ignored_refreshed = True
+            try:
+                output = subprocess.run(
+                    ["git", "ls-files", "--others", "--ignored", "--exclude-standard", "--directory", "-z"],
+                    cwd=self.repo_path,
+                    capture_output=True,
+                    check=True,
+                    timeout=30,
+                ).stdout
+                self._ignored = frozenset(path.rstrip("/") for path in output.decode("utf-8", "replace").split("\0") if path)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"git ls-files failed in {self.repo_path}, .gitignore is not applied: {e}")
+                self._ignored = frozenset()
+        return self._ignored
+
+    def _listing(self, relative_path: str) -> list[TreeEntry]:
+        path = os.path.join(self.repo_path, relative_path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._listings.get(relative_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with os.scandir(path) as it:
+            # is_dir без перехода по ссылкам: ссылка на родительскую директорию не зацикливает обход
+            entries = sorted(
+                (TreeEntry(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it if entry.name not in EXCLUDE),
+                key=lambda entry: entry.name,
+            )
+        self._listings[relative_path] = (mtime, entries)
+        # Новые файлы могут попадать под .gitignore, как и изменённый сам .gitignore. Если список уже
+        # пересчитан в этом render, он видел текущие файлы
+        if not self._ignored_refreshed:
+            self._ignored_stale = True
+        return entries
+
+    def _visible(self, relative_path: str, entries: Iterable[TreeEntry]) -> list[TreeEntry]:
+        ignored = self._ignored_paths()
+        if not ignored:
+            return list(entries)
+        return [entry for entry in entries if os.path.join(relative_path, entry.name).replace(os.sep, "/") not in ignored]
+
+    def render(self, root_path: str = ".", max_depth: int = 3) -> str:
+        """Текстовое дерево от root_path (относительно корня репозитория) до глубины max_depth"""
+        root = os.path.normpath(root_path)
+        root = "" if root == "." else root
+        lines: list[str] = []
+        hidden = 0
+
+        def walk(relative_path: str, prefix: str, depth: int):
+            nonlocal hidden
+            if depth > max_depth:
+                return
+            try:
+                entries = self._visible(relative_path, self._listing(relative_path))
+            except OSError as e:
+                logger.error(f"Ошибка при обходе директории '{relative_path}': {e}")
+                lines.append(f"{prefix}└── [Ошибка доступа: {e}]")
+                return
+            shown = entries[:self.max_dir_entries]
+            rest = len(entries) - len(shown)
+            for i, entry in enumerate(shown):
+                if len(lines) >= self.max_lines:
+                    hidden += len(shown) - i + rest
+                    return
+                last = i == len(shown) - 1 and not rest
+                lines.append(f"{prefix}{'└── ' if last else '├── '}{entry.name}")
+                if entry.is_dir:
+                    walk(os.path.join(relative_path, entry.name), prefix + ("    " if last else "│   "), depth + 1)
+            if rest:
+                lines.append(f"{prefix}└── … ещё {rest} записей")
+
+        with self._lock:
+            self._ignored_refreshed = False
+            self._rules_checked = False
+            walk(root, "", 0)
+        if hidden:
+            lines.append(f"… ещё {hidden} записей не показано, уменьшите max_depth или укажите root_path")
+        return "\n".join(lines) + "\n" if lines else ""
@@ -1,8 +1,24 @@
+import asyncio
+import hashlib
 import logging
+import re
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
 from functools import wraps
-from typing import ParamSpec, TypeVar, Callable
+from typing import ParamSpec, TypeVar, Callable, Awaitable, Iterator, Optional, Union, NamedTuple, Any
+
+from django.conf import settings
+from redis import Redis
+from redis.exceptions import RedisError
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.tools import BaseTool, tool
 
 logger = logging.getLogger(__name__)
 
@@ -11,59 +27,610 @@ P = ParamSpec("P")
 R = TypeVar("R")
 
 
-class RateLimiter:
-    def __init__(self, max_calls_per_minute: int):
-        self.max_calls_per_minute = max_calls_per_minute
-        self.min_interval = 60 / max_calls_per_minute
+class ToolCategory(str, Enum):
+    # Файлы и AST в локальной копии репозитория - без лимита
+    LOCAL = "local"
+    # Локальный git и push в remote
+    GIT = "git"
+    # Вызовы GitHub API (pull request, review, merge)
+    GITHUB = "github"
+
+
+class CallWindow:
+    """Скользящее окно вызовов за window секунд (deque, старые вызовы выталкиваются слева)"""
+
+    def __init__(self, window: float = 60):
+        self.window = window
+        self.calls: deque[float] = deque()
+
+    def add(self, now: float) -> int:
+        """Добавляет вызов и возвращает количество вызовов в окне"""
+        self.calls.append(now)
+        return self.count(now)
+
+    def count(self, now: float) -> int:
+        while self.calls and self.calls[0] <= now - self.window:
+            self.calls.popleft()
+        return len(self.calls)
+
+
+class TokenBucket:
+    """
+    Token bucket: токены пополняются со скоростью rate_per_minute, но не больше capacity (допустимый всплеск).
+    reserve() забирает токен сразу, даже если его ещё нет (баланс уходит в минус), и возвращает,
+    сколько ждать. Поэтому очередь вызывающих выстраивается под коротким lock, а ждут они уже без него.
+    rate_per_minute=None - без лимита.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: Optional[float],
+        capacity: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.clock = clock
         self.lock = threading.Lock()
-        self.last_call = 0.0
-        self.call_times = []  # лог вызовов
-
-    def update_rate_limit(self, new_limit: int):
-        self.max_calls_per_minute = new_limit
-        self.min_interval = 60 / new_limit
-        logger.info(
-            f"update_rate_limit: {new_limit}, new min interval: {self.min_interval}"
-        )
+        self.window = CallWindow()
+        self.capacity = capacity
+        self.rate_per_minute = rate_per_minute
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def update_rate(self, rate_per_minute: Optional[float], capacity: Optional[float] = None):
+        with self.lock:
+            self._refill(self.clock())
+            self.rate_per_minute = rate_per_minute
+            if capacity is not None:
+                self.capacity = capacity
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self, now: float):
+        if self.rate_per_minute:
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate_per_minute / 60)
+        self.updated_at = now
 
-    def wait(self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> Callable[P, R]:
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """
+        Забирает токен и возвращает, сколько секунд ждать до его появления.
+        Если ждать пришлось бы дольше max_wait, токен не забирается (результат > max_wait)
+        """
         with self.lock:
-            start_exec_time = time.time()
-            wait_time = self.min_interval - (start_exec_time - self.last_call)
-            if self.last_call and wait_time > 0:
-                logger.info(f"wait befor call for: {wait_time} seconds")
-                time.sleep(wait_time)
-
-            self._log_call(time.time())
-            self.last_call = time.time()
-            result = func(*args, **kwargs)
-            return result
-
-    def _log_call(self, now):
-        readable = time.strftime("%H:%M:%S", time.localtime(now))
-        logger.info(f"[RateLimiter] Tool called at {readable}")
-
-        # Добавляем новый вызов
-        self.call_times.append(now)
-
-        # Очистим старые вызовы (старше 60 сек) — если нужно контролировать окно
-        one_minute_ago = now - 60
-        self.call_times = [t for t in self.call_times if t >= one_minute_ago]
-
-        # Проверка: если вдруг вызовов стало больше чем разрешено
-        if len(self.call_times) > self.max_calls_per_minute:
-            logger.info(
-                f"[RateLimiter][WARNING] Exceeded rate: {len(self.call_times)} calls in the last minute"
+            now = self.clock()
+            if self.rate_per_minute is None:
+                self.window.add(now)
+                return 0.0
+            self._refill(now)
+            wait_time = 0.0 if self.tokens >= 1 else (1 - self.tokens) * 60 / self.rate_per_minute
+            if max_wait is not None and wait_time > max_wait:
+                return wait_time
+            self.tokens -= 1
+            calls = self.window.add(now)
+        if calls > self.rate_per_minute + self.capacity:
+            logger.info(f"[RateLimiter][WARNING] {calls} calls in the last minute, limit {self.rate_per_minute}")
+        return wait_time
+
+    def block(self, seconds: float):
+        """Следующий токен появится не раньше, чем через seconds (Retry-After от API)"""
+        with self.lock:
+            if not self.rate_per_minute:
+                return
+            self._refill(self.clock())
+            self.tokens = min(self.tokens, 1 - seconds * self.rate_per_minute / 60)
+
+    def calls_in_window(self) -> int:
+        with self.lock:
+            return self.window.count(self.clock())
+
+
+@dataclass(frozen=True)
+class AIMDPolicy:
+    """
+    Подстройка лимита по ответам API (AIMD, как в TCP): каждый успешный вызов поднимает лимит
+    на increase / rate (при полной загрузке примерно +increase в минуту), ответ 429 умножает его на decrease.
+    Выученный лимит хранится в backend и переживает задачу (в Redis - и перезапуск воркеров).
+    """
+    min_rate: float
+    max_rate: float
+    increase: float = 1.0
+    decrease: float = 0.5
+
+    @classmethod
+    def around(cls, rate: float, spread: float = 4) -> "AIMDPolicy":
+        """Лимит может уйти от начального rate в spread раз в обе стороны"""
+        return cls(min_rate=max(1.0, rate / spread), max_rate=rate * spread)
+
+    def next_rate(self, rate: float, throttled: bool, ceiling: Optional[float] = None) -> float:
+        rate = rate * self.decrease if throttled else rate + self.increase / rate
+        if ceiling is not None:
+            rate = min(rate, ceiling)
+        return max(self.min_rate, min(self.max_rate, rate))
+
+
+class QuotaState(NamedTuple):
+    """Остаток квоты из заголовков ответа (X-RateLimit-Remaining / X-RateLimit-Reset)"""
+    remaining: int
+    reset_in: float
+
+    @property
+    def ceiling(self) -> float:
+        """Сколько вызовов в минуту можно делать, чтобы остатка хватило до сброса квоты"""
+        return self.remaining * 60 / max(self.reset_in, 1.0)
+
+
+# "retry_delay { seconds: 17 }" в ошибке gRPC Gemini или "Please retry in 17.5s." в тексте
+RETRY_DELAY_PATTERN = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)|retry in (\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+def throttle_delay(error: BaseException) -> Optional[float]:
+    """
+    Если error - отказ по лимиту (429, или 403 с исчерпанной квотой GitHub), возвращает, сколько секунд
+    API просит подождать (Retry-After, X-RateLimit-Reset, RetryInfo Gemini; 0 - не сказано), иначе None
+    """
+    status = getattr(error, "status", None) or getattr(error, "status_code", None) or getattr(error, "code", None)
+    headers = {str(name).lower(): value for name, value in (getattr(error, "headers", None) or {}).items()}
+    quota_exhausted = headers.get("x-ratelimit-remaining") == "0" or "retry-after" in headers
+    if status != 429 and not (status == 403 and quota_exhausted):
+        return None
+    if "retry-after" in headers:
+        try:
+            return max(0.0, float(headers["retry-after"]))
+        except ValueError:
+            pass
+    if "x-ratelimit-reset" in headers:
+        try:
+            return max(0.0, float(headers["x-ratelimit-reset"]) - time.time())
+        except ValueError:
+            pass
+    match = RETRY_DELAY_PATTERN.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return 0.0
+
+
+class LocalQuotaBackend:
+    """Лимиты в памяти процесса (TokenBucket на ключ): для тестов и запуска без Redis"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets: dict[str, TokenBucket] = {}
+        # Лимиты, выученные AIMDPolicy (ключ -> вызовов в минуту)
+        self.rates: dict[str, float] = {}
+
+    def _bucket(self, key: str, rate_per_minute: float, capacity: float = 1) -> TokenBucket:
+        with self.lock:
+            rate_per_minute = self.rates.get(key, rate_per_minute)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate_per_minute, capacity=capacity, clock=self.clock)
+        if bucket.rate_per_minute != rate_per_minute or bucket.capacity != capacity:
+            bucket.update_rate(rate_per_minute, capacity=capacity)
+        return bucket
+
+    def reserve(self, key: str, rate_per_minute: float, capacity: float = 1, max_wait: Optional[float] = None) -> float:
+        return self._bucket(key, rate_per_minute, capacity).reserve(max_wait=max_wait)
+
+    def adjust(
+        self,
+        key: str,
+        rate_per_minute: float,
+        policy: AIMDPolicy,
+        throttled_for: Optional[float] = None,
+        ceiling: Optional[float] = None,
+    ) -> float:
+        """Пересчитывает лимит ключа по policy, после 429 (throttled_for) ещё и блокирует ключ на это время"""
+        with self.lock:
+            rate = self.rates[key] = policy.next_rate(
+                self.rates.get(key, rate_per_minute), throttled=throttled_for is not None, ceiling=ceiling
             )
+        bucket = self._bucket(key, rate_per_minute)
+        if throttled_for:
+            bucket.block(throttled_for)
+        return rate
+
+
+class RedisQuotaBackend:
+    """
+    Лимиты в Redis, общие для всех воркеров и процессов. Алгоритм GCRA - тот же token bucket,
+    но в Redis хранится одно число на ключ (теоретическое время следующего вызова), время берётся у Redis.
+    Если Redis недоступен, лимит временно считается в памяти процесса (fallback).
+    """
+    # KEYS[1] - ключ, KEYS[2] - hash выученных лимитов (AIMDPolicy), ARGV[1] - лимит в минуту, если выученного нет,
+    # ARGV[2] - ёмкость, ARGV[3] - max_wait (мкс, -1 - без ограничения)
+    SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local interval = 60000000 / tonumber(redis.call('HGET', KEYS[2], KEYS[1]) or ARGV[1])
+local max_wait = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval
+local wait = new_tat - now - tonumber(ARGV[2]) * interval
+if wait < 0 then wait = 0 end
+if max_wait >= 0 and wait > max_wait then return wait end
+redis.call('SET', KEYS[1], string.format('%.0f', new_tat), 'PX', math.ceil((new_tat - now) / 1000) + 1000)
+return wait
+"""
+    # KEYS как у SCRIPT, ARGV[1] - лимит в минуту, если выученного нет, ARGV[2..5] - min_rate, max_rate, increase,
+    # decrease из AIMDPolicy, ARGV[6] - на сколько мкс заблокировать ключ после 429 (-1 - вызов успешный),
+    # ARGV[7] - потолок из заголовков (-1 - нет)
+    ADJUST_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[2], KEYS[1]) or ARGV[1])
+local throttled_for = tonumber(ARGV[6])
+local ceiling = tonumber(ARGV[7])
+if throttled_for >= 0 then
+    rate = rate * tonumber(ARGV[5])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+    local blocked_until = now + throttled_for
+    if tonumber(redis.call('GET', KEYS[1]) or 0) < blocked_until then
+        redis.call('SET', KEYS[1], string.format('%.0f', blocked_until), 'PX', math.ceil(throttled_for / 1000) + 1000)
+    end
+else
+    rate = rate + tonumber(ARGV[4]) / rate
+end
+if ceiling >= 0 and rate > ceiling then rate = ceiling end
+rate = math.max(tonumber(ARGV[2]), math.min(tonumber(ARGV[3]), rate))
+local value = string.format('%.3f', rate)
+redis.call('HSET', KEYS[2], KEYS[1], value)
+return value
+"""
+
+    # Сколько секунд после ошибки Redis лимит считается локально, без попыток подключения на каждом вызове
+    RETRY_AFTER = 30
+
+    def __init__(self, client, prefix: str = "ratelimit", fallback: Optional[LocalQuotaBackend] = None):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback or LocalQuotaBackend()
+        self._script = client.register_script(self.SCRIPT)
+        self._adjust_script = client.register_script(self.ADJUST_SCRIPT)
+        self._unavailable_until = 0.0
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisQuotaBackend":
+        return cls(Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2), **kwargs)
+
+    def _keys(self, key: str) -> list[str]:
+        return [f"{self.prefix}:{key}", f"{self.prefix}:rates"]
+
+    def _call(self, script, keys: list[str], args: list, fallback: Callable[[], Any]) -> Any:
+        if time.monotonic() < self._unavailable_until:
+            return fallback()
+        try:
+            return script(keys=keys, args=args)
+        except RedisError as e:
+            logger.warning(f"[RateLimiter] redis is unavailable, using in-process limit for {self.RETRY_AFTER}s: {e}")
+            self._unavailable_until = time.monotonic() + self.RETRY_AFTER
+            return fallback()
+
+    def reserve(self, key: str, rate_per_minute: float, capacity: float = 1, max_wait: Optional[float] = None) -> float:
+        max_wait_us = -1 if max_wait is None else max_wait * 1_000_000
+        wait = self._call(
+            self._script,
+            self._keys(key),
+            [rate_per_minute, capacity, max_wait_us],
+            lambda: self.fallback.reserve(key, rate_per_minute, capacity=capacity, max_wait=max_wait) * 1_000_000,
+        )
+        return int(wait) / 1_000_000
+
+    def adjust(
+        self,
+        key: str,
+        rate_per_minute: float,
+        policy: AIMDPolicy,
+        throttled_for: Optional[float] = None,
+        ceiling: Optional[float] = None,
+    ) -> float:
+        args = [
+            rate_per_minute, policy.min_rate, policy.max_rate, policy.increase, policy.decrease,
+            -1 if throttled_for is None else throttled_for * 1_000_000,
+            -1 if ceiling is None else ceiling,
+        ]
+        rate = self._call(
+            self._adjust_script,
+            self._keys(key),
+            args,
+            lambda: self.fallback.adjust(key, rate_per_minute, policy, throttled_for=throttled_for, ceiling=ceiling),
+        )
+        return float(rate)
+
+
+QuotaBackend = Union[LocalQuotaBackend, RedisQuotaBackend]
+
+
+def key_fingerprint(secret: Optional[str]) -> str:
+    """Короткий хэш API ключа или токена для имени лимита: сам ключ в Redis не попадает"""
+    return hashlib.sha256((secret or "").encode()).hexdigest()[:12]
 
 
-rate_limiter: RateLimiter = RateLimiter(10)
+def create_quota_backend() -> QuotaBackend:
+    """Backend лимитов из настроек: RATE_LIMIT_BACKEND = redis (общий для воркеров) или local"""
+    if getattr(settings, "RATE_LIMIT_BACKEND", "local") == "redis":
+        return RedisQuotaBackend.from_url(settings.RATE_LIMIT_REDIS_URL)
+    return LocalQuotaBackend()
 
 
-def rate_limited_tools_per_minute(func: Callable[P, R]) -> Callable[P, R]:
+quota_backend: QuotaBackend = create_quota_backend()
+
+# Чей лимит расходуют инструменты в этом контексте (отпечаток GitHub токена сессии, см. quota_scope)
+_quota_scope: ContextVar[str] = ContextVar("rate_limit_quota_scope", default="default")
+
+
+# Остаток квоты по заголовкам последнего ответа API в этом контексте (см. AIAutomation.github_quota)
+_quota_observer: ContextVar[Optional[Callable[[ToolCategory], Optional[QuotaState]]]] = ContextVar(
+    "rate_limit_quota_observer", default=None
+)
+
+
+@contextmanager
+def quota_scope(scope: str, observer: Optional[Callable[[ToolCategory], Optional[QuotaState]]] = None) -> Iterator[None]:
+    """Лимиты и наблюдатель квоты на время блока: после выхода контекст вызывающего кода остаётся прежним"""
+    scope_token = _quota_scope.set(scope)
+    observer_token = _quota_observer.set(observer)
+    try:
+        yield
+    finally:
+        _quota_observer.reset(observer_token)
+        _quota_scope.reset(scope_token)
+
+
+class RateLimiter:
+    """
+    Лимиты вызовов инструментов по категориям (ToolCategory), отдельно для каждого GitHub токена.
+    Токены хранятся в backend (Redis - общий лимит для всех воркеров, local - на процесс).
+    Резервирование атомарное и короткое: ожидание и сам вызов идут без блокировок,
+    поэтому медленный run_linter или git push не задерживает другие инструменты.
+    Для категорий из policies лимит подстраивается по ответам API (report), limits - начальное значение.
+    """
+
+    def __init__(
+        self,
+        limits: dict[ToolCategory, Optional[int]],
+        backend: Optional[QuotaBackend] = None,
+        policies: Optional[dict[ToolCategory, AIMDPolicy]] = None,
+    ):
+        self.limits = dict(limits)
+        self.backend = backend or LocalQuotaBackend()
+        self.policies = dict(policies or {})
+
+    def update_rate_limit(self, new_limit: Optional[int], category: Optional[ToolCategory] = None):
+        """Меняет лимит категории, без category - всех категорий с лимитом"""
+        for bucket_category, limit in self.limits.items():
+            if category == bucket_category or (category is None and limit is not None):
+                self.limits[bucket_category] = new_limit
+        logger.info(f"update_rate_limit: {new_limit} calls per minute for {category.value if category else 'limited categories'}")
+
+    def _is_limited(self, category: ToolCategory) -> bool:
+        return self.limits.get(category) is not None
+
+    @staticmethod
+    def _key(category: ToolCategory) -> str:
+        return f"{category.value}:{_quota_scope.get()}"
+
+    def _reserve(self, category: ToolCategory) -> float:
+        if not self._is_limited(category):
+            return 0.0
+        wait_time = self.backend.reserve(self._key(category), self.limits[category])
+        if wait_time > 0:
+            logger.info(f"wait befor {category.value} call for: {wait_time:.2f} seconds")
+        return wait_time
+
+    def is_adaptive(self, category: ToolCategory) -> bool:
+        return category in self.policies and self.limits.get(category) is not None
+
+    def report(
+        self,
+        category: ToolCategory,
+        throttled_for: Optional[float] = None,
+        quota: Optional[QuotaState] = None,
+    ):
+        """
+        Результат вызова для AIMD: throttled_for - API ответил 429 и просит подождать столько секунд,
+        quota - остаток квоты из заголовков успешного ответа (лимит не поднимается выше quota.ceiling)
+        """
+        if not self.is_adaptive(category):
+            return
+        if throttled_for is None and quota is not None and quota.remaining <= 0:
+            throttled_for = quota.reset_in
+        rate = self.backend.adjust(
+            self._key(category),
+            self.limits[category],
+            self.policies[category],
+            throttled_for=throttled_for,
+            ceiling=quota.ceiling if quota is not None else None,
+        )
+        if throttled_for is not None:
+            logger.warning(f"[RateLimiter] {category.value} is throttled for {throttled_for:.0f}s, new limit {rate:.1f} calls per minute")
+
+    def acquire(self, category: ToolCategory = ToolCategory.LOCAL):
+        wait_time = self._reserve(category)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    async def aacquire(self, category: ToolCategory = ToolCategory.LOCAL):
+        if not self._is_limited(category):
+            return
+        # Резервирование в Redis - сетевой вызов, event loop он не блокирует
+        wait_time = await asyncio.to_thread(self._reserve, category)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+rate_limiter: RateLimiter = RateLimiter(
+    limits={
+        ToolCategory.LOCAL: None,
+        ToolCategory.GIT: settings.GIT_CALLS_PER_MINUTE,
+        ToolCategory.GITHUB: settings.GITHUB_CALLS_PER_MINUTE,
+    },
+    backend=quota_backend,
+    policies={
+        ToolCategory.GITHUB: AIMDPolicy.around(settings.GITHUB_CALLS_PER_MINUTE),
+    },
+)
+
+
+class QuotaRateLimiter(BaseRateLimiter):
+    """
+    rate_limiter для chat моделей LangChain (ChatGoogleGenerativeAI(rate_limiter=...)):
+    лимит запросов на ключ (API ключ + модель), общий для всех воркеров при Redis backend
+    """
+
+    def __init__(
+        self,
+        key: str,
+        requests_per_minute: float,
+        backend: Optional[QuotaBackend] = None,
+        capacity: float = 1,
+        policy: Optional[AIMDPolicy] = None,
+    ):
+        self.key = key
+        self.requests_per_minute = requests_per_minute
+        self.capacity = capacity
+        self.backend = backend or quota_backend
+        self.policy = policy
+
+    def report(self, throttled_for: Optional[float] = None):
+        """Результат запроса к модели для AIMD (см. RateLimiter.report)"""
+        if self.policy is None:
+            return
+        rate = self.backend.adjust(self.key, self.requests_per_minute, self.policy, throttled_for=throttled_for)
+        if throttled_for is not None:
+            logger.warning(f"[RateLimiter] {self.key} is throttled for {throttled_for:.0f}s, new limit {rate:.1f} requests per minute")
+
+    def _reserve(self, blocking: bool) -> float:
+        return self.backend.reserve(
+            self.key, self.requests_per_minute, capacity=self.capacity, max_wait=None if blocking else 0
+        )
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        wait_time = self._reserve(blocking)
+        if wait_time > 0:
+            if not blocking:
+                return False
+            logger.info(f"wait befor {self.key} request for: {wait_time:.2f} seconds")
+            time.sleep(wait_time)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        wait_time = await asyncio.to_thread(self._reserve, blocking)
+        if wait_time > 0:
+            if not blocking:
+                return False
+            logger.info(f"wait befor {self.key} request for: {wait_time:.2f} seconds")
+            await asyncio.sleep(wait_time)
+        return True
+
+
+class RateLimitFeedback(BaseCallbackHandler):
+    """Callback модели: сообщает QuotaRateLimiter об успешных ответах и отказах по лимиту (429)"""
+
+    def __init__(self, limiter: QuotaRateLimiter):
+        self.limiter = limiter
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any):
+        self.limiter.report()
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any):
+        delay = throttle_delay(error)
+        if delay is not None:
+            self.limiter.report(throttled_for=delay)
+
+
+def _call_and_report(func: Callable[P, R], category: ToolCategory, *args: P.args, **kwargs: P.kwargs) -> R:
+    """Вызов инструмента с отчётом для AIMD: 429 в исключении или остаток квоты из заголовков ответа"""
+    if not rate_limiter.is_adaptive(category):
+        return func(*args, **kwargs)
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        delay = throttle_delay(e)
+        if delay is not None:
+            rate_limiter.report(category, throttled_for=delay)
+        raise
+    observer = _quota_observer.get()
+    rate_limiter.report(category, quota=observer(category) if observer else None)
+    return result
+
+
+def rate_limited_tools_per_minute(
+    func: Callable[P, R], category: ToolCategory = ToolCategory.LOCAL
+) -> Callable[P, R]:
+    @wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        rate_limiter.acquire(category)
+        return _call_and_report(func, category, *args, **kwargs)
+    return wrapper
+
+
+def async_rate_limited_tools_per_minute(
+    func: Callable[P, R], category: ToolCategory = ToolCategory.LOCAL
+) -> Callable[P, Awaitable[R]]:
+    """Ожидание лимита на event loop, сам блокирующий вызов - в потоке executor'а"""
+    @wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        await rate_limiter.aacquire(category)
+        return await asyncio.to_thread(_call_and_report, func, category, *args, **kwargs)
+    return wrapper
+
+
+def _in_quota_scope(
+    func: Callable[P, R], scope: str, observer: Optional[Callable[[ToolCategory], Optional[QuotaState]]]
+) -> Callable[P, R]:
     @wraps(func)
     def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
-        result = rate_limiter.wait(func=func, *args, **kwargs)
-        return result
+        with quota_scope(scope, observer):
+            return func(*args, **kwargs)
     return wrapper
 
+
+def _ain_quota_scope(
+    func: Callable[P, Awaitable[R]], scope: str, observer: Optional[Callable[[ToolCategory], Optional[QuotaState]]]
+) -> Callable[P, Awaitable[R]]:
+    # asyncio.to_thread копирует контекст, поэтому вызов в executor видит тот же scope
+    @wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        with quota_scope(scope, observer):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def rate_limited_tool(
+    func: Optional[Callable[P, R]] = None,
+    *,
+    category: ToolCategory = ToolCategory.LOCAL,
+    read_only: bool = False,
+    side_effect: bool = False,
+    scope: Optional[str] = None,
+    observer: Optional[Callable[[ToolCategory], Optional[QuotaState]]] = None,
+) -> Union[BaseTool, Callable[[Callable[P, R]], BaseTool]]:
+    """
+    @tool с лимитом вызовов и асинхронной версией для ainvoke/astream: синхронный вызов ждёт лимит в потоке,
+    асинхронный - на event loop, а блокирующая работа (файлы, git, GitHub API) уходит в executor.
+
+    :param category: категория лимита (ToolCategory)
+    :param read_only: инструмент ничего не меняет (файлы, git, GitHub), OrderedToolNode может
+        выполнять такие вызовы параллельно
+    :param side_effect: вызов меняет внешний мир (push, PR, merge), OrderedToolNode не повторяет его
+        с тем же tool_call_id при продолжении прерванного хода
+    :param scope: чей лимит расходует вызов (quota_scope), по умолчанию - заданный в контексте вызова
+    :param observer: остаток квоты после вызова для AIMD (см. RateLimiter.report)
+    """
+    def decorator(func: Callable[P, R]) -> BaseTool:
+        call = rate_limited_tools_per_minute(func, category)
+        acall = async_rate_limited_tools_per_minute(func, category)
+        if scope is not None:
+            call, acall = _in_quota_scope(call, scope, observer), _ain_quota_scope(acall, scope, observer)
+        structured_tool = tool(call)
+        structured_tool.coroutine = acall
+        structured_tool.metadata = {
+            **(structured_tool.metadata or {}),
+            "read_only": read_only,
+            "side_effect": side_effect,
+            "rate_limit_category": category,
+        }
+        return structured_tool
+
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -0,0 +1,180 @@
+import pickle
+import threading
+import zlib
+from typing import Any, Optional
+
+from langgraph.checkpoint.serde.base import SerializerProtocol
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+try:
+    import zstandard
+except ImportError:  # zstd опционален, без него используется zlib
+    zstandard = None
+
+
+class Compressor:
+    """Алгоритм сжатия с коротким именем (для type в чекпоинтах) и id (для заголовка StateSerializer)"""
+    name: str = "none"
+    id: int = 0
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCompressor(Compressor):
+    name = "zlib"
+    id = 1
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    name = "zstd"
+    id = 2
+
+    def __init__(self, level: int = 3):
+        if zstandard is None:
+            raise ImportError("zstandard is not installed, use zlib compression or `pip install zstandard`")
+        self.level = level
+        # Контексты zstd не потокобезопасны, а чекпоинтер пишет из потоков LangGraph
+        self._local = threading.local()
+
+    def _context(self) -> threading.local:
+        if not hasattr(self._local, "compressor"):
+            self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+            self._local.decompressor = zstandard.ZstdDecompressor()
+        return self._local
+
+    def compress(self, data: bytes) -> bytes:
+        return self._context().compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._context().decompressor.decompress(data)
+
+
+COMPRESSORS: dict[str, type[Compressor]] = {
+    Compressor.name: Compressor,
+    ZlibCompressor.name: ZlibCompressor,
+    ZstdCompressor.name: ZstdCompressor,
+}
+COMPRESSORS_BY_ID: dict[int, type[Compressor]] = {compressor.id: compressor for compressor in COMPRESSORS.values()}
+DEFAULT_COMPRESSION = ZstdCompressor.name if zstandard is not None else ZlibCompressor.name
+
+
+def get_compressor(name: str) -> Compressor:
+    try:
+        return COMPRESSORS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown compression: {name}") from None
+
+
+class CompressedSerializer(SerializerProtocol):
+    """
+    Сериализатор для чекпоинтов LangGraph: значения кодируются JsonPlusSerializer (msgpack),
+    а байты больше min_size сжимаются. Алгоритм дописывается к type через "+" (как у EncryptedSerializer),
+    поэтому несжатые строки, записанные раньше, читаются без изменений.
+    """
+
+    def __init__(
+        self,
+        serde: Optional[SerializerProtocol] = None,
+        compression: str = DEFAULT_COMPRESSION,
+        min_size: int = 256,
+    ) -> None:
+        self.serde = serde or JsonPlusSerializer()
+        self.compressor = get_compressor(compression)
+        self.min_size = min_size
+        self._decompressors: dict[str, Compressor] = {self.compressor.name: self.compressor}
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.serde.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if self.compressor.id == Compressor.id or len(data) < self.min_size:
+            return type_, data
+        return f"{type_}+{self.compressor.name}", self.compressor.compress(data)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if "+" not in type_:
+            return self.serde.loads_typed(data)
+        type_, compression = type_.split("+", 1)
+        if compression not in self._decompressors:
+            self._decompressors[compression] = get_compressor(compression)
+        return self.serde.loads_typed((type_, self._decompressors[compression].decompress(payload)))
+
+
+class StateSerializer:
+    """
+    Формат значений DjangoDBDict/DBDict:
+    MAGIC(3) + версия формата(1) + id сжатия(1) + длина имени кодека(1) + имя кодека + payload.
+    Строки без MAGIC считаются старыми (pickle.dumps всего значения) и читаются как есть.
+
+    codec:
+        "msgpack" - JsonPlusSerializer (LangChain сообщения, pydantic, dataclasses...), кортежи становятся списками
+        "json" - JsonPlusSerializer в json
+        "pickle" - для структур, где важны типы (defaultdict, кортежи), например DBDict под InMemorySaver
+    """
+    MAGIC = b"AIS"
+    FORMAT_VERSION = 1
+    CODECS = ("msgpack", "json", "pickle")
+
+    def __init__(self, codec: str = "msgpack", compression: str = DEFAULT_COMPRESSION, min_size: int = 256):
+        if codec not in self.CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        self.codec = codec
+        self.compressor = get_compressor(compression)
+        self.min_size = min_size
+        self.serde = JsonPlusSerializer()
+        self._compressors: dict[int, Compressor] = {
+            compressor.id: compressor() for compressor in (Compressor, ZlibCompressor)
+        }
+        self._compressors[self.compressor.id] = self.compressor
+
+    def _encode(self, obj: Any) -> tuple[str, bytes]:
+        if self.codec == "pickle":
+            return "pickle", pickle.dumps(obj)
+        if self.codec == "json":
+            return "json", self.serde.dumps(obj)
+        return self.serde.dumps_typed(obj)
+
+    def _decode(self, codec: str, payload: bytes) -> Any:
+        if codec == "pickle":
+            return pickle.loads(payload)
+        return self.serde.loads_typed((codec, payload))
+
+    def dumps(self, obj: Any) -> bytes:
+        codec, payload = self._encode(obj)
+        compressor = self.compressor if len(payload) >= self.min_size else self._compressors[Compressor.id]
+        codec_name = codec.encode()
+        header = self.MAGIC + bytes((self.FORMAT_VERSION, compressor.id, len(codec_name))) + codec_name
+        return header + compressor.compress(payload)
+
+    def loads(self, data: bytes) -> Any:
+        data = bytes(data)
+        if not data.startswith(self.MAGIC):
+            return pickle.loads(data)
+        version, compression_id, codec_length = data[3], data[4], data[5]
+        if version != self.FORMAT_VERSION:
+            raise ValueError(f"Unsupported state format version: {version}")
+        codec = data[6:6 + codec_length].decode()
+        if compression_id not in self._compressors:
+            if compression_id not in COMPRESSORS_BY_ID:
+                raise ValueError(f"Unknown compression id: {compression_id}")
+            self._compressors[compression_id] = COMPRESSORS_BY_ID[compression_id]()
+        payload = self._compressors[compression_id].decompress(data[6 + codec_length:])
+        return self._decode(codec, payload)
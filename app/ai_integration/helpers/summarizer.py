@@ -0,0 +1,62 @@
+import logging
+from typing import Sequence
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage, AIMessage
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Ты ведёшь краткую память AI агента, который работает с git репозиторием.
+Ниже текущая сводка и старые сообщения, которые больше не помещаются в контекст модели.
+Обнови сводку так, чтобы агент мог продолжить работу без этих сообщений. Обязательно сохрани:
+- состояние todo list: задачи, шаги и их статусы;
+- текущую ветку, созданные ветки, коммиты и pull request'ы;
+- какие файлы созданы или изменены и зачем;
+- принятые решения, ошибки и что ещё осталось сделать.
+Не пересказывай содержимое файлов целиком. Ответь только текстом новой сводки, не длиннее {max_words} слов."""
+
+
+class HistorySummarizer:
+    """
+    Сворачивает старые сообщения треда в текстовую сводку, которая хранится в чекпоинте (канал summary)
+    и подставляется в системный промпт вместо вытесненной истории.
+    """
+    SUMMARY_HEADER = "Краткое содержание предыдущей работы:"
+
+    def __init__(self, model: BaseChatModel, max_tokens: int, max_message_chars: int = 2000):
+        self.model = model
+        # Сводка резервирует max_tokens из бюджета контекста
+        self.max_tokens = max_tokens
+        # Длинные сообщения (содержимое файлов, вывод линтера) режутся, в сводку они всё равно не попадут
+        self.max_message_chars = max_message_chars
+
+    def _render(self, message: BaseMessage) -> str:
+        if isinstance(message, ToolMessage):
+            role = f"Tool {message.name or ''}".strip()
+        elif isinstance(message, AIMessage):
+            role = "AI"
+            if message.tool_calls:
+                calls = ", ".join(f"{call['name']}({call['args']})" for call in message.tool_calls)
+                return f"{role}: {message.text()} [вызовы: {calls}]"[:self.max_message_chars]
+        elif isinstance(message, HumanMessage):
+            role = "Human"
+        else:
+            role = message.type
+        text = message.text()
+        if len(text) > self.max_message_chars:
+            text = f"{text[:self.max_message_chars]}... [обрезано {len(text) - self.max_message_chars} символов]"
+        return f"{role}: {text}"
+
+    def fold(self, summary: str, messages: Sequence[BaseMessage]) -> str:
+        """Возвращает новую сводку: summary + messages"""
+        history = "\n".join(self._render(message) for message in messages)
+        request = [
+            SystemMessage(content=SUMMARY_PROMPT.format(max_words=self.max_tokens // 2)),
+            HumanMessage(content=f"Текущая сводка:\n{summary or '(пусто)'}\n\nСтарые сообщения:\n{history}"),
+        ]
+        response = self.model.invoke(request)
+        logger.info(f"summarized {len(messages)} messages into {len(response.text())} chars")
+        return response.text().strip()
+
+    def as_message(self, summary: str) -> SystemMessage:
+        return SystemMessage(content=f"{self.SUMMARY_HEADER}\n{summary}")
@@ -0,0 +1,199 @@
+import ast
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from ai_integration.helpers.code_search import filter_paths, list_files
+
+logger = logging.getLogger(__name__)
+
+
+class Symbol(NamedTuple):
+    # "class", "def" или "async def"
+    kind: str
+    # Полное имя внутри модуля: Class.method, outer.inner
+    name: str
+    # Аргументы и аннотация результата, у класса - базовые классы
+    signature: str
+    line: int
+    end_line: int
+    # Функция объявлена прямо в теле класса
+    method: bool
+
+    def describe(self) -> str:
+        return f"{self.kind} {self.name}{self.signature} (lines {self.line}-{self.end_line})"
+
+
+def _signature(node: ast.AST) -> str:
+    if isinstance(node, ast.ClassDef):
+        bases = [ast.unparse(base) for base in node.bases] + [ast.unparse(keyword) for keyword in node.keywords]
+        return f"({', '.join(bases)})" if bases else ""
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+    return f"({ast.unparse(node.args)}){returns}"
+
+
+def parse_symbols(source: bytes, path: str = "<unknown>") -> list[Symbol]:
+    """Классы и функции (в том числе async, методы и вложенные) модуля в порядке объявления; [] - синтаксическая ошибка"""
+    try:
+        tree = ast.parse(source, filename=path)
+    except (SyntaxError, ValueError, RecursionError) as e:
+        logger.warning(f"Ошибка при парсинге AST в '{path}': {e}")
+        return []
+    symbols: list[Symbol] = []
+
+    def visit(nodes, prefix: str, in_class: bool):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                is_class = isinstance(node, ast.ClassDef)
+                kind = "class" if is_class else "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+                name = prefix + node.name
+                symbols.append(Symbol(kind, name, _signature(node), node.lineno, node.end_lineno or node.lineno, in_class and not is_class))
+                visit(node.body, f"{name}.", is_class)
+            else:
+                # Объявления внутри if TYPE_CHECKING, try/except ImportError и т.п. принадлежат тому же уровню
+                visit(
+                    (child for child in ast.iter_child_nodes(node) if isinstance(child, (ast.stmt, ast.excepthandler, ast.match_case))),
+                    prefix,
+                    in_class,
+                )
+
+    visit(tree.body, "", False)
+    return symbols
+
+
+class SymbolIndex:
+    """
+    Символы python файлов рабочей копии для get_function_defs, get_class_structure, find_symbol и list_symbols.
+    Файл разбирается через ast только при изменении: запись хранит mtime и размер, а результат разбора лежит
+    по sha содержимого (как у git blob), поэтому checkout или touch без изменения содержимого не вызывает
+    повторного разбора, а вернувшийся файл другой ветки берётся из кэша. Индекс хранится в
+    .git/ai_agent_symbol_index.pickle и переживает сессии.
+    """
+    VERSION = 1
+    FILE_NAME = "ai_agent_symbol_index.pickle"
+    # Как часто сохранять индекс после разбора новых файлов
+    SAVE_INTERVAL = 60
+    # Результатов разбора, на которые не ссылается ни один файл, больше этого - они удаляются при сохранении
+    MAX_UNUSED_BLOBS = 5000
+
+    def __init__(self, repo_path: str):
+        self.repo_path = os.path.abspath(repo_path)
+        # Путь -> (st_mtime_ns, st_size, sha содержимого)
+        self.files: dict[str, tuple[int, int, str]] = {}
+        # sha содержимого -> символы
+        self.blobs: dict[str, list[Symbol]] = {}
+        self._dirty = False
+        self._saved_at = 0.0
+        # Параллельные read-only вызовы (OrderedToolNode) обновляют индекс по очереди
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["repo_path"])
+        self.__dict__.update(state)
+
+    @property
+    def index_path(self) -> Optional[str]:
+        git_dir = os.path.join(self.repo_path, ".git")
+        return os.path.join(git_dir, self.FILE_NAME) if os.path.isdir(git_dir) else None
+
+    @classmethod
+    def load(cls, repo_path: str) -> "SymbolIndex":
+        """Индекс с диска, если он есть и той же версии; устаревшие записи проверяются при обращении"""
+        index = cls(repo_path)
+        index_path = index.index_path
+        if index_path is None or not os.path.exists(index_path):
+            return index
+        try:
+            with open(index_path, "rb") as file:
+                version, loaded = pickle.load(file)
+            if version == cls.VERSION and isinstance(loaded, cls):
+                loaded.repo_path = index.repo_path
+                return loaded
+        except Exception as e:
+            logger.warning(f"symbol index {index_path} is broken, rebuilding: {e}")
+        return index
+
+    def save(self):
+        index_path = self.index_path
+        if index_path is None:
+            return
+        with self._lock:
+            used = {entry[2] for entry in self.files.values()}
+            if len(self.blobs) - len(used) > self.MAX_UNUSED_BLOBS:
+                self.blobs = {sha: symbols for sha, symbols in self.blobs.items() if sha in used}
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                pickle.dump((self.VERSION, self), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+            self._saved_at = time.monotonic()
+            self._dirty = False
+
+    def _save_if_needed(self):
+        if self._dirty and (not self._saved_at or time.monotonic() - self._saved_at > self.SAVE_INTERVAL):
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"symbol index is not saved: {e}")
+
+    def _relative(self, path: str) -> str:
+        relative = os.path.normpath(os.path.relpath(os.path.join(self.repo_path, path), self.repo_path))
+        if relative.split(os.sep)[0] == "..":
+            raise ValueError(f"'{path}' is outside of the repository")
+        return relative.replace(os.sep, "/")
+
+    def _symbols(self, path: str) -> list[Symbol]:
+        full_path = os.path.join(self.repo_path, path)
+        stat = os.stat(full_path)
+        entry = self.files.get(path)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size) and entry[2] in self.blobs:
+            return self.blobs[entry[2]]
+        with open(full_path, "rb") as file:
+            data = file.read()
+        sha = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+        if sha not in self.blobs:
+            self.blobs[sha] = parse_symbols(data, path)
+        self.files[path] = (stat.st_mtime_ns, stat.st_size, sha)
+        self._dirty = True
+        return self.blobs[sha]
+
+    def symbols(self, path: str) -> list[Symbol]:
+        """Символы одного файла (путь относительно репозитория)"""
+        with self._lock:
+            result = self._symbols(self._relative(path))
+            self._save_if_needed()
+            return result
+
+    def directory_symbols(self, directory: str = ".") -> list[tuple[str, Symbol]]:
+        """(путь, символ) всех python файлов directory, кроме игнорируемых git; изменённые файлы разбираются заново"""
+        paths = filter_paths(list_files(self.repo_path, directory), directory, [".py"])
+        result: list[tuple[str, Symbol]] = []
+        with self._lock:
+            prefix = self._relative(directory)
+            prefix = "" if prefix == "." else f"{prefix}/"
+            # Удалённые файлы directory
+            listed = set(paths)
+            for path in [path for path in self.files if path.startswith(prefix) and path not in listed]:
+                del self.files[path]
+                self._dirty = True
+            for path in paths:
+                try:
+                    result.extend((path, symbol) for symbol in self._symbols(path))
+                except OSError as e:
+                    logger.debug(f"symbol index skips '{path}': {e}")
+            self._save_if_needed()
+        return result
+
+    def find(self, name: str, directory: str = ".") -> list[tuple[str, Symbol]]:
+        """Объявления name: полное имя (Class.method) или последняя его часть (method)"""
+        return [
+            (path, symbol)
+            for path, symbol in self.directory_symbols(directory)
+            if symbol.name == name or symbol.name.endswith(f".{name}")
+        ]
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from typing import Any, Literal, MutableMapping, Optional, Sequence
+
+from langchain_core.messages import ToolCall, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import get_config_list, get_executor_for_config
+from langchain_core.tools import BaseTool
+from langgraph.prebuilt import ToolNode
+from langgraph.store.base import BaseStore
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedToolNode(ToolNode):
+    """
+    ToolNode, который выполняет вызовы одного ответа модели группами по порядку:
+    подряд идущие read-only вызовы (metadata["read_only"], см. rate_limited_tool) - параллельно
+    на пуле из max_workers потоков, изменяющие (файлы, git, GitHub) - строго по одному, в том порядке,
+    в котором их вернула модель. Каждый вызов, в том числе параллельный, берёт свой токен rate limiter.
+    Работает с create_react_agent(version="v1"), когда все вызовы хода приходят в один узел.
+    Переопределяет внутренние методы ToolNode (_func, _afunc, _run_one), поэтому версия
+    langgraph-prebuilt ограничена в pyproject.toml.
+
+    Вызовы с внешним эффектом (metadata["side_effect"]: push, PR, merge) запоминаются в tool_results
+    по tool_call_id: если узел выполняется повторно после сбоя (продолжение с чекпоинта), уже выполненный
+    вызов не повторяется, а возвращает сохранённый результат.
+    """
+
+    def __init__(
+        self,
+        tools: Sequence[BaseTool],
+        *,
+        max_workers: int = 4,
+        tool_results: Optional[MutableMapping[str, str]] = None,
+        max_tool_results: int = 200,
+        **kwargs: Any,
+    ) -> None:
+        """
+        :param tool_results: хранилище результатов вызовов с внешним эффектом (tool_call_id -> ответ),
+            например DjangoDBDict чата; если у него есть sync_data, результат сохраняется сразу после вызова
+        :param max_tool_results: сколько последних результатов хранить
+        """
+        super().__init__(tools, **kwargs)
+        self.max_workers = max_workers
+        self.tool_results = tool_results
+        self.max_tool_results = max_tool_results
+
+    def is_read_only(self, call: ToolCall) -> bool:
+        tool_ = self.tools_by_name.get(call["name"])
+        return bool(tool_ is not None and (tool_.metadata or {}).get("read_only"))
+
+    def has_side_effect(self, call: ToolCall) -> bool:
+        tool_ = self.tools_by_name.get(call["name"])
+        return bool(tool_ is not None and (tool_.metadata or {}).get("side_effect"))
+
+    def _recorded(self, call: ToolCall) -> Optional[ToolMessage]:
+        """Ответ уже выполненного вызова с внешним эффектом или None"""
+        if self.tool_results is None or not call.get("id") or not self.has_side_effect(call):
+            return None
+        content = self.tool_results.get(call["id"])
+        if content is None:
+            return None
+        logger.info(f"skip {call['name']} ({call['id']}): already done before restart")
+        return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"])
+
+    def _record(self, call: ToolCall, result: Any) -> None:
+        if (
+            self.tool_results is None
+            or not call.get("id")
+            or not self.has_side_effect(call)
+            or not isinstance(result, ToolMessage)
+            or result.status == "error"
+        ):
+            return
+        self.tool_results[call["id"]] = result.content
+        while len(self.tool_results) > self.max_tool_results:
+            del self.tool_results[next(iter(self.tool_results))]
+        # Пишем сразу: при падении воркера до следующего чекпоинта вызов не должен повториться
+        sync_data = getattr(self.tool_results, "sync_data", None)
+        if sync_data is not None:
+            sync_data()
+
+    def _run_one(
+        self,
+        call: ToolCall,
+        input_type: Literal["list", "dict", "tool_calls"],
+        config: RunnableConfig,
+    ) -> Any:
+        if (recorded := self._recorded(call)) is not None:
+            return recorded
+        result = super()._run_one(call, input_type, config)
+        self._record(call, result)
+        return result
+
+    async def _arun_one(
+        self,
+        call: ToolCall,
+        input_type: Literal["list", "dict", "tool_calls"],
+        config: RunnableConfig,
+    ) -> Any:
+        if (recorded := self._recorded(call)) is not None:
+            return recorded
+        result = await super()._arun_one(call, input_type, config)
+        # Запись в базу синхронная, side-effect вызовы и так выполняются по одному
+        await asyncio.to_thread(self._record, call, result)
+        return result
+
+    def _groups(self, tool_calls: list[ToolCall]) -> list[list[int]]:
+        """Индексы вызовов, разбитые на группы: серия read-only вызовов или один изменяющий"""
+        groups: list[list[int]] = []
+        previous_read_only = False
+        for i, call in enumerate(tool_calls):
+            read_only = self.is_read_only(call)
+            if read_only and previous_read_only:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+            previous_read_only = read_only
+        return groups
+
+    def _func(
+        self,
+        input: Any,
+        config: RunnableConfig,
+        *,
+        store: Optional[BaseStore],
+    ) -> Any:
+        tool_calls, input_type = self._parse_input(input, store)
+        config_list = get_config_list(config, len(tool_calls))
+        outputs: list[Any] = [None] * len(tool_calls)
+        for group in self._groups(tool_calls):
+            if len(group) == 1:
+                i = group[0]
+                outputs[i] = self._run_one(tool_calls[i], input_type, config_list[i])
+                continue
+            logger.info(f"run {len(group)} read-only tool calls in parallel: {[tool_calls[i]['name'] for i in group]}")
+            with get_executor_for_config({**config, "max_concurrency": self.max_workers}) as executor:
+                results = executor.map(
+                    self._run_one,
+                    [tool_calls[i] for i in group],
+                    [input_type] * len(group),
+                    [config_list[i] for i in group],
+                )
+                for i, result in zip(group, results):
+                    outputs[i] = result
+        return self._combine_tool_outputs(outputs, input_type)
+
+    async def _afunc(
+        self,
+        input: Any,
+        config: RunnableConfig,
+        *,
+        store: Optional[BaseStore],
+    ) -> Any:
+        tool_calls, input_type = self._parse_input(input, store)
+        outputs: list[Any] = [None] * len(tool_calls)
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run_one(i: int) -> None:
+            async with semaphore:
+                outputs[i] = await self._arun_one(tool_calls[i], input_type, config)
+
+        for group in self._groups(tool_calls):
+            if len(group) == 1:
+                await run_one(group[0])
+                continue
+            logger.info(f"run {len(group)} read-only tool calls in parallel: {[tool_calls[i]['name'] for i in group]}")
+            await asyncio.gather(*(run_one(i) for i in group))
+        return self._combine_tool_outputs(outputs, input_type)
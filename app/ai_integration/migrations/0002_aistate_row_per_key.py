@@ -0,0 +1,70 @@
+import hashlib
+import pickle
+
+from django.db import migrations, models
+
+
+STATE_MODELS = ("AIStateBlobs", "AIStateWrites", "AIStateStorage", "AIStateDefault")
+
+
+def split_state_rows(apps, schema_editor):
+    """Разбивает старые строки (один pickle всего словаря на record_id) на строки по ключам."""
+    for model_name in STATE_MODELS:
+        legacy_model = apps.get_model("ai_integration", f"{model_name}Legacy")
+        model = apps.get_model("ai_integration", model_name)
+        for legacy in legacy_model.objects.all().iterator():
+            if not legacy.data:
+                continue
+            data = pickle.loads(bytes(legacy.data))
+            rows = []
+            for key, value in data.items():
+                key_data = pickle.dumps(key, protocol=4)
+                rows.append(
+                    model(
+                        record_id=legacy.id,
+                        key_hash=hashlib.sha256(key_data).hexdigest(),
+                        key=key_data,
+                        data=pickle.dumps(value),
+                    )
+                )
+            model.objects.bulk_create(rows, batch_size=500)
+
+
+def state_model_fields():
+    return [
+        ('id', models.BigAutoField(primary_key=True, serialize=False)),
+        ('record_id', models.CharField(db_index=True, max_length=255)),
+        ('key_hash', models.CharField(max_length=64)),
+        ('key', models.BinaryField()),
+        ('data', models.BinaryField()),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_integration', '0001_initial'),
+    ]
+
+    operations = [
+        *[
+            migrations.RenameModel(old_name=name, new_name=f"{name}Legacy")
+            for name in STATE_MODELS
+        ],
+        *[
+            migrations.CreateModel(
+                name=name,
+                fields=state_model_fields(),
+                options={
+                    'abstract': False,
+                    'unique_together': {('record_id', 'key_hash')},
+                },
+            )
+            for name in STATE_MODELS
+        ],
+        migrations.RunPython(split_state_rows, migrations.RunPython.noop),
+        *[
+            migrations.DeleteModel(name=f"{name}Legacy")
+            for name in STATE_MODELS
+        ],
+    ]
@@ -0,0 +1,146 @@
+import pickle
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+CHECKPOINT_MODELS = ("AIStateStorage", "AIStateWrites", "AIStateBlobs")
+
+
+def convert_state_rows(apps, schema_editor):
+    """Переносит словари InMemorySaver (строка на ключ) в таблицы DjangoCheckpointSaver."""
+    legacy_storage = apps.get_model("ai_integration", "AIStateStorageLegacy")
+    legacy_writes = apps.get_model("ai_integration", "AIStateWritesLegacy")
+    legacy_blobs = apps.get_model("ai_integration", "AIStateBlobsLegacy")
+    storage = apps.get_model("ai_integration", "AIStateStorage")
+    writes = apps.get_model("ai_integration", "AIStateWrites")
+    blobs = apps.get_model("ai_integration", "AIStateBlobs")
+
+    # storage: thread_id -> checkpoint_ns -> checkpoint_id -> (checkpoint, metadata, parent_checkpoint_id)
+    for row in legacy_storage.objects.all().iterator():
+        thread_id = pickle.loads(bytes(row.key))
+        rows = []
+        for checkpoint_ns, checkpoints in pickle.loads(bytes(row.data)).items():
+            for checkpoint_id, (checkpoint, metadata, parent_checkpoint_id) in checkpoints.items():
+                rows.append(
+                    storage(
+                        thread_id=thread_id,
+                        checkpoint_ns=checkpoint_ns,
+                        checkpoint_id=checkpoint_id,
+                        parent_checkpoint_id=parent_checkpoint_id,
+                        type=checkpoint[0],
+                        checkpoint=checkpoint[1],
+                        metadata_type=metadata[0],
+                        metadata=metadata[1],
+                    )
+                )
+        storage.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+
+    # writes: (thread_id, checkpoint_ns, checkpoint_id) -> (task_id, idx) -> (task_id, channel, value, task_path)
+    for row in legacy_writes.objects.all().iterator():
+        thread_id, checkpoint_ns, checkpoint_id = pickle.loads(bytes(row.key))
+        rows = [
+            writes(
+                thread_id=thread_id,
+                checkpoint_ns=checkpoint_ns,
+                checkpoint_id=checkpoint_id,
+                task_id=task_id,
+                idx=idx,
+                channel=channel,
+                type=value[0],
+                data=value[1],
+                task_path=task_path,
+            )
+            for (task_id, idx), (_, channel, value, task_path) in pickle.loads(bytes(row.data)).items()
+        ]
+        writes.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+
+    # blobs: (thread_id, checkpoint_ns, channel, version) -> (type, data)
+    rows = []
+    for row in legacy_blobs.objects.all().iterator():
+        thread_id, checkpoint_ns, channel, version = pickle.loads(bytes(row.key))
+        type_, data = pickle.loads(bytes(row.data))
+        rows.append(
+            blobs(
+                thread_id=thread_id,
+                checkpoint_ns=checkpoint_ns,
+                channel=channel,
+                version=str(version),
+                type=type_,
+                data=data,
+            )
+        )
+        if len(rows) >= 500:
+            blobs.objects.bulk_create(rows, ignore_conflicts=True)
+            rows = []
+    blobs.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_integration', '0002_aistate_row_per_key'),
+    ]
+
+    operations = [
+        *[
+            migrations.RenameModel(old_name=name, new_name=f"{name}Legacy")
+            for name in CHECKPOINT_MODELS
+        ],
+        migrations.CreateModel(
+            name='AIStateStorage',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('thread_id', models.CharField(max_length=255)),
+                ('checkpoint_ns', models.CharField(blank=True, default='', max_length=255)),
+                ('checkpoint_id', models.CharField(max_length=255)),
+                ('parent_checkpoint_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('type', models.CharField(max_length=64)),
+                ('checkpoint', models.BinaryField()),
+                ('metadata_type', models.CharField(max_length=64)),
+                ('metadata', models.BinaryField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('thread_id', 'checkpoint_ns', 'checkpoint_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AIStateBlobs',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('thread_id', models.CharField(max_length=255)),
+                ('checkpoint_ns', models.CharField(blank=True, default='', max_length=255)),
+                ('channel', models.CharField(max_length=255)),
+                ('version', models.CharField(max_length=255)),
+                ('type', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'unique_together': {('thread_id', 'checkpoint_ns', 'channel', 'version')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AIStateWrites',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('thread_id', models.CharField(max_length=255)),
+                ('checkpoint_ns', models.CharField(blank=True, default='', max_length=255)),
+                ('checkpoint_id', models.CharField(max_length=255)),
+                ('task_id', models.CharField(max_length=255)),
+                ('idx', models.IntegerField()),
+                ('channel', models.CharField(max_length=255)),
+                ('type', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+                ('task_path', models.CharField(blank=True, default='', max_length=1024)),
+            ],
+            options={
+                'unique_together': {('thread_id', 'checkpoint_ns', 'checkpoint_id', 'task_id', 'idx')},
+            },
+        ),
+        migrations.RunPython(convert_state_rows, migrations.RunPython.noop),
+        *[
+            migrations.DeleteModel(name=f"{name}Legacy")
+            for name in CHECKPOINT_MODELS
+        ],
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_integration', '0003_checkpoint_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aistateblobs',
+            name='base_version',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='aistateblobs',
+            name='snapshot_version',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
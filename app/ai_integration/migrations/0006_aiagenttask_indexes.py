@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_integration', '0005_aiagenttask_claim'),
+        ('github_integration', '0002_repository_github_email_repository_github_username'),
+        ('schedule_service', '0002_activityschedule_weekdays'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aiagenttask',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['scheduled_time', 'id'], name='aiagenttask_pending_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aiagenttask',
+            index=models.Index(fields=['status', 'scheduled_time'], name='aiagenttask_status_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aiagenttask',
+            index=models.Index(fields=['scheduled_time', 'activity_schedule'], name='aiagenttask_planning_idx'),
+        ),
+    ]
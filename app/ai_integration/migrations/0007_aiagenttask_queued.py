@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_integration', '0006_aiagenttask_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='aiagenttask',
+            name='status',
+            field=models.CharField(blank=True, choices=[('DONE', 'Done'), ('RUNNING', 'Running'), ('PENDING', 'Pending'), ('QUEUED', 'Queued'), ('ERROR', 'Error'), ('CANCELLED', 'Cancelled')], max_length=255, null=True),
+        ),
+    ]
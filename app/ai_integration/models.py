@@ -1,6 +1,8 @@
+from datetime import datetime
 from enum import Enum
 
 from django.db import models
+from django.db.models.functions import TruncDate
 from django.utils import timezone
 
 from ai_integration.helpers.ai_model_enum import AIModels
@@ -10,36 +12,85 @@ from schedule_service.models import ActivitySchedule
 
 
 class AIState(models.Model):
-    id = None
-    data = None
+    """
+    Одна строка на ключ словаря состояния (DjangoDBDict).
+    record_id объединяет все ключи одного чата, key_hash - sha256 от сериализованного ключа.
+    """
+    id = models.BigAutoField(primary_key=True)
+    record_id = models.CharField(max_length=255, db_index=True)
+    key_hash = models.CharField(max_length=64)
+    key = models.BinaryField()
+    data = models.BinaryField()
+
     class Meta:
         abstract = True
+        unique_together = ("record_id", "key_hash")
 
 
-class AIStateBlobs(AIState):
-    id = models.CharField(max_length=255, unique=True, primary_key=True)
-    data = models.BinaryField()
-
+class AIStateDefault(AIState):
+    pass
+
+
+class AIStateStorage(models.Model):
+    """Чекпоинт LangGraph (без channel_values): одна строка на checkpoint_id"""
+    id = models.BigAutoField(primary_key=True)
+    thread_id = models.CharField(max_length=255)
+    checkpoint_ns = models.CharField(max_length=255, default="", blank=True)
+    checkpoint_id = models.CharField(max_length=255)
+    parent_checkpoint_id = models.CharField(max_length=255, blank=True, null=True)
+    type = models.CharField(max_length=64)
+    checkpoint = models.BinaryField()
+    metadata_type = models.CharField(max_length=64)
+    metadata = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
 
-class AIStateWrites(AIState):
-    id = models.CharField(max_length=255, unique=True, primary_key=True)
+    class Meta:
+        unique_together = ("thread_id", "checkpoint_ns", "checkpoint_id")
+
+
+class AIStateBlobs(models.Model):
+    """
+    Значение канала графа для конкретной версии.
+    Если base_version заполнен, data - дельта списка относительно base_version ({"drop": n, "append": [...]}),
+    snapshot_version - версия полного снимка, с которого начинается цепочка дельт.
+    """
+    id = models.BigAutoField(primary_key=True)
+    thread_id = models.CharField(max_length=255)
+    checkpoint_ns = models.CharField(max_length=255, default="", blank=True)
+    channel = models.CharField(max_length=255)
+    version = models.CharField(max_length=255)
+    type = models.CharField(max_length=64)
     data = models.BinaryField()
+    base_version = models.CharField(max_length=255, blank=True, null=True)
+    snapshot_version = models.CharField(max_length=255, blank=True, null=True)
 
-
-class AIStateStorage(AIState):
-    id = models.CharField(max_length=255, unique=True, primary_key=True)
+    class Meta:
+        unique_together = ("thread_id", "checkpoint_ns", "channel", "version")
+
+
+class AIStateWrites(models.Model):
+    """Промежуточные записи (pending writes) задач, привязанные к чекпоинту"""
+    id = models.BigAutoField(primary_key=True)
+    thread_id = models.CharField(max_length=255)
+    checkpoint_ns = models.CharField(max_length=255, default="", blank=True)
+    checkpoint_id = models.CharField(max_length=255)
+    task_id = models.CharField(max_length=255)
+    idx = models.IntegerField()
+    channel = models.CharField(max_length=255)
+    type = models.CharField(max_length=64)
     data = models.BinaryField()
+    task_path = models.CharField(max_length=1024, default="", blank=True)
 
-
-class AIStateDefault(AIState):
-    id = models.CharField(max_length=255, unique=True, primary_key=True)
-    data = models.BinaryField()
+    class Meta:
+        unique_together = ("thread_id", "checkpoint_ns", "checkpoint_id", "task_id", "idx")
 
 
 class StatusesAIAgentTask(models.Choices):
     DONE = "DONE"
     RUNNING = "RUNNING"
     PENDING = "PENDING"
+    # Отправлена в очередь Celery с eta = scheduled_time, воркер ещё не начал
+    QUEUED = "QUEUED"
     ERROR = "ERROR"
     CANCELLED = "CANCELLED"
 
@@ -86,4 +137,60 @@ class AIAgentTask(models.Model):
     created_at = models.DateTimeField(default=timezone.now)  # Истинное время создания
     scheduled_time = models.DateTimeField(null=True, blank=True)  # Время планируемого запуска
     ai_model = models.CharField(max_length=255, blank=True, null=True, choices=[(model.value, model.name) for model in AIModels])
+    # Метка отправки (один UPDATE на пачку задач): воркер начинает задачу, только если метка в сообщении совпадает
+    claim_token = models.UUIDField(blank=True, null=True, db_index=True)
+    # Время отправки в очередь, затем старта воркером (или следующего повтора)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Опрос run_scheduled_ai_tasks: PENDING задачи, у которых подошло время, по порядку
+            models.Index(
+                fields=["scheduled_time", "id"],
+                condition=models.Q(status="PENDING"),
+                name="aiagenttask_pending_due_idx",
+            ),
+            models.Index(fields=["status", "scheduled_time"], name="aiagenttask_status_time_idx"),
+            # schedule_ai_tasks: задачи расписаний за период планирования, сгруппированные по расписанию и дню
+            models.Index(fields=["scheduled_time", "activity_schedule"], name="aiagenttask_planning_idx"),
+        ]
+
+    def cancel(self) -> bool:
+        """
+        Отменяет незавершённую задачу. PENDING и QUEUED задачи больше не запустятся (сообщение в очереди
+        пропускается воркером), RUNNING останавливается после текущего шага графа, выполненное остаётся в чекпоинте.
+        Возвращает False, если задача уже завершилась.
+        """
+        cancelled = AIAgentTask.objects.filter(
+            id=self.id,
+            status__in=[
+                StatusesAIAgentTask.PENDING.value,
+                StatusesAIAgentTask.QUEUED.value,
+                StatusesAIAgentTask.RUNNING.value,
+            ],
+        ).update(status=StatusesAIAgentTask.CANCELLED.value)
+        if cancelled:
+            self.status = StatusesAIAgentTask.CANCELLED.value
+        return bool(cancelled)
+
+    @classmethod
+    def due(cls, now: datetime) -> models.QuerySet:
+        """PENDING задачи, у которых подошло время запуска, в порядке scheduled_time (aiagenttask_pending_due_idx)"""
+        return cls.objects.filter(
+            status=StatusesAIAgentTask.PENDING.value, scheduled_time__lte=now
+        ).order_by("scheduled_time", "id")
+
+    @classmethod
+    def scheduled_counts(cls, start: datetime, end: datetime) -> models.QuerySet:
+        """
+        Число задач расписаний по (activity_schedule_id, day) в [start, end). Диапазон по scheduled_time,
+        а не scheduled_time__date: __date оборачивает колонку в функцию, и индекс aiagenttask_planning_idx не работает
+        """
+        return (
+            cls.objects.filter(activity_schedule__isnull=False, scheduled_time__gte=start, scheduled_time__lt=end)
+            .annotate(day=TruncDate("scheduled_time"))
+            .values("activity_schedule_id", "day")
+            .annotate(total=models.Count("id"))
+            .order_by()
+        )
 
@@ -1,12 +1,22 @@
+import asyncio
 import os
 import random
+import time
+from contextlib import aclosing, closing
+from datetime import timedelta
+from typing import Any, Iterator, Optional
 
+from asgiref.sync import sync_to_async
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.db.models import Q
 from django.utils import timezone
 
 from ai_integration.ai_service import AIService
+from ai_integration.helpers.django_checkpointer import DjangoCheckpointSaver
+from ai_integration.helpers.lease import Lease, LeaseBusy, repository_lease_keys
 
 from ai_integration.models import AIAgentTask, StatusesAIAgentTask
 from ai_integration.helpers.ai_model_enum import AIModels
@@ -16,9 +26,145 @@ from github_integration.models import Repository, ProjectTheme
 
 logger = get_task_logger(__name__)
 
+# За сколько секунд до жёсткого лимита прерывается зависший шаг (SoftTimeLimitExceeded, asyncio.timeout)
+TIME_LIMIT_MARGIN = 60
 
-@shared_task(name="run_ai_agent", bind=True)
-def run_ai_agent(self, project_theme_id: int, ai_agent_task_id: str = None) -> None:
+
+def _chat_id(project_theme: ProjectTheme, repository: Repository) -> str:
+    return f"{project_theme.name}-{repository.name}"
+
+
+def _lease_for(project_theme: ProjectTheme, repository: Repository) -> Lease:
+    return Lease(repository_lease_keys(repository.id, _chat_id(project_theme, repository)))
+
+
+def _start_task(ai_agent_task_id: int, claim_token: Optional[str]) -> bool:
+    """
+    QUEUED -> RUNNING по claim_token из сообщения. Устаревшее сообщение (задачу уже отправила заново
+    сверка run_scheduled_ai_tasks, отменили или выполнили) ничего не меняет и пропускается.
+    Без claim_token (запуск не через планировщик) задача переходит в RUNNING из любого статуса, кроме CANCELLED.
+    """
+    if claim_token is None:
+        return bool(
+            AIAgentTask.objects.filter(id=ai_agent_task_id)
+            .exclude(status=StatusesAIAgentTask.CANCELLED.value)
+            .update(status=StatusesAIAgentTask.RUNNING.value, claimed_at=timezone.now())
+        )
+    return bool(
+        AIAgentTask.objects.filter(
+            id=ai_agent_task_id, claim_token=claim_token, status=StatusesAIAgentTask.QUEUED.value
+        ).update(status=StatusesAIAgentTask.RUNNING.value, claimed_at=timezone.now())
+    )
+
+
+def _finish_task(ai_agent_task_id: int, claim_token: Optional[str], status: str) -> bool:
+    """
+    RUNNING -> DONE/ERROR одним условным UPDATE. Задачу, которую за время выполнения отменили
+    или отправили заново с другим claim_token, не перезаписываем.
+    """
+    tasks = AIAgentTask.objects.filter(id=ai_agent_task_id, status=StatusesAIAgentTask.RUNNING.value)
+    if claim_token is not None:
+        tasks = tasks.filter(claim_token=claim_token)
+    return bool(tasks.update(status=status))
+
+
+def _stop_reason(ai_agent_task_id: int, started: float) -> Optional[str]:
+    """
+    Проверка между шагами графа: задачу отменили (AIAgentTask.cancel) или вышел AI_AGENT_SOFT_TIME_LIMIT.
+    Агент останавливается после сохранения чекпоинта шага, следующий запуск чата продолжит с него.
+    """
+    if time.monotonic() - started > settings.AI_AGENT_SOFT_TIME_LIMIT:
+        return "time limit"
+    if AIAgentTask.objects.filter(id=ai_agent_task_id, status=StatusesAIAgentTask.CANCELLED.value).exists():
+        return "cancelled"
+    return None
+
+
+def _finish_stopped(ai_agent_task_id: int, claim_token: Optional[str], reason: str, steps: int) -> str:
+    logger.warning(f"AI Agent Task:{ai_agent_task_id} stopped ({reason}) after {steps} steps")
+    if reason == "cancelled":
+        return f"Задача отменена после {steps} шагов"
+    _finish_task(ai_agent_task_id, claim_token, StatusesAIAgentTask.ERROR.value)
+    return f"Задача остановлена по лимиту времени после {steps} шагов"
+
+
+def _return_to_pending(ai_agent_task_id: int):
+    """Репозиторий занят другой задачей: run_scheduled_ai_tasks заберёт эту задачу снова на следующем тике"""
+    AIAgentTask.objects.filter(id=ai_agent_task_id, status=StatusesAIAgentTask.RUNNING.value).update(
+        status=StatusesAIAgentTask.PENDING.value, claim_token=None, claimed_at=None
+    )
+
+
+def _retry_countdown(retries: int) -> float:
+    """Пауза перед повтором: AI_AGENT_RETRY_BACKOFF * 2^retries, не больше AI_AGENT_RETRY_BACKOFF_MAX, со случайным разбросом"""
+    delay = min(settings.AI_AGENT_RETRY_BACKOFF * 2 ** retries, settings.AI_AGENT_RETRY_BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _queue_retry(ai_agent_task_id: int, claim_token: Optional[str], countdown: float):
+    """
+    RUNNING -> QUEUED до повтора с тем же claim_token: повторное сообщение пройдёт _start_task,
+    а requeue_lost_tasks не отправит задачу второй раз, пока не пройдёт claimed_at + AI_AGENT_QUEUED_GRACE.
+    Без claim_token задача остаётся в RUNNING до повтора.
+    """
+    if claim_token is None:
+        return
+    AIAgentTask.objects.filter(
+        id=ai_agent_task_id, claim_token=claim_token, status=StatusesAIAgentTask.RUNNING.value
+    ).update(status=StatusesAIAgentTask.QUEUED.value, claimed_at=timezone.now() + timedelta(seconds=countdown))
+
+
+def _agent_events(ai_service: AIService, prompt: str, retrying: bool) -> Iterator[dict[str, Any]]:
+    """
+    События агента для задачи. Если прошлый запуск оборвался посреди хода (ошибка модели, падение воркера),
+    ход сначала продолжается с чекпоинта: выполненные инструменты не повторяются, история остаётся корректной.
+    При повторе той же задачи промпт уже в истории, новой задаче он отправляется после продолжения.
+    """
+    if ai_service.can_resume():
+        yield from ai_service.stream(resume=True)
+        if retrying:
+            return
+    yield from ai_service.stream(human_message=prompt)
+
+
+async def _aagent_events(ai_service: AIService, prompt: str, retrying: bool):
+    """Асинхронная версия _agent_events"""
+    if await sync_to_async(ai_service.can_resume)():
+        async with aclosing(ai_service.astream(resume=True)) as events:
+            async for event in events:
+                yield event
+        if retrying:
+            return
+    async with aclosing(ai_service.astream(human_message=prompt)) as events:
+        async for event in events:
+            yield event
+
+
+def _build_ai_service(task: AIAgentTask, project_theme: ProjectTheme, repository: Repository) -> AIService:
+    try:
+        model = AIModels(task.ai_model)
+    except ValueError:
+        logger.error(f"AI Model:{task.ai_model} for project:{project_theme.id} not found, using default {AIModels.GEMINI_2_0_FLASH.value}")
+        model = AIModels.GEMINI_2_0_FLASH
+
+    return AIService(
+        system_prompt=project_theme.system_prompt,
+        chat_id=_chat_id(project_theme, repository),
+        github_token=repository.github_token,
+        github_username=repository.github_username,
+        github_email=repository.github_email,
+        repo_url=repository.url,
+        model=model
+    )
+
+
+@shared_task(
+    name="run_ai_agent",
+    bind=True,
+    soft_time_limit=settings.AI_AGENT_TIME_LIMIT - TIME_LIMIT_MARGIN,
+    time_limit=settings.AI_AGENT_TIME_LIMIT,
+)
+def run_ai_agent(self, project_theme_id: int, ai_agent_task_id: str = None, claim_token: Optional[str] = None) -> None:
     try:
         project_theme = ProjectTheme.objects.get(id=project_theme_id)
         repository = project_theme.repository
@@ -28,38 +174,157 @@ def run_ai_agent(self, project_theme_id: int, ai_agent_task_id: str = None) -> N
             raise AIAgentTask.DoesNotExist
         if task.status == StatusesAIAgentTask.DONE.value:
             return f"Задача в статусе Done, пропускаем выполнение"
+        if not _start_task(task.id, claim_token):
+            logger.warning(f"AI Agent Task:{task.id} skipped: message with claim {claim_token} is stale")
+            return "Сообщение устарело, задача уже отправлена заново или выполнена"
 
+        # Рабочую копию репозитория и чекпоинты чата меняет только одна задача, другие репозитории - параллельно
+        lease = _lease_for(project_theme, repository)
+        try:
+            lease.acquire()
+        except LeaseBusy as e:
+            logger.warning(f"AI Agent Task:{task.id} postponed: {e}")
+            _return_to_pending(task.id)
+            return "Репозиторий занят другой задачей, задача вернётся в очередь"
 
         try:
-            model = AIModels(task.ai_model)
-        except ValueError:
-            logger.error(f"AI Model:{task.ai_model} for project:{project_theme_id} not found, using default {AIModels.GEMINI_2_0_FLASH.value}")
-            model = AIModels.GEMINI_2_0_FLASH
-
-        ai_service = AIService(
-            system_prompt=project_theme.system_prompt,
-            chat_id=f"{project_theme.name}-{repository.name}",
-            github_token=repository.github_token,
-            github_username=repository.github_username,
-            github_email=repository.github_email,
-            repo_url=repository.url,
-            model=model
-        )
+            ai_service = _build_ai_service(task=task, project_theme=project_theme, repository=repository)
+
+            steps = 0
+            started = time.monotonic()
+            # closing: при остановке стрим графа закрывается (и пишет чекпоинт) до освобождения аренды
+            with closing(_agent_events(ai_service, task.prompt or "Продолжи", retrying=self.request.retries > 0)) as events:
+                for event in events:
+                    steps += 1
+                    if self.request.id:
+                        self.update_state(
+                            state="PROGRESS",
+                            meta={"ai_agent_task_id": task.id, "steps": steps, "event": event["type"], "tool": event.get("tool")},
+                        )
+                    # Отмена и лимит проверяются между шагами: всё, что агент успел сделать, уже в чекпоинте
+                    if reason := _stop_reason(task.id, started):
+                        return _finish_stopped(task.id, claim_token, reason, steps)
+        finally:
+            lease.release()
 
-        ai_service.invoke(human_message=task.prompt or "Продолжи")
-        task.status = StatusesAIAgentTask.DONE.value
-        task.save()
+        _finish_task(task.id, claim_token, StatusesAIAgentTask.DONE.value)
 
     except AIAgentTask.DoesNotExist:
         # Если задача не найдена, завершаем без повтора
         raise Exception(f"run_ai_agent Task:{ai_agent_task_id} for project:{project_theme_id} not found")
     except Exception as e:
         logger.error(f"Exception occurred genegate_ai_code: {e}")
-        # При любой ошибке обновляем статус на ERROR
-        task = AIAgentTask.objects.get(id=ai_agent_task_id)
-        task.status = StatusesAIAgentTask.ERROR.value
-        task.save()
-        # # Инициируем повтор, если не исчерпаны попытки
-        # raise self.retry(exc=e)
+        retries = self.request.retries or 0
+        # Зависший шаг, прерванный по лимиту времени, не повторяем
+        if retries < settings.AI_AGENT_MAX_RETRIES and not isinstance(e, SoftTimeLimitExceeded):
+            # Повтор продолжит с последнего чекпоинта (_agent_events), а не начнёт задачу заново
+            countdown = _retry_countdown(retries)
+            logger.warning(f"AI Agent Task:{ai_agent_task_id} retry {retries + 1}/{settings.AI_AGENT_MAX_RETRIES} in {countdown:.0f}s")
+            _queue_retry(ai_agent_task_id, claim_token, countdown)
+            raise self.retry(exc=e, countdown=countdown, max_retries=settings.AI_AGENT_MAX_RETRIES)
+        # Попытки исчерпаны: обновляем статус на ERROR
+        _finish_task(ai_agent_task_id, claim_token, StatusesAIAgentTask.ERROR.value)
+        raise e
+
+
+async def _run_ai_agent_session(ai_agent_task_id: int, claim_token: Optional[str] = None) -> str:
+    """Одна сессия агента на общем event loop, статусы задачи - как в run_ai_agent"""
+    task = await AIAgentTask.objects.select_related("project_theme__repository").filter(id=ai_agent_task_id).alast()
+    if not task or not task.project_theme:
+        raise Exception(f"run_ai_agents_async Task:{ai_agent_task_id} not found")
+    if task.status == StatusesAIAgentTask.DONE.value:
+        return "Задача в статусе Done, пропускаем выполнение"
+    if not await sync_to_async(_start_task)(task.id, claim_token):
+        logger.warning(f"AI Agent Task:{task.id} skipped: message with claim {claim_token} is stale")
+        return "Сообщение устарело, задача уже отправлена заново или выполнена"
+    lease = _lease_for(task.project_theme, task.project_theme.repository)
+    try:
+        await sync_to_async(lease.acquire, thread_sensitive=False)()
+    except LeaseBusy as e:
+        logger.warning(f"AI Agent Task:{task.id} postponed: {e}")
+        await sync_to_async(_return_to_pending)(task.id)
+        return "Репозиторий занят другой задачей, задача вернётся в очередь"
+    try:
+        # Клонирование репозитория и загрузка todo list блокирующие, выполняем их вне event loop
+        ai_service = await sync_to_async(_build_ai_service, thread_sensitive=False)(
+            task=task, project_theme=task.project_theme, repository=task.project_theme.repository
+        )
+        steps = 0
+        started = time.monotonic()
+        # Зависшая сессия прерывается одна, не дожидаясь лимита всей задачи run_ai_agents_async
+        async with asyncio.timeout(settings.AI_AGENT_TIME_LIMIT - TIME_LIMIT_MARGIN):
+            # Повторы внутри сессии: пауза на event loop не мешает другим сессиям, ход продолжается с чекпоинта
+            for attempt in range(settings.AI_AGENT_MAX_RETRIES + 1):
+                try:
+                    async with aclosing(
+                        _aagent_events(ai_service, task.prompt or "Продолжи", retrying=attempt > 0)
+                    ) as events:
+                        async for event in events:
+                            steps += 1
+                            if reason := await sync_to_async(_stop_reason)(task.id, started):
+                                return await sync_to_async(_finish_stopped)(task.id, claim_token, reason, steps)
+                    break
+                except Exception as e:
+                    if attempt >= settings.AI_AGENT_MAX_RETRIES:
+                        raise
+                    countdown = _retry_countdown(attempt)
+                    logger.warning(f"AI Agent Task:{task.id} error: {e}, retry {attempt + 1}/{settings.AI_AGENT_MAX_RETRIES} in {countdown:.0f}s")
+                    await asyncio.sleep(countdown)
+
+        await sync_to_async(_finish_task)(task.id, claim_token, StatusesAIAgentTask.DONE.value)
+        return f"Выполнено за {steps} шагов"
+    except Exception as e:
+        logger.error(f"Exception occurred run_ai_agents_async Task:{ai_agent_task_id}: {e}")
+        await sync_to_async(_finish_task)(task.id, claim_token, StatusesAIAgentTask.ERROR.value)
         raise e
+    finally:
+        await sync_to_async(lease.release, thread_sensitive=False)()
+
 
+async def _run_ai_agent_sessions(ai_agent_task_ids: list[int], claim_token: Optional[str] = None) -> dict[str, str]:
+    results = await asyncio.gather(
+        *(_run_ai_agent_session(ai_agent_task_id, claim_token) for ai_agent_task_id in ai_agent_task_ids),
+        return_exceptions=True,
+    )
+    return {
+        str(ai_agent_task_id): f"{type(result).__name__}: {result}" if isinstance(result, BaseException) else result
+        for ai_agent_task_id, result in zip(ai_agent_task_ids, results)
+    }
+
+
+@shared_task(
+    name="run_ai_agents_async",
+    soft_time_limit=settings.AI_AGENT_TIME_LIMIT - TIME_LIMIT_MARGIN // 2,
+    time_limit=settings.AI_AGENT_TIME_LIMIT,
+)
+def run_ai_agents_async(ai_agent_task_ids: list[int], claim_token: Optional[str] = None) -> dict[str, str]:
+    """
+    Выполняет несколько задач агента на одном event loop: пока одна сессия ждёт Gemini или GitHub,
+    работают остальные. Ошибка одной сессии не останавливает другие.
+    """
+    return asyncio.run(_run_ai_agent_sessions(ai_agent_task_ids, claim_token))
+
+
+@shared_task(name="compact_ai_state")
+def compact_ai_state() -> dict:
+    """Удаляет чекпоинты вне политики хранения и неиспользуемые версии каналов, по порции тредов за запуск"""
+    keep_last = settings.CHECKPOINT_RETENTION_KEEP_LAST
+    keep_days = settings.CHECKPOINT_RETENTION_KEEP_DAYS
+    checkpointer = DjangoCheckpointSaver()
+    threads = checkpointer.threads_to_prune(
+        keep_last=keep_last,
+        keep_days=keep_days,
+        limit=settings.CHECKPOINT_COMPACTION_BATCH,
+    )
+    total = {"threads": len(threads), "checkpoints": 0, "writes": 0, "blobs": 0}
+    for thread_id, checkpoint_ns in threads:
+        deleted = checkpointer.prune(
+            thread_id=thread_id,
+            checkpoint_ns=checkpoint_ns,
+            keep_last=keep_last,
+            keep_days=keep_days,
+        )
+        for key, value in deleted.items():
+            total[key] += value
+    logger.info(f"compact_ai_state: {total}")
+    return total
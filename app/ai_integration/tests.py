@@ -1,3 +1,1619 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import pickle
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from github import GithubException
+from google.api_core.exceptions import ResourceExhausted
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage, ToolMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+from pydantic import Field
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.graph.message import REMOVE_ALL_MESSAGES, add_messages
+
+from ai_integration.ai_service import AIService
+from ai_integration.helpers.agent_helper import AIAutomation
+from ai_integration.helpers.ai_agent import LLMAgent
+from ai_integration.helpers.db_dict_factory import DjangoDBDict
+from ai_integration.helpers.django_checkpointer import DjangoCheckpointSaver
+from ai_integration.helpers.message_trimmer import MessageTrimmer
+from ai_integration.helpers.summarizer import SUMMARY_PROMPT
+from ai_integration.helpers import project_tree
+from ai_integration.helpers import state_serializer
+from ai_integration.helpers.state_serializer import CompressedSerializer, StateSerializer
+from ai_integration.helpers import code_search
+from ai_integration.helpers.code_search import CodeSearchIndex, literal_prefilter, required_trigrams, scan, search_files
+from ai_integration.helpers import symbol_index
+from ai_integration.helpers.symbol_index import Symbol, SymbolIndex, parse_symbols
+from ai_integration.helpers.lease import Lease, LeaseBusy, LocalLeaseBackend, RedisLeaseBackend
+from ai_integration.helpers.tool_executor import OrderedToolNode
+from ai_integration.models import AIAgentTask, AIStateBlobs, AIStateDefault, AIStateStorage, AIStateWrites, StatusesAIAgentTask
+from ai_integration import tasks as agent_tasks
+from ai_integration.tasks import _run_ai_agent_session, compact_ai_state, run_ai_agent
+from github_integration.models import ProjectTheme, Repository
+from ai_integration.helpers.rate_limit import (
+    AIMDPolicy,
+    CallWindow,
+    LocalQuotaBackend,
+    QuotaRateLimiter,
+    QuotaState,
+    RateLimiter,
+    RedisQuotaBackend,
+    TokenBucket,
+    ToolCategory,
+    quota_scope,
+    rate_limited_tool,
+    rate_limited_tools_per_minute,
+    throttle_delay,
+)
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(SimpleTestCase):
+    def test_concurrent_callers_get_distinct_slots(self):
+        bucket = TokenBucket(rate_per_minute=60, capacity=1, clock=FakeClock())
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            waits = list(executor.map(lambda _: bucket.reserve(), range(10)))
+        self.assertEqual(sorted(waits), [float(i) for i in range(10)])
+
+    def test_refill_is_capped_by_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate_per_minute=60, capacity=3, clock=clock)
+        bucket.reserve()
+        clock.now = 100
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0.0, 0.0, 0.0, 1.0])
+
+    def test_unlimited_bucket_never_waits(self):
+        bucket = TokenBucket(rate_per_minute=None, clock=FakeClock())
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            waits = list(executor.map(lambda _: bucket.reserve(), range(100)))
+        self.assertEqual(set(waits), {0.0})
+        self.assertEqual(bucket.calls_in_window(), 100)
+
+
+class CallWindowTest(SimpleTestCase):
+    def test_old_calls_leave_window(self):
+        window = CallWindow(window=60)
+        window.add(0)
+        window.add(10)
+        self.assertEqual(window.add(70), 1)
+        self.assertEqual(len(window.calls), 1)
+
+
+def limits(per_minute: int) -> dict:
+    return {ToolCategory.LOCAL: None, ToolCategory.GIT: per_minute, ToolCategory.GITHUB: per_minute}
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_categories_are_metered_separately(self):
+        limiter = RateLimiter(limits(60), backend=LocalQuotaBackend(clock=FakeClock()))
+        self.assertEqual(limiter._reserve(ToolCategory.GIT), 0.0)
+        self.assertEqual(limiter._reserve(ToolCategory.GITHUB), 0.0)
+        self.assertEqual(limiter._reserve(ToolCategory.GIT), 1.0)
+        self.assertEqual(limiter._reserve(ToolCategory.LOCAL), 0.0)
+
+    def test_slow_call_does_not_block_other_callers(self):
+        started, release = threading.Event(), threading.Event()
+
+        @rate_limited_tools_per_minute
+        def slow():
+            started.set()
+            release.wait(5)
+
+        @rate_limited_tools_per_minute
+        def fast():
+            return "done"
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            slow_future = executor.submit(slow)
+            self.assertTrue(started.wait(5))
+            self.assertEqual(executor.submit(fast).result(timeout=1), "done")
+            self.assertFalse(slow_future.done())
+            release.set()
+            slow_future.result(timeout=5)
+
+    def test_async_callers_are_spaced_by_rate(self):
+        limiter = RateLimiter(limits(600))
+
+        async def acquire_all():
+            await asyncio.gather(*(limiter.aacquire(ToolCategory.GITHUB) for _ in range(4)))
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        # 600 вызовов в минуту - один раз в 0.1 с, первый без ожидания
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+    def test_quota_is_per_scope(self):
+        limiter = RateLimiter(limits(60), backend=LocalQuotaBackend(clock=FakeClock()))
+
+        def reserve(scope: str) -> float:
+            with quota_scope(scope):
+                return limiter._reserve(ToolCategory.GITHUB)
+
+        waits = [reserve(scope) for scope in ("a", "b", "a")]
+        self.assertEqual(waits, [0.0, 0.0, 1.0])
+        # После блока снова лимит по умолчанию, а не последнего токена
+        self.assertEqual(limiter._reserve(ToolCategory.GITHUB), 0.0)
+
+
+class QuotaRateLimiterTest(SimpleTestCase):
+    def test_non_blocking_acquire_does_not_take_token(self):
+        limiter = QuotaRateLimiter("gemini:test", 60, backend=LocalQuotaBackend(clock=FakeClock()))
+        self.assertTrue(limiter.acquire(blocking=False))
+        self.assertFalse(limiter.acquire(blocking=False))
+        self.assertEqual(limiter.backend.buckets["gemini:test"].tokens, 0)
+
+
+class AdaptiveRateTest(SimpleTestCase):
+    def setUp(self):
+        self.backend = LocalQuotaBackend(clock=FakeClock())
+        self.limiter = RateLimiter(
+            limits(60),
+            backend=self.backend,
+            policies={ToolCategory.GITHUB: AIMDPolicy(min_rate=10, max_rate=120)},
+        )
+
+    def learned_rate(self) -> float:
+        return self.backend.rates[f"{ToolCategory.GITHUB.value}:default"]
+
+    def test_throttle_halves_rate_and_blocks_key(self):
+        self.limiter.report(ToolCategory.GITHUB, throttled_for=30)
+        self.assertEqual(self.learned_rate(), 30)
+        self.assertAlmostEqual(self.limiter._reserve(ToolCategory.GITHUB), 30)
+
+    def test_success_increases_rate_additively(self):
+        for _ in range(60):
+            self.limiter.report(ToolCategory.GITHUB)
+        self.assertAlmostEqual(self.learned_rate(), 61, delta=0.1)
+
+    def test_rate_follows_remaining_quota(self):
+        self.limiter.report(ToolCategory.GITHUB, quota=QuotaState(remaining=20, reset_in=120))
+        self.assertEqual(self.learned_rate(), 10)
+        self.limiter.report(ToolCategory.GITHUB, quota=QuotaState(remaining=0, reset_in=45))
+        self.assertAlmostEqual(self.limiter._reserve(ToolCategory.GITHUB), 45)
+
+    def test_fixed_categories_are_not_adjusted(self):
+        self.limiter.report(ToolCategory.GIT, throttled_for=30)
+        self.assertEqual(self.backend.rates, {})
+
+    def test_throttle_delay_from_errors(self):
+        self.assertEqual(throttle_delay(GithubException(429, headers={"Retry-After": "12"})), 12)
+        self.assertEqual(throttle_delay(GithubException(403, headers={"x-ratelimit-remaining": "0", "x-ratelimit-reset": "0"})), 0)
+        self.assertIsNone(throttle_delay(GithubException(403, headers={"x-ratelimit-remaining": "10"})))
+        error = ResourceExhausted("Quota exceeded [retry_delay {\n  seconds: 17\n}\n]")
+        self.assertEqual(throttle_delay(error), 17)
+        self.assertIsNone(throttle_delay(ValueError("boom")))
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class RedisQuotaBackendTest(SimpleTestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def backend(self) -> RedisQuotaBackend:
+        return RedisQuotaBackend(fakeredis.FakeRedis(server=self.server))
+
+    def test_quota_is_shared_between_workers(self):
+        # Два backend с отдельными клиентами - как два процесса Celery с одним Redis
+        first, second = self.backend(), self.backend()
+        self.assertEqual(first.reserve("gemini:model:key", 60), 0.0)
+        self.assertAlmostEqual(second.reserve("gemini:model:key", 60), 1.0, delta=0.05)
+        self.assertEqual(second.reserve("gemini:other-model:key", 60), 0.0)
+
+    def test_concurrent_callers_get_distinct_slots(self):
+        backend = self.backend()
+        # Время Redis (TIME в fakeredis) остановлено: ожидания не зависят от того, как потоки делят процессор
+        with mock.patch("time.time", return_value=1_700_000_000.0), ThreadPoolExecutor(max_workers=8) as executor:
+            waits = list(executor.map(lambda _: backend.reserve("github:key", 600, capacity=2), range(8)))
+        self.assertEqual(sorted(round(wait, 1) for wait in waits), [0.0, 0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+
+    def test_learned_rate_is_shared_between_workers(self):
+        first, second = self.backend(), self.backend()
+        policy = AIMDPolicy(min_rate=10, max_rate=120)
+        self.assertEqual(first.adjust("gemini:model:key", 60, policy, throttled_for=2), 30)
+        # Второй воркер видит и уменьшенный лимит, и блокировку ключа
+        self.assertAlmostEqual(second.reserve("gemini:model:key", 60), 2, delta=0.05)
+        self.assertAlmostEqual(second.reserve("gemini:model:key", 60), 4, delta=0.05)
+        self.assertAlmostEqual(second.adjust("gemini:model:key", 60, policy), 30 + 1 / 30, delta=0.001)
+
+    def test_falls_back_to_local_limit_without_redis(self):
+        backend = RedisQuotaBackend.from_url("redis://127.0.0.1:1/0")
+        backend.fallback = LocalQuotaBackend(clock=FakeClock())
+        self.assertEqual([backend.reserve("git:key", 60) for _ in range(2)], [0.0, 1.0])
+
+
+class LeaseTest(SimpleTestCase):
+    def test_same_repository_is_exclusive(self):
+        backend = LocalLeaseBackend()
+        with Lease(["repo:1", "chat:a"], ttl=60, backend=backend):
+            with self.assertRaises(LeaseBusy):
+                Lease(["chat:b", "repo:1"], ttl=60, backend=backend).acquire()
+            # Неудачный захват отпускает уже взятые ключи
+            self.assertNotIn("chat:b", backend.leases)
+            with Lease(["repo:2", "chat:b"], ttl=60, backend=backend):
+                pass
+        with Lease(["repo:1", "chat:a"], ttl=60, backend=backend):
+            pass
+
+    def test_expired_lease_can_be_taken(self):
+        clock = FakeClock()
+        backend = LocalLeaseBackend(clock=clock)
+        self.assertTrue(backend.acquire("repo:1", "worker-1", ttl=60))
+        clock.now = 61
+        self.assertTrue(backend.acquire("repo:1", "worker-2", ttl=60))
+        # Упавший воркер не может продлить или снять чужую аренду
+        self.assertFalse(backend.renew("repo:1", "worker-1", ttl=60))
+        self.assertFalse(backend.release("repo:1", "worker-1"))
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_lease_is_shared_between_workers(self):
+        server = fakeredis.FakeServer()
+        first = RedisLeaseBackend(fakeredis.FakeRedis(server=server))
+        second = RedisLeaseBackend(fakeredis.FakeRedis(server=server))
+        with Lease(["repo:1"], ttl=60, backend=first):
+            with self.assertRaises(LeaseBusy):
+                Lease(["repo:1"], ttl=60, backend=second).acquire()
+        with Lease(["repo:1"], ttl=60, backend=second):
+            pass
+
+
+def tool_turn(*calls) -> dict:
+    return {"messages": [AIMessage(content="", tool_calls=[
+        {"name": name, "args": args, "id": call_id} for call_id, name, args in calls
+    ])]}
+
+
+class OrderedToolNodeTest(SimpleTestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(limits(6000))
+        rate_limiter_patch = mock.patch("ai_integration.helpers.rate_limit.rate_limiter", self.limiter)
+        rate_limiter_patch.start()
+        self.addCleanup(rate_limiter_patch.stop)
+        self.events = []
+        events_lock = threading.Lock()
+        # Вызовы с wait=True ждут друг друга: по одному они не завершатся
+        self.barrier = threading.Barrier(2, timeout=5)
+
+        def log(event: str):
+            with events_lock:
+                self.events.append(event)
+
+        @rate_limited_tool(category=ToolCategory.GITHUB, read_only=True)
+        def read(path: str, wait: bool = False, delay: float = 0.0) -> str:
+            """read"""
+            log(f"start {path}")
+            if wait:
+                self.barrier.wait()
+            time.sleep(delay)
+            log(f"end {path}")
+            return path
+
+        @rate_limited_tool(category=ToolCategory.GITHUB)
+        def write(path: str) -> str:
+            """write"""
+            log(f"write {path}")
+            return f"written {path}"
+
+        self.node = OrderedToolNode([read, write])
+
+    def run_node(self, asynchronous: bool, *calls) -> list:
+        self.events.clear()
+        self.barrier.reset()
+        turn = tool_turn(*calls)
+        result = asyncio.run(self.node.ainvoke(turn)) if asynchronous else self.node.invoke(turn)
+        return result["messages"]
+
+    def test_read_only_calls_run_concurrently(self):
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                messages = self.run_node(
+                    asynchronous,
+                    ("call-1", "read", {"path": "a.py", "wait": True}),
+                    ("call-2", "read", {"path": "b.py", "wait": True}),
+                )
+                self.assertEqual([message.content for message in messages], ["a.py", "b.py"])
+
+    def test_mutating_call_runs_between_groups(self):
+        calls = [
+            ("call-1", "read", {"path": "a.py", "delay": 0.05}),
+            ("call-2", "read", {"path": "b.py"}),
+            ("call-3", "write", {"path": "c.py"}),
+            ("call-4", "read", {"path": "d.py"}),
+            ("call-5", "write", {"path": "e.py"}),
+        ]
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                messages = self.run_node(asynchronous, *calls)
+                write = self.events.index("write c.py")
+                self.assertEqual(set(self.events[:write]), {"start a.py", "end a.py", "start b.py", "end b.py"})
+                self.assertEqual(self.events[write + 1:], ["start d.py", "end d.py", "write e.py"])
+                self.assertEqual([message.tool_call_id for message in messages], [call[0] for call in calls])
+
+    def test_outputs_keep_call_order(self):
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                # Первый вызов заканчивается последним
+                messages = self.run_node(
+                    asynchronous,
+                    ("call-1", "read", {"path": "a.py", "delay": 0.2}),
+                    ("call-2", "read", {"path": "b.py"}),
+                    ("call-3", "read", {"path": "c.py"}),
+                )
+                self.assertEqual(self.events[-1], "end a.py")
+                self.assertEqual([message.tool_call_id for message in messages], ["call-1", "call-2", "call-3"])
+                self.assertEqual([message.content for message in messages], ["a.py", "b.py", "c.py"])
+
+    def test_each_parallel_call_takes_a_token(self):
+        calls = [(f"call-{i}", "read", {"path": f"{i}.py"}) for i in range(3)]
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                with mock.patch.object(self.limiter.backend, "reserve", wraps=self.limiter.backend.reserve) as reserve:
+                    self.run_node(asynchronous, *calls)
+                self.assertEqual(reserve.call_count, 3)
+
+
+class OrderedToolNodeResumeTest(SimpleTestCase):
+    def setUp(self):
+        self.pushes = []
+
+        @rate_limited_tool(side_effect=True)
+        def push(branch: str) -> str:
+            """push"""
+            self.pushes.append(branch)
+            return f"pushed {branch} #{len(self.pushes)}"
+
+        @rate_limited_tool(read_only=True)
+        def read(path: str) -> str:
+            """read"""
+            return path
+
+        self.tools = [push, read]
+
+    def test_side_effect_call_is_not_repeated_on_resume(self):
+        tool_results = {}
+        turn = tool_turn(("call-1", "push", {"branch": "feature"}), ("call-2", "read", {"path": "a.py"}))
+        first = OrderedToolNode(self.tools, tool_results=tool_results).invoke(turn)
+        # Узел выполняется заново после падения воркера: push с тем же tool_call_id не повторяется
+        second = OrderedToolNode(self.tools, tool_results=tool_results).invoke(turn)
+        self.assertEqual(self.pushes, ["feature"])
+        self.assertEqual(
+            [message.content for message in first["messages"]],
+            [message.content for message in second["messages"]],
+        )
+        self.assertEqual(list(tool_results), ["call-1"])
+
+    def test_new_call_runs_and_results_are_bounded(self):
+        tool_results = {}
+        node = OrderedToolNode(self.tools, tool_results=tool_results, max_tool_results=2)
+        for i in range(3):
+            node.invoke(tool_turn((f"call-{i}", "push", {"branch": "feature"})))
+        self.assertEqual(len(self.pushes), 3)
+        self.assertEqual(list(tool_results), ["call-1", "call-2"])
+
+
+class SessionToolTest(SimpleTestCase):
+    @staticmethod
+    def session(repo_path: str, token: str) -> AIAutomation:
+        # Без клонирования и GitHub: инструментам файлов нужны только repo_path и todo list
+        automation = AIAutomation.__new__(AIAutomation)
+        automation.repo_path = repo_path
+        automation.quota_scope = token
+        automation.todo_list_storage = {}
+        return automation
+
+    def test_tools_are_bound_to_their_session(self):
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir:
+            first, second = self.session(first_dir, "first"), self.session(second_dir, "second")
+            self.assertIs(first.read_file, first.read_file)
+            self.assertIsNot(first.read_file, second.read_file)
+            self.assertNotIn("self", first.read_file.args)
+
+            first.update_file.invoke({"path": "a.txt", "data": "first"})
+            second.update_file.invoke({"path": "a.txt", "data": "second"})
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(
+                    lambda automation: automation.read_file.invoke({"path": "a.txt"}), [first, second] * 4
+                ))
+            self.assertEqual(results, ["first", "second"] * 4)
+
+    def test_async_sessions_do_not_share_state(self):
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir:
+            sessions = [self.session(first_dir, "first"), self.session(second_dir, "second")]
+
+            async def plan(automation: AIAutomation, name: str):
+                await automation.update_todo_list.ainvoke({"tasks": {"task": name}})
+                await asyncio.sleep(0)
+                return await automation.get_todo_list.ainvoke({})
+
+            async def main():
+                return await asyncio.gather(*[plan(automation, f"task-{i}") for i, automation in enumerate(sessions)])
+
+            results = asyncio.run(main())
+            self.assertEqual(results, [{"task": "task-0"}, {"task": "task-1"}])
+
+
+class ProjectTreeIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.repo = tempfile.TemporaryDirectory()
+        self.addCleanup(self.repo.cleanup)
+        subprocess.run(["git", "init", "-q", self.repo.name], check=True)
+        for path in ["src/app.py", "src/utils.py", "node_modules/lib/index.js", "build.log", ".venv/bin/python", "README.md"]:
+            self.write(path)
+        self.write(".gitignore", "node_modules/\n*.log\n")
+
+    def write(self, path: str, data: str = ""):
+        full_path = os.path.join(self.repo.name, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as file:
+            file.write(data)
+
+    def test_gitignore_and_excludes_are_skipped(self):
+        tree = project_tree.ProjectTreeIndex(self.repo.name).render()
+        self.assertEqual(tree, ".gitignore\nREADME.md\nsrc\n    app.py\n    utils.py\n".replace(
+            ".gitignore\nREADME.md\nsrc\n    ", "├── .gitignore\n├── README.md\n└── src\n    ├── "
+        ).replace("    utils.py", "    └── utils.py"))
+
+    def test_unchanged_tree_is_served_from_cache(self):
+        index = project_tree.ProjectTreeIndex(self.repo.name)
+        first = index.render()
+        with mock.patch.object(project_tree.os, "scandir", wraps=os.scandir) as scandir, \
+                mock.patch.object(project_tree.subprocess, "run", wraps=subprocess.run) as run:
+            self.assertEqual(index.render(), first)
+            scandir.assert_not_called()
+            run.assert_not_called()
+            self.write("src/new.py")
+            self.assertIn("new.py", index.render())
+            self.assertEqual(scandir.call_count, 1)
+
+    def test_edited_gitignore_is_applied(self):
+        index = project_tree.ProjectTreeIndex(self.repo.name)
+        self.assertIn("src", index.render())
+        # Файл перезаписывается на месте: mtime корневой директории не меняется
+        self.write(".gitignore", "node_modules/\n*.log\nsrc/\n")
+        self.assertNotIn("src", index.render())
+        self.write(".gitignore", "node_modules/\n")
+        tree = index.render()
+        self.assertIn("src", tree)
+        self.assertIn("build.log", tree)
+
+    def test_output_is_capped(self):
+        for i in range(10):
+            self.write(f"data/{i:02}.csv")
+        tree = project_tree.ProjectTreeIndex(self.repo.name, max_dir_entries=3).render("data")
+        self.assertEqual(tree, "├── 00.csv\n├── 01.csv\n├── 02.csv\n└── … ещё 7 записей\n")
+        tree = project_tree.ProjectTreeIndex(self.repo.name, max_lines=4).render()
+        self.assertTrue(tree.endswith("не показано, уменьшите max_depth или укажите root_path\n"), tree)
+
+
+class CodeSearchIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.repo = tempfile.TemporaryDirectory()
+        self.addCleanup(self.repo.cleanup)
+        self.git("init", "-q")
+        self.write("app/models.py", "class User:\n    name = 'user'\n\n\ndef load_user(user_id):\n    return User()\n")
+        self.write("app/views.py", "from app.models import load_user\n\n\ndef index(request):\n    return load_user(1)\n")
+        self.write("app/data.bin", "load_user\0binary")
+        self.write("build/out.py", "load_user = None\n")
+        self.write(".gitignore", "build/\n")
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "init")
+
+    def git(self, *args: str):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=self.repo.name, check=True)
+
+    def write(self, path: str, data: str):
+        full_path = os.path.join(self.repo.name, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as file:
+            file.write(data)
+
+    def test_required_trigrams(self):
+        self.assertEqual(required_trigrams("load_user"), [{"loa", "oad", "ad_", "d_u", "_us", "use", "ser"}])
+        self.assertEqual(required_trigrams(r"def \w+\(req"), [{"def", "ef ", "(re", "req"}])
+        self.assertEqual(len(required_trigrams("(User|Group)Admin")), 2)
+        self.assertIsNone(required_trigrams(r"load|\w+"))
+        self.assertIsNone(required_trigrams(r"a.b"))
+
+    def test_search_uses_index_and_skips_ignored_and_binary_files(self):
+        index = CodeSearchIndex(self.repo.name)
+        self.assertEqual(index.candidates("class User"), ["app/models.py"])
+        self.assertEqual(
+            index.search(r"load_user\(", extensions=[".py", ".bin"]),
+            ["app/models.py:5: def load_user(user_id):", "app/views.py:5: return load_user(1)"],
+        )
+
+    def test_limits_and_context(self):
+        index = CodeSearchIndex(self.repo.name)
+        results = index.search("load_user", max_results=1)
+        self.assertEqual(results[0], "app/models.py:5: def load_user(user_id):")
+        self.assertTrue(results[-1].startswith("… поиск остановлен на 1 совпадениях"))
+        self.assertEqual(index.search("return User", context_lines=1), [
+            "app/models.py-5- def load_user(user_id):",
+            "app/models.py:6: return User()",
+        ])
+
+    def test_index_follows_tool_writes_and_git(self):
+        index = CodeSearchIndex(self.repo.name)
+        self.assertEqual(index.search("logout"), [])
+        self.write("app/auth.py", "def logout():\n    pass\n")
+        index.notify_changed(["app/auth.py"])
+        self.assertEqual(index.search("logout"), ["app/auth.py:1: def logout():"])
+
+        index.save()
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "auth")
+        self.git("checkout", "-q", "HEAD~1")
+        # Новый процесс: индекс с диска догоняет рабочую копию по git
+        loaded = CodeSearchIndex.load(self.repo.name)
+        self.assertEqual(loaded.search("logout"), [])
+        self.assertEqual(loaded.search("class User"), ["app/models.py:1: class User:"])
+
+    def test_scan_without_index(self):
+        self.assertEqual(
+            scan(self.repo.name, r"load_user\(", extensions=[".py", ".bin"]),
+            ["app/models.py:5: def load_user(user_id):", "app/views.py:5: return load_user(1)"],
+        )
+        self.assertEqual(scan(self.repo.name, "load_user", directory="../"), [])
+        self.assertFalse(CodeSearchIndex.exists(self.repo.name))
+
+    def test_literal_prefilter(self):
+        self.assertEqual(literal_prefilter(r"(User|Group)Admin\(").pattern, b"Admin\\(")
+        self.assertEqual(literal_prefilter(r"load_(user|group_admin)").pattern, b"group_admin|load_")
+        self.assertIsNone(literal_prefilter(r"(?i)load_user"))
+        self.assertIsNone(literal_prefilter(r"\w+"))
+
+    def test_large_files_are_mapped_and_always_candidates(self):
+        self.write("app/big.py", "x = 1\n" * 1000 + "load_user()\n")
+        with mock.patch.object(code_search, "MAX_FILE_SIZE", 1024), mock.patch.object(code_search, "MMAP_THRESHOLD", 1024):
+            index = CodeSearchIndex(self.repo.name)
+            self.assertIn("app/big.py", index.candidates("anything"))
+            self.assertEqual(index.search(r"^load_user\(\)", directory="app"), ["app/big.py:1001: load_user()"])
+
+    def test_parallel_search_matches_sequential(self):
+        for i in range(40):
+            self.write(f"pkg/module_{i:02}.py", f"def handler_{i}():\n    return {i}\n")
+        paths = code_search.list_files(self.repo.name, "pkg")
+        sequential = search_files(self.repo.name, paths, r"return \d+", max_results=100, context_lines=1)
+        with mock.patch.object(code_search, "PARALLEL_MIN_FILES", 2):
+            self.assertEqual(
+                search_files(self.repo.name, paths, r"return \d+", max_results=100, context_lines=1, workers=2),
+                sequential,
+            )
+            limited = search_files(self.repo.name, paths, r"return \d+", max_results=5, workers=2)
+        self.assertEqual(limited[:5], [line for line in sequential if ":2: " in line][:5])
+        self.assertTrue(limited[5].startswith("… поиск остановлен на 5 совпадениях"))
+
+    def test_parallel_search_in_daemonic_process(self):
+        # Воркер Celery - демонический дочерний процесс prefork пула: пул поиска должен запускаться и в нём
+        for i in range(40):
+            self.write(f"pkg/module_{i:02}.py", f"def handler_{i}():\n    return {i}\n")
+        paths = code_search.list_files(self.repo.name, "pkg")
+        sequential = search_files(self.repo.name, paths, r"return \d+")
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+
+        def search():
+            with (
+                mock.patch.object(code_search, "PARALLEL_MIN_FILES", 2),
+                mock.patch.object(code_search, "_pool", None),
+                mock.patch.object(code_search, "_pool_unavailable", False),
+                mock.patch.object(code_search, "_pool_failed") as pool_failed,
+            ):
+                results = search_files(self.repo.name, paths, r"return \d+", workers=2)
+                pool = code_search._pool
+                queue.put((results, pool is not None, pool_failed.called))
+                if pool is not None:
+                    pool.terminate()
+
+        process = context.Process(target=search, daemon=True)
+        process.start()
+        results, pool_started, pool_failed = queue.get(timeout=60)
+        process.join(timeout=10)
+        self.assertTrue(pool_started)
+        self.assertFalse(pool_failed)
+        self.assertEqual(results, sequential)
+
+
+class SymbolIndexTest(SimpleTestCase):
+    SOURCE = (
+        "import typing\n"
+        "\n"
+        "class Repo(Base, metaclass=Meta):\n"
+        "    def load(self, path: str = '.') -> 'Repo':\n"
+        "        def helper():\n"
+        "            pass\n"
+        "        return self\n"
+        "\n"
+        "    async def fetch(self, *urls):\n"
+        "        pass\n"
+        "\n"
+        "if typing.TYPE_CHECKING:\n"
+        "    async def connect(url) -> None:\n"
+        "        pass\n"
+    )
+
+    def setUp(self):
+        self.repo = tempfile.TemporaryDirectory()
+        self.addCleanup(self.repo.cleanup)
+        subprocess.run(["git", "init", "-q"], cwd=self.repo.name, check=True)
+        self.write("app/repo.py", self.SOURCE)
+        self.write("app/broken.py", "def broken(:\n")
+
+    def write(self, path: str, data: str):
+        full_path = os.path.join(self.repo.name, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as file:
+            file.write(data)
+
+    def test_parse_symbols(self):
+        self.assertEqual(parse_symbols(self.SOURCE.encode()), [
+            Symbol("class", "Repo", "(Base, metaclass=Meta)", 3, 10, False),
+            Symbol("def", "Repo.load", "(self, path: str='.') -> 'Repo'", 4, 7, True),
+            Symbol("def", "Repo.load.helper", "()", 5, 6, False),
+            Symbol("async def", "Repo.fetch", "(self, *urls)", 9, 10, True),
+            Symbol("async def", "connect", "(url) -> None", 13, 14, False),
+        ])
+        self.assertEqual(parse_symbols(b"def broken(:\n"), [])
+
+    def test_files_are_parsed_once(self):
+        with mock.patch.object(symbol_index, "parse_symbols", wraps=parse_symbols) as parse:
+            index = SymbolIndex(self.repo.name)
+            index.symbols("app/repo.py")
+            index.symbols("./app/repo.py")
+            self.assertEqual(parse.call_count, 1)
+            self.assertEqual([path for path, _ in index.find("fetch")], ["app/repo.py"])
+            self.assertEqual(parse.call_count, 2)
+
+            # Новый процесс: индекс с диска, touch без изменения содержимого не разбирает файл заново
+            index.save()
+            loaded = SymbolIndex.load(self.repo.name)
+            os.utime(os.path.join(self.repo.name, "app/repo.py"), ns=(1, 1))
+            self.assertEqual(len(loaded.symbols("app/repo.py")), 5)
+            self.assertEqual(parse.call_count, 2)
+
+            self.write("app/repo.py", "def load():\n    pass\n")
+            self.assertEqual(loaded.find("load"), [("app/repo.py", Symbol("def", "load", "()", 1, 2, False))])
+            self.assertEqual(parse.call_count, 3)
+        with self.assertRaises(ValueError):
+            loaded.symbols("../outside.py")
+
+    def test_tools(self):
+        automation = SessionToolTest.session(self.repo.name, "token")
+        self.assertEqual(automation.get_function_defs.invoke({"path": "app/repo.py"})[-1], "async def connect(url) -> None (lines 13-14)")
+        self.assertEqual(
+            automation.get_class_structure.invoke({"path": "app/repo.py"}),
+            ["Class Repo(Base, metaclass=Meta) (lines 3-10): methods: ['load', 'fetch']"],
+        )
+        self.assertEqual(
+            automation.find_symbol.invoke({"name": "Repo.load"}),
+            ["app/repo.py:4: def Repo.load(self, path: str='.') -> 'Repo' (lines 4-7)"],
+        )
+        self.assertEqual(len(automation.list_symbols.invoke({"directory": "app"})), 4)
+        self.assertEqual(automation.list_symbols.invoke({"directory": "app", "max_results": 1})[-1], "… ещё 3 символов, укажите directory")
+
+
+@skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is SQLite specific")
+class AIAgentTaskQueryPlanTest(TestCase):
+    """Горячие запросы планировщика должны идти по индексам, а не полным перебором таблицы задач"""
+
+    def query_plan(self, queryset) -> list[str]:
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[3] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset, index_name: str):
+        plan = self.query_plan(queryset)
+        table = AIAgentTask._meta.db_table
+        self.assertFalse([step for step in plan if step.startswith(f"SCAN {table}") and "INDEX" not in step], plan)
+        self.assertTrue([step for step in plan if index_name in step], plan)
+
+    def test_polling_uses_status_time_index(self):
+        now = timezone.now()
+        self.assertUsesIndex(AIAgentTask.due(now).values("id")[:200], "aiagenttask_status_time_idx")
+        claim = AIAgentTask.objects.filter(
+            id__in=AIAgentTask.due(now).values("id")[:200],
+            status=StatusesAIAgentTask.PENDING.value,
+            scheduled_time__lte=now,
+        )
+        self.assertUsesIndex(claim, "aiagenttask_status_time_idx")
+
+    def test_planning_counts_use_time_range(self):
+        now = timezone.now()
+        self.assertUsesIndex(AIAgentTask.scheduled_counts(now, now + timedelta(days=2)), "aiagenttask_planning_idx")
+
+
+class MessageTrimmerTest(SimpleTestCase):
+    @staticmethod
+    def turn(i: int, size: int = 200) -> list:
+        return [
+            HumanMessage(content=f"задача {i}", id=f"human-{i}"),
+            AIMessage(content="", tool_calls=[{"name": "read_file", "args": {"n": i}, "id": f"call-{i}"}], id=f"ai-{i}"),
+            ToolMessage(content="x" * size, tool_call_id=f"call-{i}", id=f"tool-{i}"),
+        ]
+
+    def assertTrimmed(self, trimmer: MessageTrimmer, messages: list):
+        expected = trim_messages(
+            messages,
+            strategy="last",
+            token_counter=count_tokens_approximately,
+            max_tokens=trimmer.max_tokens,
+            start_on="human",
+            end_on=("human", "tool"),
+            include_system=True,
+        )
+        self.assertEqual([message.id for message in trimmer.trim(messages)], [message.id for message in expected])
+
+    def test_sliding_window_matches_trim_messages(self):
+        trimmer = MessageTrimmer(max_tokens=500)
+        messages = []
+        for i in range(30):
+            messages.extend(self.turn(i, size=100 + 37 * i % 300))
+            self.assertTrimmed(trimmer, messages)
+            if i % 5 == 4:
+                # Ответ модели в конце хода в окно не попадает (end_on)
+                messages.append(AIMessage(content=f"готово {i}", id=f"answer-{i}"))
+                self.assertTrimmed(trimmer, messages)
+            if i % 7 == 6:
+                # Начало истории удалено из state (RemoveMessage в pre_model_hook)
+                del messages[:6]
+                self.assertTrimmed(trimmer, messages)
+
+    def test_system_message_is_kept_and_counted(self):
+        system = SystemMessage(content="правила " * 100, id="system")
+        messages = [system, *(message for i in range(5) for message in self.turn(i))]
+        trimmer = MessageTrimmer(max_tokens=400)
+        result = trimmer.trim(messages)
+        self.assertIs(result[0], system)
+        self.assertLess(len(result), len(messages))
+        self.assertLessEqual(count_tokens_approximately(result), 400)
+        self.assertTrimmed(MessageTrimmer(max_tokens=400), messages)
+
+    def test_tool_message_is_not_separated_from_its_call(self):
+        messages = [*self.turn(0), *self.turn(1), AIMessage(content="готово", id="answer")]
+        # В бюджет влезает результат первого вызова без самого вызова: окно начинается со следующей задачи
+        trimmer = MessageTrimmer(max_tokens=count_tokens_approximately(messages[2:6]))
+        self.assertEqual([message.id for message in trimmer.trim(messages)], ["human-1", "ai-1", "tool-1"])
+        self.assertTrimmed(MessageTrimmer(max_tokens=trimmer.max_tokens), messages)
+
+    def test_forget_and_replaced_message(self):
+        trimmer = MessageTrimmer(max_tokens=1000)
+        messages = [*self.turn(0), *self.turn(1)]
+        self.assertTrimmed(trimmer, messages)
+        trimmer.forget(["human-0", "ai-0", "tool-0"])
+        self.assertEqual(set(trimmer._counts), {"human-1", "ai-1", "tool-1"})
+        del messages[:3]
+        self.assertTrimmed(trimmer, messages)
+        # Сообщение заменено с тем же id (add_messages): после forget токены и окно считаются заново
+        for size in (8000, 200):
+            messages[2] = ToolMessage(content="x" * size, tool_call_id="call-1", id="tool-1")
+            trimmer.forget(["tool-1"])
+            self.assertTrimmed(trimmer, messages)
+
+
+class FakeReActModel(BaseChatModel):
+    """Модель ReAct цикла: steps раз вызывает read_chunk, затем отвечает текстом; запросы сводки отдельно"""
+    steps: int = 25
+    # Размер каждого промпта агента в токенах (count_tokens_approximately)
+    prompts: list = Field(default_factory=list)
+    summaries: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-react"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if isinstance(messages[0], SystemMessage) and messages[0].content.startswith(SUMMARY_PROMPT[:30]):
+            self.summaries += 1
+            message = AIMessage(content=f"сводка {self.summaries}")
+        else:
+            self.prompts.append(count_tokens_approximately(messages))
+            step = len(self.prompts)
+            if step > self.steps:
+                message = AIMessage(content="готово")
+            else:
+                message = AIMessage(content="", tool_calls=[{"name": "read_chunk", "args": {"n": step}, "id": f"call-{step}"}])
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+@tool
+def read_chunk(n: int) -> str:
+    """Читает кусок файла"""
+    return f"chunk {n}: " + "x" * 1200
+
+
+@tool("read_chunk")
+def read_large_chunk(n: int) -> str:
+    """Читает кусок файла"""
+    return f"chunk {n}: " + "x" * 8000
+
+
+class SerialCheckpointSaver(DjangoCheckpointSaver):
+    """
+    SQLite в памяти (тестовая база) не ждёт блокировку таблицы, а граф пишет чекпоинты из фоновых потоков:
+    запросы чекпоинтера в тестах выполняются по очереди
+    """
+    lock = threading.RLock()
+
+    def get_tuple(self, config):
+        with self.lock:
+            return super().get_tuple(config)
+
+    def put(self, *args, **kwargs):
+        with self.lock:
+            return super().put(*args, **kwargs)
+
+    def put_writes(self, *args, **kwargs):
+        with self.lock:
+            return super().put_writes(*args, **kwargs)
+
+
+class LLMAgentSummaryTest(TransactionTestCase):
+    @mock.patch("ai_integration.helpers.ai_agent.DjangoCheckpointSaver", SerialCheckpointSaver)
+    def test_single_turn_history_is_summarized(self):
+        # Одна задача по расписанию: один промпт и много вызовов инструментов без новых сообщений человека
+        model = FakeReActModel()
+        agent = LLMAgent(
+            model=model,
+            tools=[read_chunk],
+            system_message=SystemMessage(content="Ты агент"),
+            chat_id="single-turn",
+            context_budget=3000,
+        )
+        events = list(agent.stream("Сделай задачу"))
+
+        self.assertEqual(events[-1], {"type": "llm_message", "node": "agent", "content": "готово"})
+        self.assertEqual(len(model.prompts), model.steps + 1)
+        # Без сводки история выросла бы до ~8k токенов
+        self.assertLessEqual(max(model.prompts), 3000)
+        self.assertGreater(model.summaries, 0)
+        state = agent._agent.get_state(agent._config).values
+        self.assertEqual(state["summary"], f"сводка {model.summaries}")
+        # Задача хода не сворачивается, вызовы и их результаты не разрываются
+        messages = state["messages"]
+        self.assertEqual(messages[0].content, "Сделай задачу")
+        self.assertIsInstance(messages[1], AIMessage)
+        calls = {call["id"] for message in messages if isinstance(message, AIMessage) for call in message.tool_calls}
+        self.assertEqual(calls, {message.tool_call_id for message in messages if message.type == "tool"})
+
+    def run_single_group(self, prompt: str, tool) -> tuple[FakeReActModel, list]:
+        # Один вызов инструмента за ход: свернуть старые группы вызовов нельзя
+        model = FakeReActModel(steps=1)
+        agent = LLMAgent(
+            model=model,
+            tools=[tool],
+            system_message=SystemMessage(content="Ты агент"),
+            chat_id="single-group",
+            context_budget=1000,
+        )
+        events = list(agent.stream(prompt))
+        self.assertEqual(events[-1], {"type": "llm_message", "node": "agent", "content": "готово"})
+        self.assertLessEqual(max(model.prompts), 1000)
+        return model, agent._agent.get_state(agent._config).values["messages"]
+
+    @mock.patch("ai_integration.helpers.ai_agent.DjangoCheckpointSaver", SerialCheckpointSaver)
+    def test_turn_prompt_is_dropped_when_group_does_not_fit_with_it(self):
+        model, messages = self.run_single_group("Сделай задачу " + "y" * 2800, read_chunk)
+        # Длинная задача хода свёрнута в сводку, вызов и его результат остались
+        self.assertEqual(model.summaries, 1)
+        self.assertIsInstance(messages[0], AIMessage)
+        self.assertEqual(messages[0].tool_calls[0]["id"], "call-1")
+        self.assertEqual(messages[1].tool_call_id, "call-1")
+
+    @mock.patch("ai_integration.helpers.ai_agent.DjangoCheckpointSaver", SerialCheckpointSaver)
+    def test_oversized_tool_result_is_shortened(self):
+        model, messages = self.run_single_group("Сделай задачу", read_large_chunk)
+        self.assertEqual(model.summaries, 0)
+        self.assertEqual(messages[0].content, "Сделай задачу")
+        self.assertEqual(messages[2].tool_call_id, "call-1")
+        self.assertIn("[обрезано", messages[2].content)
+
+
+class FlakyReActModel(FakeReActModel):
+    """FakeReActModel, который один раз падает на запросе fail_on (ошибка API модели посреди хода)"""
+    fail_on: int = 3
+    failures: int = 0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if not self.failures and len(self.prompts) + 1 == self.fail_on:
+            self.failures += 1
+            raise RuntimeError("model is unavailable")
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+class FakeAIService(AIService):
+    """AIService без рабочей копии репозитория: только агент и todo list"""
+
+    def __init__(self, agent: LLMAgent):
+        self._agent = agent
+        self.todo_list_storage = mock.Mock()
+
+
+@override_settings(AI_AGENT_MAX_RETRIES=2)
+class RunAIAgentRetryTest(TransactionTestCase):
+    def setUp(self):
+        repository = Repository.objects.create(name="repo", url="https://github.com/user/repo", github_token="t")
+        self.project_theme = ProjectTheme.objects.create(name="theme", system_prompt="", repository=repository)
+        self.task = AIAgentTask.objects.create(
+            project_theme=self.project_theme,
+            prompt="Сделай задачу",
+            status=StatusesAIAgentTask.QUEUED.value,
+            claim_token="00000000-0000-0000-0000-000000000001",
+        )
+        self.model = FlakyReActModel(steps=4)
+        self.statuses = []
+
+    def build_ai_service(self, task, project_theme, repository) -> AIService:
+        # Повтор создаёт сервис заново: состояние чата только в чекпоинте
+        return FakeAIService(
+            LLMAgent(model=self.model, tools=[read_chunk], system_message=SystemMessage(content="Ты агент"), chat_id="retry")
+        )
+
+    def record_status(self, function):
+        # Запросы основного потока - под той же блокировкой, что и запись чекпоинтов (SerialCheckpointSaver)
+        def wrapper(*args, **kwargs):
+            with SerialCheckpointSaver.lock:
+                result = function(*args, **kwargs)
+                self.statuses.append(AIAgentTask.objects.get(id=self.task.id).status)
+            return result
+        return wrapper
+
+    @staticmethod
+    def serial(function):
+        def wrapper(*args, **kwargs):
+            with SerialCheckpointSaver.lock:
+                return function(*args, **kwargs)
+        return wrapper
+
+    @mock.patch("ai_integration.helpers.ai_agent.DjangoCheckpointSaver", SerialCheckpointSaver)
+    def test_retry_resumes_from_checkpoint(self):
+        with (
+            mock.patch("ai_integration.tasks._build_ai_service", self.build_ai_service),
+            mock.patch("ai_integration.tasks._lease_for", lambda *args: Lease(["repo"], backend=LocalLeaseBackend())),
+            mock.patch("ai_integration.tasks._start_task", self.record_status(agent_tasks._start_task)),
+            mock.patch("ai_integration.tasks._queue_retry", self.record_status(agent_tasks._queue_retry)),
+            mock.patch("ai_integration.tasks._stop_reason", self.serial(agent_tasks._stop_reason)),
+            mock.patch.object(run_ai_agent, "update_state"),
+        ):
+            result = run_ai_agent.apply(
+                kwargs={
+                    "project_theme_id": self.project_theme.id,
+                    "ai_agent_task_id": self.task.id,
+                    "claim_token": str(self.task.claim_token),
+                }
+            )
+
+        self.assertTrue(result.successful(), result.traceback)
+        self.assertEqual(self.model.failures, 1)
+        # Повтор с тем же claim_token: RUNNING -> QUEUED до повтора -> RUNNING
+        self.assertEqual(
+            self.statuses,
+            [StatusesAIAgentTask.RUNNING.value, StatusesAIAgentTask.QUEUED.value, StatusesAIAgentTask.RUNNING.value],
+        )
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, StatusesAIAgentTask.DONE.value)
+
+        # Ход продолжен с чекпоинта: промпт в истории один раз, выполненные инструменты не повторялись
+        agent = self.build_ai_service(self.task, self.project_theme, None)._agent
+        messages = agent._agent.get_state(agent._config).values["messages"]
+        self.assertEqual([message.content for message in messages if message.type == "human"], ["Сделай задачу"])
+        self.assertEqual(
+            [message.tool_call_id for message in messages if message.type == "tool"],
+            [f"call-{step}" for step in range(1, 5)],
+        )
+        self.assertEqual(messages[-1].content, "готово")
+
+
+class AIAgentTaskCancelTest(TestCase):
+    def test_cancel_unfinished_task(self):
+        for status in (StatusesAIAgentTask.PENDING, StatusesAIAgentTask.QUEUED, StatusesAIAgentTask.RUNNING):
+            task = AIAgentTask.objects.create(prompt="test", status=status.value)
+            self.assertTrue(task.cancel())
+            task.refresh_from_db()
+            self.assertEqual(task.status, StatusesAIAgentTask.CANCELLED.value)
+
+    def test_finished_task_is_not_cancelled(self):
+        task = AIAgentTask.objects.create(prompt="test", status=StatusesAIAgentTask.DONE.value)
+        self.assertFalse(task.cancel())
+        task.refresh_from_db()
+        self.assertEqual(task.status, StatusesAIAgentTask.DONE.value)
+
+
+class AIAgentTaskStatusTest(TestCase):
+    """Итоговый статус задачи пишется условным UPDATE и не затирает отмену во время выполнения"""
+
+    def setUp(self):
+        repository = Repository.objects.create(name="repo", url="https://github.com/user/repo", github_token="t")
+        self.project_theme = ProjectTheme.objects.create(name="theme", system_prompt="", repository=repository)
+        self.task = AIAgentTask.objects.create(
+            project_theme=self.project_theme,
+            prompt="test",
+            status=StatusesAIAgentTask.QUEUED.value,
+            claim_token="00000000-0000-0000-0000-000000000001",
+        )
+        for patcher in (
+            mock.patch("ai_integration.tasks._build_ai_service", return_value=mock.Mock()),
+            mock.patch("ai_integration.tasks._lease_for", lambda *args: Lease(["repo"], backend=LocalLeaseBackend())),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def cancel_after_last_step(self, *args, **kwargs):
+        # Отмена приходит после проверки последнего шага, до записи итогового статуса
+        yield {"type": "llm_message"}
+        AIAgentTask.objects.filter(id=self.task.id).update(status=StatusesAIAgentTask.CANCELLED.value)
+
+    def run_task(self):
+        return run_ai_agent.apply(
+            kwargs={
+                "project_theme_id": self.project_theme.id,
+                "ai_agent_task_id": self.task.id,
+                "claim_token": str(self.task.claim_token),
+            }
+        )
+
+    def assertStatus(self, status: StatusesAIAgentTask):
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, status.value)
+
+    def one_step(self, *args, **kwargs):
+        yield {"type": "llm_message"}
+
+    def test_done(self):
+        with mock.patch("ai_integration.tasks._agent_events", self.one_step):
+            self.run_task()
+        self.assertStatus(StatusesAIAgentTask.DONE)
+
+    def test_cancel_during_run_is_kept(self):
+        with mock.patch("ai_integration.tasks._agent_events", self.cancel_after_last_step):
+            self.run_task()
+        self.assertStatus(StatusesAIAgentTask.CANCELLED)
+
+    @override_settings(AI_AGENT_MAX_RETRIES=0)
+    def test_error(self):
+        with mock.patch("ai_integration.tasks._agent_events", side_effect=RuntimeError("model error")):
+            self.assertIsInstance(self.run_task().result, RuntimeError)
+        self.assertStatus(StatusesAIAgentTask.ERROR)
+
+    @override_settings(AI_AGENT_MAX_RETRIES=0)
+    def test_error_after_requeue_is_not_written(self):
+        def requeued(*args, **kwargs):
+            # Сверка уже вернула задачу в PENDING, сообщение этого запуска устарело
+            AIAgentTask.objects.filter(id=self.task.id).update(
+                status=StatusesAIAgentTask.PENDING.value, claim_token=None, claimed_at=None
+            )
+            raise RuntimeError("model error")
+
+        with mock.patch("ai_integration.tasks._agent_events", requeued):
+            self.run_task()
+        self.assertStatus(StatusesAIAgentTask.PENDING)
+
+    async def test_async_session_keeps_cancel(self):
+        async def events(*args, **kwargs):
+            yield {"type": "llm_message"}
+            await AIAgentTask.objects.filter(id=self.task.id).aupdate(status=StatusesAIAgentTask.CANCELLED.value)
+
+        with mock.patch("ai_integration.tasks._aagent_events", events):
+            result = await _run_ai_agent_session(self.task.id, str(self.task.claim_token))
+        self.assertEqual(result, "Выполнено за 1 шагов")
+        await self.task.arefresh_from_db()
+        self.assertEqual(self.task.status, StatusesAIAgentTask.CANCELLED.value)
+
+    async def test_async_session_done(self):
+        async def events(*args, **kwargs):
+            for event in self.one_step():
+                yield event
+
+        with mock.patch("ai_integration.tasks._aagent_events", events):
+            await _run_ai_agent_session(self.task.id, str(self.task.claim_token))
+        await self.task.arefresh_from_db()
+        self.assertEqual(self.task.status, StatusesAIAgentTask.DONE.value)
+
+
+def put_checkpoint(saver: DjangoCheckpointSaver, config: dict, values: dict, versions: dict, step: int = 0) -> dict:
+    """Чекпоинт как его пишет граф: все значения каналов, новые версии только у изменённых (values)"""
+    new_versions = {channel: saver.get_next_version(versions.get(channel), None) for channel in values}
+    versions.update(new_versions)
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = dict(values)
+    checkpoint["channel_versions"] = dict(versions)
+    return saver.put(config, checkpoint, {"source": "loop", "step": step}, new_versions)
+
+
+class DjangoCheckpointSaverTest(TestCase):
+    config = {"configurable": {"thread_id": "chat", "checkpoint_ns": ""}}
+
+    def test_put_get_list_round_trip(self):
+        saver = DjangoCheckpointSaver()
+        versions = {}
+        first = put_checkpoint(saver, self.config, {"messages": [HumanMessage("привет")], "summary": ""}, versions, step=1)
+        second = put_checkpoint(saver, first, {"messages": [HumanMessage("привет"), AIMessage("ответ")]}, versions, step=2)
+
+        checkpoint = DjangoCheckpointSaver().get_tuple(self.config)
+        self.assertEqual(checkpoint.config, second)
+        self.assertEqual(checkpoint.parent_config, first)
+        self.assertEqual([message.content for message in checkpoint.checkpoint["channel_values"]["messages"]], ["привет", "ответ"])
+        self.assertEqual(checkpoint.checkpoint["channel_values"]["summary"], "")
+        self.assertEqual(checkpoint.metadata["step"], 2)
+
+        listed = list(DjangoCheckpointSaver().list(self.config))
+        self.assertEqual([item.config for item in listed], [second, first])
+        self.assertEqual(len(listed[1].checkpoint["channel_values"]["messages"]), 1)
+        self.assertEqual(DjangoCheckpointSaver().get_tuple(first).checkpoint["id"], listed[1].checkpoint["id"])
+        self.assertEqual([item.config for item in saver.list(self.config, before=second)], [first])
+        self.assertEqual([item.config for item in saver.list(None, filter={"step": 2})], [second])
+        self.assertIsNone(saver.get_tuple({"configurable": {"thread_id": "other"}}))
+
+    def test_pending_writes_survive_reload(self):
+        saver = DjangoCheckpointSaver()
+        config = put_checkpoint(saver, self.config, {"messages": [HumanMessage("привет")]}, {})
+        saver.put_writes(config, [("messages", [AIMessage("ответ")]), ("summary", "сводка")], task_id="task-1")
+        # Повтор той же задачи не дублирует записи, специальный канал заменяется
+        saver.put_writes(config, [("messages", [AIMessage("другой ответ")])], task_id="task-1")
+        saver.put_writes(config, [("__error__", "первая ошибка")], task_id="task-2")
+        saver.put_writes(config, [("__error__", "вторая ошибка")], task_id="task-2")
+
+        writes = DjangoCheckpointSaver().get_tuple(self.config).pending_writes
+        self.assertEqual(
+            [(task_id, channel, value if isinstance(value, str) else value[0].content) for task_id, channel, value in writes],
+            [("task-1", "messages", "ответ"), ("task-1", "summary", "сводка"), ("task-2", "__error__", "вторая ошибка")],
+        )
+
+    def test_delete_thread(self):
+        saver = DjangoCheckpointSaver()
+        config = put_checkpoint(saver, self.config, {"messages": [HumanMessage("привет")]}, {})
+        saver.put_writes(config, [("summary", "сводка")], task_id="task-1")
+        put_checkpoint(saver, {"configurable": {"thread_id": "other", "checkpoint_ns": ""}}, {"summary": ""}, {})
+
+        saver.delete_thread("chat")
+        self.assertIsNone(saver.get_tuple(self.config))
+        for model in (AIStateStorage, AIStateWrites, AIStateBlobs):
+            self.assertFalse(model.objects.filter(thread_id="chat").exists())
+        self.assertTrue(AIStateStorage.objects.filter(thread_id="other").exists())
+
+    async def test_async_methods(self):
+        saver = DjangoCheckpointSaver()
+        checkpoint = empty_checkpoint()
+        version = saver.get_next_version(None, None)
+        checkpoint["channel_values"] = {"messages": [HumanMessage("привет")]}
+        checkpoint["channel_versions"] = {"messages": version}
+        config = await saver.aput(self.config, checkpoint, {"step": 0}, {"messages": version})
+        await saver.aput_writes(config, [("summary", "сводка")], task_id="task-1")
+
+        loaded = await saver.aget_tuple(self.config)
+        self.assertEqual(loaded.checkpoint["channel_values"]["messages"][0].content, "привет")
+        self.assertEqual(loaded.pending_writes, [("task-1", "summary", "сводка")])
+        self.assertEqual([item.config async for item in saver.alist(self.config)], [config])
+
+        await saver.adelete_thread("chat")
+        self.assertIsNone(await saver.aget_tuple(self.config))
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Данные готовятся моделями migrate_from, затем применяются миграции до последней"""
+    migrate_from: list[tuple[str, str]]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        self.old_apps = executor.loader.project_state(self.migrate_from).apps
+        self.addCleanup(self.migrate_to_latest)
+
+    def migrate_to_latest(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+
+class CheckpointTablesMigrationTest(MigrationTestCase):
+    migrate_from = [("ai_integration", "0002_aistate_row_per_key")]
+    config = DjangoCheckpointSaverTest.config
+
+    def legacy_rows(self, model_name: str, rows: dict):
+        model = self.old_apps.get_model("ai_integration", model_name)
+        for key, value in rows.items():
+            key_data = pickle.dumps(key, protocol=4)
+            model.objects.create(
+                record_id="chat", key_hash=hashlib.sha256(key_data).hexdigest(), key=key_data, data=pickle.dumps(value)
+            )
+
+    def test_in_memory_saver_rows_are_converted(self):
+        # Словари InMemorySaver в том виде, в котором их писал DjangoDBDict (строка на ключ)
+        memory = InMemorySaver()
+        versions = {}
+        first = put_checkpoint(memory, self.config, {"messages": [HumanMessage("привет")], "summary": ""}, versions)
+        second = put_checkpoint(memory, first, {"messages": [HumanMessage("привет"), AIMessage("ответ")]}, versions)
+        memory.put_writes(second, [("summary", "сводка")], task_id="task-1")
+        self.legacy_rows(
+            "AIStateStorage",
+            {thread_id: {ns: dict(checkpoints) for ns, checkpoints in namespaces.items()} for thread_id, namespaces in memory.storage.items()},
+        )
+        self.legacy_rows("AIStateWrites", {key: dict(writes) for key, writes in memory.writes.items()})
+        self.legacy_rows("AIStateBlobs", dict(memory.blobs))
+
+        self.migrate_to_latest()
+
+        self.assertEqual(AIStateStorage.objects.count(), 2)
+        self.assertEqual(AIStateBlobs.objects.count(), 3)
+        checkpoint = DjangoCheckpointSaver().get_tuple(self.config)
+        self.assertEqual(checkpoint.config, second)
+        self.assertEqual(checkpoint.parent_config, first)
+        self.assertEqual([message.content for message in checkpoint.checkpoint["channel_values"]["messages"]], ["привет", "ответ"])
+        self.assertEqual(checkpoint.pending_writes, [("task-1", "summary", "сводка")])
+
+
+class DjangoDBDictTest(TestCase):
+    """sync_data не пробрасывает ошибки записи, поэтому проверяются сами строки в базе"""
+
+    def create(self) -> DjangoDBDict:
+        return DjangoDBDict.db_dict_factory(record_id="chat", table_name=AIStateDefault)()
+
+    def rows(self) -> dict:
+        return {
+            pickle.loads(bytes(key)): key_hash
+            for key, key_hash in AIStateDefault.objects.filter(record_id="chat").values_list("key", "key_hash")
+        }
+
+    def test_row_per_key(self):
+        with self.create() as storage:
+            storage["todo"] = {"task": "Сделать тесты"}
+            storage[("chat", 1)] = [1, 2]
+        self.assertEqual(
+            self.rows(),
+            {key: hashlib.sha256(pickle.dumps(key, protocol=4)).hexdigest() for key in ("todo", ("chat", 1))},
+        )
+        self.assertEqual(dict(self.create()), {"todo": {"task": "Сделать тесты"}, ("chat", 1): [1, 2]})
+        # Другой record_id - другой словарь
+        self.assertEqual(dict(DjangoDBDict.db_dict_factory(record_id="other", table_name=AIStateDefault)()), {})
+
+    def test_only_changed_keys_are_written(self):
+        with self.create() as storage:
+            storage.update({"a": {"value": 1}, "b": {"value": 2}, "c": "text"})
+
+        storage = self.create()
+        with mock.patch.object(DjangoDBDict, "_write_rows", autospec=True, side_effect=DjangoDBDict._write_rows) as write_rows:
+            # Чтение изменяемого значения без изменения и повторная запись того же значения ничего не пишут
+            storage["a"]
+            storage["c"] = "text"
+            storage.sync_data()
+            write_rows.assert_not_called()
+
+            storage["b"]["value"] = 3
+            storage.sync_data()
+        (_, changed, deleted), _ = write_rows.call_args
+        self.assertEqual([pickle.loads(key_data) for _, key_data, _, _ in changed], ["b"])
+        self.assertEqual(list(deleted), [])
+        self.assertEqual(self.create()["b"], {"value": 3})
+
+    def test_deleted_keys(self):
+        with self.create() as storage:
+            storage.update({"a": 1, "b": 2, "c": 3, "d": 4})
+
+        with self.create() as storage:
+            del storage["a"]
+            storage.pop("b")
+            # Ключ, удалённый и записанный снова до синхронизации, остаётся
+            del storage["c"]
+            storage["c"] = 30
+            # Новый ключ, удалённый до синхронизации, не пишется
+            storage["e"] = 5
+            del storage["e"]
+        self.assertEqual(set(self.rows()), {"c", "d"})
+        self.assertEqual(dict(self.create()), {"c": 30, "d": 4})
+
+        with self.create() as storage:
+            storage.clear()
+        self.assertEqual(self.rows(), {})
+
+
+class StateRowPerKeyMigrationTest(MigrationTestCase):
+    migrate_from = [("ai_integration", "0001_initial")]
+
+    def test_legacy_dict_is_split_into_rows(self):
+        legacy = self.old_apps.get_model("ai_integration", "AIStateDefault")
+        legacy.objects.create(id="chat", data=pickle.dumps({"todo": {"task": "Сделать тесты"}, ("chat", 1): [1, 2]}))
+        legacy.objects.create(id="empty", data=b"")
+
+        self.migrate_to_latest()
+
+        self.assertEqual(AIStateDefault.objects.filter(record_id="chat").count(), 2)
+        self.assertFalse(AIStateDefault.objects.filter(record_id="empty").exists())
+        storage = DjangoDBDict.db_dict_factory(record_id="chat", table_name=AIStateDefault)()
+        self.assertEqual(dict(storage), {"todo": {"task": "Сделать тесты"}, ("chat", 1): [1, 2]})
+        # Ключ после миграции находится по тому же key_hash, запись обновляет строку, а не добавляет новую
+        storage["todo"]["task"] = "Готово"
+        storage.sync_data()
+        self.assertEqual(AIStateDefault.objects.filter(record_id="chat").count(), 2)
+        self.assertEqual(DjangoDBDict.db_dict_factory(record_id="chat", table_name=AIStateDefault)()["todo"], {"task": "Готово"})
+
+
+class CheckpointPruneTest(TransactionTestCase):
+    config = {"configurable": {"thread_id": "chat", "checkpoint_ns": ""}}
+
+    def put_history(self, saver: DjangoCheckpointSaver, steps: int, config: dict, messages: list, versions: dict) -> dict:
+        # Неизменённые сообщения - те же объекты, как после add_messages: messages пишутся дельтами
+        for step in range(steps):
+            messages.append(AIMessage(f"шаг {len(messages)}"))
+            config = put_checkpoint(saver, config, {"messages": list(messages)}, versions, step=len(messages))
+        return config
+
+    def age_checkpoints(self, days: int):
+        AIStateStorage.objects.update(created_at=timezone.now() - timedelta(days=days))
+
+    def assertMessages(self, config: dict, messages: list):
+        checkpoint = DjangoCheckpointSaver().get_tuple(config)
+        self.assertEqual(
+            [message.content for message in checkpoint.checkpoint["channel_values"]["messages"]],
+            [message.content for message in messages],
+        )
+
+    def test_prune_delta_thread(self):
+        saver = DjangoCheckpointSaver()
+        messages, versions = [HumanMessage("задача")], {}
+        config = self.put_history(saver, 10, self.config, messages, versions)
+        self.assertGreater(AIStateBlobs.objects.filter(base_version__isnull=False).count(), 5)
+        # Сообщения каждого оставшегося чекпоинта до очистки
+        expected = {
+            item.config["configurable"]["checkpoint_id"]: item.checkpoint["channel_values"]["messages"]
+            for item in saver.list(self.config, limit=3)
+        }
+        self.assertEqual(DjangoCheckpointSaver.threads_to_prune(keep_last=3, keep_days=7, limit=10), [])
+        self.age_checkpoints(days=30)
+        self.assertEqual(DjangoCheckpointSaver.threads_to_prune(keep_last=3, keep_days=7, limit=10), [("chat", "")])
+
+        deleted = saver.prune("chat", keep_last=3, keep_days=7)
+
+        self.assertEqual(deleted, {"checkpoints": 7, "writes": 0, "blobs": 7})
+        self.assertEqual(DjangoCheckpointSaver.threads_to_prune(keep_last=3, keep_days=7, limit=10), [])
+        # Цепочка самой старой живой версии проходила через удалённые версии: теперь это снимок
+        remaining = AIStateBlobs.objects.order_by("version")
+        self.assertEqual(remaining.count(), 3)
+        self.assertIsNone(remaining.first().base_version)
+        for item in DjangoCheckpointSaver().list(self.config):
+            self.assertEqual(
+                [message.content for message in item.checkpoint["channel_values"]["messages"]],
+                [message.content for message in expected[item.config["configurable"]["checkpoint_id"]]],
+            )
+        self.assertMessages(self.config, messages)
+
+        # Тот же экземпляр продолжает писать дельты от последней версии, новый - после перезагрузки
+        config = self.put_history(saver, 2, config, messages, versions)
+        self.assertMessages(self.config, messages)
+        reloaded = DjangoCheckpointSaver()
+        reloaded.get_tuple(self.config)
+        self.put_history(reloaded, 2, config, messages, versions)
+        self.assertMessages(self.config, messages)
+
+    @override_settings(CHECKPOINT_RETENTION_KEEP_LAST=3, CHECKPOINT_RETENTION_KEEP_DAYS=7, CHECKPOINT_COMPACTION_BATCH=10)
+    def test_compact_ai_state(self):
+        saver = DjangoCheckpointSaver()
+        messages = [HumanMessage("задача")]
+        self.put_history(saver, 6, self.config, messages, {})
+        other = {"configurable": {"thread_id": "other", "checkpoint_ns": ""}}
+        self.put_history(saver, 2, other, [HumanMessage("задача")], {})
+        self.age_checkpoints(days=30)
+
+        self.assertEqual(compact_ai_state(), {"threads": 1, "checkpoints": 3, "writes": 0, "blobs": 3})
+        self.assertEqual(AIStateStorage.objects.filter(thread_id="chat").count(), 3)
+        self.assertEqual(AIStateStorage.objects.filter(thread_id="other").count(), 2)
+        self.assertMessages(self.config, messages)
+        self.assertEqual(compact_ai_state()["threads"], 0)
+
+
+class StateSerializerTest(SimpleTestCase):
+    value = {"todo": [{"task": "Сделать тесты", "done": False}] * 50, "count": 3}
+
+    def test_round_trip(self):
+        for codec in StateSerializer.CODECS:
+            for compression in ("none", "zlib", state_serializer.DEFAULT_COMPRESSION):
+                serializer = StateSerializer(codec=codec, compression=compression)
+                for value in (self.value, {"small": 1}):
+                    with self.subTest(codec=codec, compression=compression, size=len(str(value))):
+                        self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+        messages = [HumanMessage("привет"), AIMessage("ответ")]
+        self.assertEqual(StateSerializer().loads(StateSerializer().dumps(messages)), messages)
+
+    def test_header(self):
+        data = StateSerializer(codec="json", compression="zlib").dumps(self.value)
+        self.assertEqual(data[:10], b"AIS" + bytes((1, 1, 4)) + b"json")
+        # Маленькие значения не сжимаются
+        self.assertEqual(StateSerializer(compression="zlib").dumps({"small": 1})[4], 0)
+
+    def test_header_selects_codec_and_compression(self):
+        pickled = StateSerializer(codec="pickle", compression="zlib").dumps(defaultdict(dict, {("a", 1): {}}))
+        loaded = StateSerializer(codec="json", compression="none").loads(pickled)
+        self.assertIsInstance(loaded, defaultdict)
+        self.assertEqual(loaded, {("a", 1): {}})
+        # Сжатие, которое читатель сам не пишет, создаётся по id из заголовка
+        compressed = StateSerializer(compression=state_serializer.DEFAULT_COMPRESSION).dumps(self.value)
+        self.assertEqual(StateSerializer(compression="none").loads(compressed), self.value)
+
+    def test_unknown_header(self):
+        data = bytearray(StateSerializer().dumps(self.value))
+        data[3] = 2
+        with self.assertRaisesRegex(ValueError, "format version"):
+            StateSerializer().loads(bytes(data))
+        data[3], data[4] = 1, 9
+        with self.assertRaisesRegex(ValueError, "compression id"):
+            StateSerializer().loads(bytes(data))
+
+    def test_legacy_pickle(self):
+        # Значения, записанные до StateSerializer: pickle.dumps всего значения (миграция 0002, DBDict)
+        legacy = defaultdict(dict, {"thread": {"": {"checkpoint": ("msgpack", b"data", None)}}})
+        for protocol in (0, 4, pickle.HIGHEST_PROTOCOL):
+            with self.subTest(protocol=protocol):
+                loaded = StateSerializer().loads(pickle.dumps(legacy, protocol=protocol))
+                self.assertEqual(loaded, legacy)
+                self.assertIsInstance(loaded, defaultdict)
+        self.assertEqual(StateSerializer().loads(memoryview(pickle.dumps(self.value))), self.value)
+
+    def test_uncompressed_checkpoint_blob(self):
+        # Значение канала, записанное чекпоинтером до сжатия: type без "+алгоритм"
+        messages = [HumanMessage("привет"), AIMessage("ответ" * 100)]
+        typed = JsonPlusSerializer().dumps_typed(messages)
+        self.assertEqual(CompressedSerializer().loads_typed(typed), messages)
+        self.assertEqual(CompressedSerializer().dumps_typed(messages)[0], f"msgpack+{state_serializer.DEFAULT_COMPRESSION}")
+
+    def test_zlib_without_zstandard(self):
+        with mock.patch.object(state_serializer, "zstandard", None):
+            with self.assertRaises(ImportError):
+                StateSerializer(compression="zstd")
+            serializer = StateSerializer(compression="zlib")
+            data = serializer.dumps(self.value)
+            self.assertEqual(data[4], state_serializer.ZlibCompressor.id)
+            header = 6 + data[5]
+            self.assertEqual(zlib.decompress(data[header:]), StateSerializer(compression="none").dumps(self.value)[header:])
+            self.assertEqual(serializer.loads(data), self.value)
+            typed = CompressedSerializer(compression="zlib").dumps_typed(self.value)
+            self.assertEqual(typed[0], "msgpack+zlib")
+            self.assertEqual(CompressedSerializer(compression="zlib").loads_typed(typed), self.value)
+        # Строки, записанные без zstandard, читаются и при установленном
+        self.assertEqual(StateSerializer().loads(data), self.value)
+        self.assertEqual(CompressedSerializer().loads_typed(typed), self.value)
+
+
+class CheckpointDeltaTest(TransactionTestCase):
+    # База дельт обновляется в transaction.on_commit, внутри транзакции TestCase он не выполняется
+    config = {"configurable": {"thread_id": "chat", "checkpoint_ns": ""}}
+
+    def setUp(self):
+        self.saver = DjangoCheckpointSaver()
+        self.versions = {}
+        self.checkpoint_config = self.config
+        self.messages = add_messages([], [HumanMessage("задача")])
+        # checkpoint_id -> ожидаемые сообщения
+        self.expected = {}
+
+    def step(self, *updates):
+        # Канал messages меняется редьюсером графа: неизменённые сообщения остаются теми же объектами
+        for update in updates:
+            self.messages = add_messages(self.messages, update)
+        self.checkpoint_config = put_checkpoint(
+            self.saver, self.checkpoint_config, {"messages": self.messages}, self.versions, step=len(self.expected)
+        )
+        self.expected[self.checkpoint_config["configurable"]["checkpoint_id"]] = [message.id for message in self.messages]
+
+    def last_blob(self) -> AIStateBlobs:
+        return AIStateBlobs.objects.get(channel="messages", version=self.versions["messages"])
+
+    def chain_lengths(self) -> list[int]:
+        bases = dict(AIStateBlobs.objects.values_list("version", "base_version"))
+        lengths = []
+        for version in bases:
+            length = 0
+            while bases[version] is not None:
+                version, length = bases[version], length + 1
+            lengths.append(length)
+        return lengths
+
+    def assertStored(self):
+        """Каждый чекпоинт, прочитанный новым экземпляром, совпадает с тем, что было записано"""
+        checkpoints = list(DjangoCheckpointSaver().list(self.config))
+        self.assertEqual(len(checkpoints), len(self.expected))
+        for item in checkpoints:
+            self.assertEqual(
+                [message.id for message in item.checkpoint["channel_values"]["messages"]],
+                self.expected[item.config["configurable"]["checkpoint_id"]],
+            )
+        latest = DjangoCheckpointSaver().get_tuple(self.config).checkpoint["channel_values"]["messages"]
+        self.assertEqual(latest, self.messages)
+
+    def test_removals_and_chain_rollover(self):
+        for i in range(60):
+            updates = [[AIMessage(f"ответ {i}")]]
+            if i % 5 == 4:
+                # Обрезка истории с начала (как pre_model_hook): дельта с drop
+                updates.append([RemoveMessage(id=self.messages[0].id)])
+            if i == 45:
+                # Удаление из середины: префикс не совпадает, пишется снимок
+                updates.append([RemoveMessage(id=self.messages[len(self.messages) // 2].id)])
+            self.step(*updates)
+            if i == 45:
+                self.assertIsNone(self.last_blob().base_version)
+        self.assertGreater(AIStateBlobs.objects.filter(base_version__isnull=False).count(), 40)
+        self.assertLessEqual(max(self.chain_lengths()), DjangoCheckpointSaver.MAX_DELTA_CHAIN)
+        # Цепочка длиннее MAX_DELTA_CHAIN дельт начинается заново с полного снимка
+        self.assertIn(DjangoCheckpointSaver.MAX_DELTA_CHAIN, self.chain_lengths())
+        self.assertStored()
+
+    def test_remove_all_messages(self):
+        for i in range(5):
+            self.step([AIMessage(f"ответ {i}")])
+        self.step([RemoveMessage(id=REMOVE_ALL_MESSAGES), HumanMessage("сводка")])
+        self.assertIsNone(self.last_blob().base_version)
+        self.step([AIMessage("ответ после сводки")])
+        self.assertIsNotNone(self.last_blob().base_version)
+        self.assertStored()
+
+    def test_failed_put_is_not_a_delta_base(self):
+        for i in range(3):
+            self.step([AIMessage(f"ответ {i}")])
+        stored_version = self.versions["messages"]
+        messages, versions = self.messages, dict(self.versions)
+        with mock.patch.object(AIStateStorage.objects, "update_or_create", side_effect=DatabaseError("disk full")):
+            with self.assertRaises(DatabaseError):
+                self.step([AIMessage("не записан")])
+        self.assertFalse(AIStateBlobs.objects.filter(version=self.versions["messages"]).exists())
+
+        # Граф продолжает с последнего записанного чекпоинта: дельта от версии, которая есть в базе
+        self.messages, self.versions = messages, versions
+        self.step([AIMessage("повтор")])
+        self.assertEqual(self.last_blob().base_version, stored_version)
+        self.assertStored()
+
+    def test_identity_after_reload(self):
+        for i in range(5):
+            self.step([AIMessage(f"ответ {i}")])
+        self.assertIsNotNone(self.last_blob().base_version)
+
+        # Новый экземпляр (следующая задача чата): база для дельт - загруженные значения, а не равные им копии
+        self.saver = DjangoCheckpointSaver()
+        self.messages = self.saver.get_tuple(self.config).checkpoint["channel_values"]["messages"]
+        # Загруженная версия - дельта неизвестной глубины, поэтому после перезагрузки сначала пишется снимок
+        self.step([AIMessage("ответ после перезагрузки")])
+        self.assertIsNone(self.last_blob().base_version)
+
+        # Загруженный снимок - сразу база для дельт
+        self.saver = DjangoCheckpointSaver()
+        self.messages = self.saver.get_tuple(self.config).checkpoint["channel_values"]["messages"]
+        self.step([AIMessage("после снимка")])
+        self.assertIsNotNone(self.last_blob().base_version)
+
+        # Равные, но другие объекты сообщений не считаются неизменёнными
+        self.messages = [message.model_copy() for message in self.messages]
+        self.step([AIMessage("копии")])
+        self.assertIsNone(self.last_blob().base_version)
+        self.assertStored()
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+DAY_BITS = {"MON": 1, "TUE": 2, "WED": 4, "THU": 8, "FRI": 16, "SAT": 32, "SUN": 64}
+
+
+def fill_weekdays(apps, schema_editor):
+    """Маска weekdays из строки days_of_week (как Weekday.from_days)"""
+    activity_schedule = apps.get_model("schedule_service", "ActivitySchedule")
+    schedules = list(activity_schedule.objects.only("id", "days_of_week"))
+    for schedule in schedules:
+        schedule.weekdays = sum(
+            {DAY_BITS[day.strip()[:3].upper()] for day in (schedule.days_of_week or "").split(",") if day.strip()[:3].upper() in DAY_BITS}
+        )
+    activity_schedule.objects.bulk_update(schedules, ["weekdays"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule_service', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activityschedule',
+            name='weekdays',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_weekdays, migrations.RunPython.noop),
+    ]
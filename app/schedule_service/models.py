@@ -1,9 +1,61 @@
+from datetime import date
+from enum import IntFlag
+
 from django.db import models
 
 from ai_integration.helpers.ai_model_enum import AIModels
 from github_integration.models import ProjectTheme
 
 
+class Weekday(IntFlag):
+    """Дни недели битовой маской (ActivitySchedule.weekdays): бит i - date.weekday() == i"""
+    MON = 1
+    TUE = 2
+    WED = 4
+    THU = 8
+    FRI = 16
+    SAT = 32
+    SUN = 64
+
+    @classmethod
+    def from_days(cls, days_of_week: str) -> "Weekday":
+        """Маска из строки вида "Mon,Tue,Wed" (регистр и полные названия не важны, неизвестные дни пропускаются)"""
+        mask = cls(0)
+        for day in days_of_week.split(","):
+            mask |= cls.__members__.get(day.strip()[:3].upper(), cls(0))
+        return mask
+
+    @classmethod
+    def for_date(cls, day: date) -> "Weekday":
+        return cls(1 << day.weekday())
+
+
+class ActivityScheduleQuerySet(models.QuerySet):
+    """
+    Пересчитывает weekdays и при записи в обход save(): update(days_of_week=...), bulk_create и bulk_update.
+    Запросы на чистом SQL маску не обновляют, такие расписания находит schedule_ai_tasks.
+    """
+
+    def update(self, **kwargs):
+        if isinstance(kwargs.get("days_of_week"), str):
+            kwargs["weekdays"] = Weekday.from_days(kwargs["days_of_week"])
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for schedule in objs:
+            schedule.weekdays = Weekday.from_days(schedule.days_of_week or "")
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if "days_of_week" in fields:
+            objs = list(objs)
+            for schedule in objs:
+                schedule.weekdays = Weekday.from_days(schedule.days_of_week or "")
+            fields = [*fields, "weekdays"]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+
 class ActivitySchedule(models.Model):
     project_theme = models.ForeignKey(
         ProjectTheme, on_delete=models.CASCADE, related_name="activity_schedules"
@@ -12,6 +64,9 @@ class ActivitySchedule(models.Model):
         max_length=100,
         help_text="Comma-separated list of days (e.g., Mon,Tue,Wed)",
     )
+    # days_of_week битовой маской Weekday, пересчитывается в save() и ActivityScheduleQuerySet:
+    # по ней schedule_ai_tasks выбирает расписания
+    weekdays = models.PositiveSmallIntegerField(default=0, db_index=True, editable=False)
     start_time = models.TimeField()
     end_time = models.TimeField()
     count_runs = models.IntegerField(default=0)
@@ -23,6 +78,15 @@ class ActivitySchedule(models.Model):
         choices=[(model.value, model.name) for model in AIModels],
     )
 
+    objects = ActivityScheduleQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.weekdays = Weekday.from_days(self.days_of_week or "")
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "days_of_week" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "weekdays"}
+        super().save(*args, **kwargs)
+
     def __str__(self) -> str:
         return f"{self.project_theme.name} Schedule"
 
@@ -1,96 +1,285 @@
+import operator
 import random
-from datetime import timedelta, datetime
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from functools import reduce
+from typing import Optional
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
 from django.utils import timezone
 
+from ai_integration.helpers.lease import agent_queue
 from ai_integration.models import AIAgentTask, AIAgentPrompts, StatusesAIAgentTask
-from ai_integration.tasks import run_ai_agent
-from schedule_service.models import ActivitySchedule
+from ai_integration.tasks import run_ai_agent, run_ai_agents_async
+from schedule_service.models import ActivitySchedule, Weekday
 
 
 
 logger = get_task_logger(__name__)
 
+def claim_due_tasks(
+    until: datetime, limit: int, now: Optional[datetime] = None
+) -> tuple[uuid.UUID, list[tuple[int, Optional[int], Optional[int], datetime]]]:
+    """
+    Атомарно переводит до limit задач со scheduled_time <= until из PENDING в QUEUED и помечает их claim_token.
+    Параллельные запуски (перекрывающиеся тики beat, несколько нод) забирают разные задачи:
+    на PostgreSQL строки блокируются через select_for_update(skip_locked=True), на остальных базах
+    один условный UPDATE ... WHERE status = PENDING, и строку, уже забранную другим запуском, он не трогает.
+    Возвращает claim_token и (id задачи, project_theme_id, id репозитория, scheduled_time) забранных задач.
+    """
+    now = now or timezone.now()
+    claim_token = uuid.uuid4()
+    due_tasks = AIAgentTask.due(until)
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            task_ids = list(due_tasks.select_for_update(skip_locked=True).values_list("id", flat=True)[:limit])
+            claimed = AIAgentTask.objects.filter(id__in=task_ids).update(
+                status=StatusesAIAgentTask.QUEUED.value, claim_token=claim_token, claimed_at=now
+            )
+    else:
+        # scheduled_time__lte во внешнем запросе, чтобы SQLite искал по aiagenttask_status_time_idx диапазоном,
+        # а не перебирал все PENDING задачи на дни вперёд
+        claimed = AIAgentTask.objects.filter(
+            id__in=due_tasks.values("id")[:limit], status=StatusesAIAgentTask.PENDING.value, scheduled_time__lte=until
+        ).update(status=StatusesAIAgentTask.QUEUED.value, claim_token=claim_token, claimed_at=now)
+
+    if not claimed:
+        return claim_token, []
+    tasks = list(
+        AIAgentTask.objects.filter(claim_token=claim_token).order_by("scheduled_time", "id").values_list(
+            "id", "project_theme_id", "project_theme__repository_id", "scheduled_time"
+        )
+    )
+    return claim_token, tasks
+
+
+def release_claimed_tasks(claim_token: uuid.UUID, task_ids: list[int]) -> int:
+    """Возвращает в PENDING забранные, но не отправленные в очередь задачи (например, брокер недоступен)"""
+    return AIAgentTask.objects.filter(
+        claim_token=claim_token, id__in=task_ids, status=StatusesAIAgentTask.QUEUED.value
+    ).update(status=StatusesAIAgentTask.PENDING.value, claim_token=None, claimed_at=None)
+
+
+def requeue_lost_tasks(now: datetime) -> int:
+    """
+    Возвращает в PENDING задачи, которые висят в QUEUED дольше AI_AGENT_QUEUED_GRACE после scheduled_time:
+    сообщение потеряно (перезапуск брокера, воркер упал до подтверждения) или ждёт за долгой задачей шарда.
+    Старое сообщение, если оно всё же дойдёт, пропускается воркером: claim_token уже другой.
+    Повтор после ошибки ждёт в QUEUED с claimed_at = время повтора, его задача не трогается до этого срока + grace.
+    """
+    lost_before = now - timedelta(minutes=settings.AI_AGENT_QUEUED_GRACE)
+    return AIAgentTask.objects.filter(
+        status=StatusesAIAgentTask.QUEUED.value,
+        scheduled_time__lt=lost_before,
+        claimed_at__lt=lost_before,
+    ).update(status=StatusesAIAgentTask.PENDING.value, claim_token=None, claimed_at=None)
+
+
+def fail_stuck_tasks(now: datetime) -> int:
+    """
+    RUNNING задачи, начатые раньше, чем AI_AGENT_TIME_LIMIT + AI_AGENT_QUEUED_GRACE назад: процесс воркера
+    завершён по жёсткому лимиту или упал, и статус уже никто не обновит. Аренда репозитория истекла сама (TTL).
+    """
+    return AIAgentTask.objects.filter(
+        status=StatusesAIAgentTask.RUNNING.value,
+        claimed_at__lt=now - timedelta(seconds=settings.AI_AGENT_TIME_LIMIT, minutes=settings.AI_AGENT_QUEUED_GRACE),
+    ).update(status=StatusesAIAgentTask.ERROR.value)
+
+
+def _send_claimed(claim_token: uuid.UUID, tasks: list[tuple[int, Optional[int], Optional[int], datetime]], now: datetime) -> int:
+    """
+    Отправляет забранные задачи с eta = scheduled_time: воркер начнёт их точно в срок, без опроса базы.
+    Задачи одного репозитория - в одну очередь (agent_queue), там их по одной выполняет воркер шарда.
+    """
+    by_queue: dict[Optional[str], list[tuple[int, Optional[int], datetime]]] = defaultdict(list)
+    for task_id, project_theme_id, repository_id, scheduled_time in tasks:
+        by_queue[agent_queue(repository_id)].append((task_id, project_theme_id, scheduled_time))
+
+    sessions_per_worker = settings.AI_AGENT_SESSIONS_PER_WORKER
+    dispatched: list[int] = []
+    try:
+        # Все сообщения пачки отправляются через одно соединение с брокером
+        with run_ai_agent.app.producer_or_acquire() as producer:
+            for queue, queue_tasks in by_queue.items():
+                if sessions_per_worker > 1:
+                    # Несколько сессий на одном event loop воркера (run_ai_agents_async):
+                    # пачка стартует по самой поздней задаче, чтобы ни одна не началась раньше срока
+                    for start in range(0, len(queue_tasks), sessions_per_worker):
+                        batch = queue_tasks[start:start + sessions_per_worker]
+                        batch_ids = [task_id for task_id, _, _ in batch]
+                        run_ai_agents_async.apply_async(
+                            kwargs={"ai_agent_task_ids": batch_ids, "claim_token": str(claim_token)},
+                            eta=max(max(scheduled_time for _, _, scheduled_time in batch), now),
+                            queue=queue,
+                            producer=producer,
+                        )
+                        dispatched.extend(batch_ids)
+                    continue
+                for task_id, project_theme_id, scheduled_time in queue_tasks:
+                    run_ai_agent.apply_async(
+                        kwargs={
+                            "project_theme_id": project_theme_id,
+                            "ai_agent_task_id": task_id,
+                            "claim_token": str(claim_token),
+                        },
+                        eta=max(scheduled_time, now),
+                        queue=queue,
+                        producer=producer,
+                        # retry_policy={
+                        #     "max_retries": 2,
+                        #     "interval_start": 60,
+                        #     "interval_step": 60
+                        # },
+                    )
+                    dispatched.append(task_id)
+    except Exception as e:
+        not_dispatched = sorted({task[0] for task in tasks} - set(dispatched))
+        released = release_claimed_tasks(claim_token, not_dispatched)
+        logger.error(f"dispatch: sent {len(dispatched)} of {len(tasks)} tasks, {released} returned to PENDING: {e}")
+        raise
+    return len(dispatched)
+
+
+def dispatch_tasks(now: Optional[datetime] = None) -> int:
+    """Отправляет в очередь все PENDING задачи на AI_AGENT_DISPATCH_HORIZON минут вперёд, пачками по SCHEDULER_CLAIM_BATCH"""
+    now = now or timezone.now()
+    until = now + timedelta(minutes=settings.AI_AGENT_DISPATCH_HORIZON)
+    dispatched = 0
+    while True:
+        claim_token, tasks = claim_due_tasks(until, limit=settings.SCHEDULER_CLAIM_BATCH, now=now)
+        if not tasks:
+            return dispatched
+        dispatched += _send_claimed(claim_token, tasks, now)
+        logger.info(f"dispatch: sent {len(tasks)} tasks until {until}, claim {claim_token}")
+
+
 @shared_task(name="run_scheduled_ai_tasks")
-def run_scheduled_ai_tasks():
+def run_scheduled_ai_tasks() -> dict:
+    """
+    Сверка раз в AI_AGENT_DISPATCH_INTERVAL минут: возвращает потерянные задачи, закрывает зависшие и отправляет задачи
+    на горизонт вперёд. Сами задачи стартуют по eta, без ожидания следующего тика.
+    """
     now = timezone.now()
-    pending_tasks = AIAgentTask.objects.filter(
-        scheduled_time__lte=now, status=StatusesAIAgentTask.PENDING.value
+    requeued = requeue_lost_tasks(now)
+    if requeued:
+        logger.warning(f"run_scheduled_ai_tasks: {requeued} queued tasks were not started in time, sending again")
+    failed = fail_stuck_tasks(now)
+    if failed:
+        logger.warning(f"run_scheduled_ai_tasks: {failed} running tasks exceeded the time limit, marked as ERROR")
+    dispatched = dispatch_tasks(now)
+    return {"requeued": requeued, "failed": failed, "dispatched": dispatched}
+
+
+def _plan_day(schedule: ActivitySchedule, day: date) -> list[AIAgentTask]:
+    """Задачи расписания на день: count_runs запусков, случайно распределённых между start_time и end_time"""
+    # Создаём timezone-aware datetime
+    start_time = timezone.make_aware(
+        datetime.combine(day, schedule.start_time)
     )
+    end_time = timezone.make_aware(
+        datetime.combine(day, schedule.end_time)
+    )
+    time_diff = (end_time - start_time).seconds // 60
+    interval = time_diff // max(schedule.count_runs, 1)
+
+    tasks = []
+    for i in range(schedule.count_runs):
+        prompt_parts = []
+        if i == 0:
+            prompt_parts.append(AIAgentPrompts.PLAN_FOR_DAY.format(count_runs=schedule.count_runs))
+            prompt_parts.append(AIAgentPrompts.DO_PLAN_FEATURES.format(count_runs=schedule.count_runs))
+            prompt_parts.append(AIAgentPrompts.CREATE_NEW_BRANCH.value)
+            # prompt_parts.append(AIAgentPrompts.ADD_FEATURE.value)
+        else:
+            prompt_parts.append(AIAgentPrompts.CONTINUE.value)
+        if i == schedule.count_runs - 1 or schedule.count_runs == 1:
+            prompt_parts.append(AIAgentPrompts.DO_MERGE_ALL.value)
 
-    for task in pending_tasks:
-        task.status = StatusesAIAgentTask.RUNNING.value
-        task.save()
-        run_ai_agent.apply_async(
-            kwargs={
-                "project_theme_id": task.project_theme_id,
-                "ai_agent_task_id": task.id,
-            },
-            # retry_policy={
-            #     "max_retries": 2,
-            #     "interval_start": 60,
-            #     "interval_step": 60
-            # },
+        random_minutes = random.randint(i * interval, (i + 1) * interval)
+        schedule_time = start_time + timedelta(minutes=random_minutes)
+
+        tasks.append(
+            AIAgentTask(
+                # project_theme_id, а не project_theme: без запроса темы на каждое расписание
+                project_theme_id=schedule.project_theme_id,
+                activity_schedule=schedule,
+                prompt=", ".join(prompt_parts),
+                status=StatusesAIAgentTask.PENDING.value,
+                created_at=timezone.now(),  # Реальное время создания
+                scheduled_time=schedule_time,  # Время планируемого запуска
+                ai_model=schedule.ai_model,
+            )
         )
+    return tasks
 
-@shared_task(name="schedule_ai_tasks")
-def schedule_ai_tasks():
-    tomorrow = timezone.now().date() + timedelta(days=1)
-    day_name = tomorrow.strftime("%a")
 
-    schedules = ActivitySchedule.objects.filter(days_of_week__contains=day_name)
+def _sync_stale_weekdays() -> int:
+    """
+    Расписания с непустым days_of_week и weekdays = 0: строки изменены в обход модели (чистый SQL, импорт),
+    schedule_ai_tasks их не видит. Маска пересчитывается, расписания с нераспознанными днями только логируются.
+    """
+    stale = list(ActivitySchedule.objects.filter(weekdays=0).exclude(days_of_week="").only("id", "days_of_week"))
+    if not stale:
+        return 0
+    fixed = []
+    for schedule in stale:
+        schedule.weekdays = Weekday.from_days(schedule.days_of_week)
+        if schedule.weekdays:
+            fixed.append(schedule)
+        else:
+            logger.warning(f"schedule_ai_tasks: schedule {schedule.id} has no known days in '{schedule.days_of_week}'")
+    if fixed:
+        ActivitySchedule.objects.bulk_update(fixed, ["weekdays"])
+        logger.warning(f"schedule_ai_tasks: weekdays of schedules {[schedule.id for schedule in fixed]} were out of sync, recalculated")
+    return len(fixed)
 
-    for schedule in schedules:
-        existing_tasks = AIAgentTask.objects.filter(
-            activity_schedule=schedule, scheduled_time__date=tomorrow
-        ).count()
 
-        if existing_tasks >= schedule.count_runs:
-            continue
+@shared_task(name="schedule_ai_tasks")
+def schedule_ai_tasks(days_ahead: Optional[int] = None) -> int:
+    """
+    Планирует задачи на days_ahead дней вперёд, начиная с завтра, за несколько запросов при любом числе расписаний:
+    расписания на эти дни (маска weekdays), уже созданные задачи (Count по расписанию и дню) и bulk_create.
+    День расписания, на который задач уже не меньше count_runs, пропускается, поэтому повторные запуски безопасны.
+    """
+    days_ahead = days_ahead or settings.SCHEDULE_DAYS_AHEAD
+    tomorrow = timezone.localdate() + timedelta(days=1)
+    days = [tomorrow + timedelta(days=offset) for offset in range(days_ahead)]
+    days_mask = reduce(operator.or_, (Weekday.for_date(day) for day in days))
+    _sync_stale_weekdays()
 
-        # Создаём timezone-aware datetime
-        start_time = timezone.make_aware(
-            datetime.combine(tomorrow, schedule.start_time)
-        )
-        end_time = timezone.make_aware(
-            datetime.combine(tomorrow, schedule.end_time)
+    schedules = list(
+        ActivitySchedule.objects.annotate(planned_weekdays=F("weekdays").bitand(int(days_mask))).filter(
+            planned_weekdays__gt=0, count_runs__gt=0
         )
-        time_diff = (end_time - start_time).seconds // 60
-        interval = time_diff // max(schedule.count_runs, 1)
-
-        tasks = []
-        for i in range(schedule.count_runs):
-            prompt_parts = []
-            if i == 0:
-                prompt_parts.append(AIAgentPrompts.PLAN_FOR_DAY.format(count_runs=schedule.count_runs))
-                prompt_parts.append(AIAgentPrompts.DO_PLAN_FEATURES.format(count_runs=schedule.count_runs))
-                prompt_parts.append(AIAgentPrompts.CREATE_NEW_BRANCH.value)
-                # prompt_parts.append(AIAgentPrompts.ADD_FEATURE.value)
-            else:
-                prompt_parts.append(AIAgentPrompts.CONTINUE.value)
-            if i == schedule.count_runs - 1 or schedule.count_runs == 1:
-                prompt_parts.append(AIAgentPrompts.DO_MERGE_ALL.value)
-
-
-
-
-            random_minutes = random.randint(i * interval, (i + 1) * interval)
-            schedule_time = start_time + timedelta(minutes=random_minutes)
-
-            tasks.append(
-                AIAgentTask(
-                    project_theme=schedule.project_theme,
-                    activity_schedule=schedule,
-                    prompt=", ".join(prompt_parts),
-                    status=StatusesAIAgentTask.PENDING.value,
-                    created_at=timezone.now(),  # Реальное время создания
-                    scheduled_time=schedule_time,  # Время планируемого запуска
-                    ai_model=schedule.ai_model,
-                )
-            )
+    )
+    if not schedules:
+        return 0
 
-        AIAgentTask.objects.bulk_create(tasks)
+    period_start = timezone.make_aware(datetime.combine(days[0], time.min))
+    period_end = timezone.make_aware(datetime.combine(days[-1] + timedelta(days=1), time.min))
+    existing_tasks = {
+        (row["activity_schedule_id"], row["day"]): row["total"]
+        for row in AIAgentTask.scheduled_counts(period_start, period_end)
+    }
+
+    tasks = []
+    for schedule in schedules:
+        for day in days:
+            if not schedule.weekdays & Weekday.for_date(day):
+                continue
+            if existing_tasks.get((schedule.id, day), 0) >= schedule.count_runs:
+                continue
+            tasks.extend(_plan_day(schedule, day))
 
+    AIAgentTask.objects.bulk_create(tasks, batch_size=500)
+    logger.info(f"schedule_ai_tasks: planned {len(tasks)} tasks for {len(schedules)} schedules, days {days[0]}..{days[-1]}")
+    # Задачи, попавшие в горизонт отправки, сразу уходят в очередь с eta
+    dispatch_tasks()
+    return len(tasks)
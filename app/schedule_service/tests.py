@@ -1,3 +1,420 @@
-from django.test import TestCase
+from datetime import date, time, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from ai_integration.helpers.lease import LocalLeaseBackend, Lease
+from ai_integration.models import AIAgentTask, StatusesAIAgentTask
+from ai_integration.tests import MigrationTestCase
+from github_integration.models import ProjectTheme, Repository
+from schedule_service.models import ActivitySchedule, Weekday
+from schedule_service.tasks import (
+    _send_claimed,
+    claim_due_tasks,
+    dispatch_tasks,
+    fail_stuck_tasks,
+    requeue_lost_tasks,
+    run_ai_agent,
+    run_scheduled_ai_tasks,
+    schedule_ai_tasks,
+)
+
+
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+        self.repository = Repository.objects.create(name="repo", url="https://github.com/user/repo", github_token="t")
+        self.project_theme = ProjectTheme.objects.create(name="theme", system_prompt="", repository=self.repository)
+
+    def create_tasks(
+        self, count: int, scheduled_time=None, status=StatusesAIAgentTask.PENDING, project_theme=None, **kwargs
+    ) -> list[AIAgentTask]:
+        return [
+            AIAgentTask.objects.create(
+                project_theme=project_theme or self.project_theme,
+                prompt="test",
+                status=status.value,
+                scheduled_time=scheduled_time or self.now - timedelta(minutes=count - i),
+                **kwargs,
+            )
+            for i in range(count)
+        ]
+
+    def statuses(self) -> dict[int, str]:
+        return dict(AIAgentTask.objects.values_list("id", "status"))
+
+    def broker(self, side_effect=None):
+        """Отправка в очередь без брокера: apply_async обеих задач агента замоканы"""
+        patchers = [
+            mock.patch.object(run_ai_agent.app, "producer_or_acquire"),
+            mock.patch("schedule_service.tasks.run_ai_agent.apply_async", side_effect=side_effect),
+            mock.patch("schedule_service.tasks.run_ai_agents_async.apply_async", side_effect=side_effect),
+        ]
+        mocks = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        return mocks[1], mocks[2]
+
+
+class ClaimDueTasksTest(SchedulerTestCase):
+    def test_overlapping_claims_are_disjoint(self):
+        tasks = self.create_tasks(10)
+        self.create_tasks(1, scheduled_time=self.now + timedelta(hours=1))
+
+        first_token, first = claim_due_tasks(self.now, limit=6, now=self.now)
+        second_token, second = claim_due_tasks(self.now, limit=6, now=self.now)
+
+        first_ids = [task_id for task_id, *_ in first]
+        second_ids = [task_id for task_id, *_ in second]
+        self.assertEqual(len(first_ids), 6)
+        self.assertFalse(set(first_ids) & set(second_ids))
+        # Самые ранние задачи забирает первый запуск, задача вне горизонта не забирается
+        self.assertEqual(first_ids + second_ids, [task.id for task in tasks])
+        self.assertEqual(first[0], (tasks[0].id, self.project_theme.id, self.repository.id, tasks[0].scheduled_time))
+        self.assertEqual(set(AIAgentTask.objects.filter(claim_token=first_token).values_list("id", flat=True)), set(first_ids))
+        self.assertEqual(set(AIAgentTask.objects.filter(claim_token=second_token).values_list("id", flat=True)), set(second_ids))
+        self.assertEqual(claim_due_tasks(self.now, limit=6, now=self.now)[1], [])
+
+    def test_overlapping_claim_with_stale_candidates(self):
+        # Второй запуск выбрал кандидатов до того, как первый их забрал: условие status = PENDING в UPDATE их пропускает
+        self.create_tasks(4)
+        stale_candidates = AIAgentTask.objects.order_by("scheduled_time", "id")
+        _, first = claim_due_tasks(self.now, limit=2, now=self.now)
+        with mock.patch.object(AIAgentTask, "due", return_value=stale_candidates):
+            _, second = claim_due_tasks(self.now, limit=4, now=self.now)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({task_id for task_id, *_ in first} & {task_id for task_id, *_ in second})
+
+    def test_claimed_tasks_are_not_claimed_again(self):
+        self.create_tasks(3)
+        for status in (StatusesAIAgentTask.QUEUED, StatusesAIAgentTask.RUNNING, StatusesAIAgentTask.CANCELLED):
+            self.create_tasks(1, status=status)
+        _, claimed = claim_due_tasks(self.now, limit=100, now=self.now)
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(
+            set(AIAgentTask.objects.filter(id__in=[task_id for task_id, *_ in claimed]).values_list("status", "claimed_at")),
+            {(StatusesAIAgentTask.QUEUED.value, self.now)},
+        )
+
+
+@override_settings(AI_AGENT_SESSIONS_PER_WORKER=1)
+class SendClaimedFailureTest(SchedulerTestCase):
+    def test_unsent_tasks_are_released(self):
+        self.create_tasks(5)
+        claim_token, claimed = claim_due_tasks(self.now, limit=100, now=self.now)
+        apply_async, _ = self.broker(side_effect=[None, None, ConnectionError("broker is down")])
+
+        with self.assertRaises(ConnectionError):
+            _send_claimed(claim_token, claimed, self.now)
+
+        self.assertEqual(apply_async.call_count, 3)
+        sent = [task_id for task_id, *_ in claimed[:2]]
+        statuses = self.statuses()
+        self.assertEqual({statuses[task_id] for task_id in sent}, {StatusesAIAgentTask.QUEUED.value})
+        released = AIAgentTask.objects.exclude(id__in=sent)
+        self.assertEqual(set(released.values_list("status", "claim_token", "claimed_at")), {(StatusesAIAgentTask.PENDING.value, None, None)})
+        # Освобождённые задачи забирает следующий тик
+        self.assertEqual(len(claim_due_tasks(self.now, limit=100, now=self.now)[1]), 3)
+
+
+class WeekdayTest(TestCase):
+    def test_from_days(self):
+        self.assertEqual(Weekday.from_days("Mon,Tue,Wed"), Weekday.MON | Weekday.TUE | Weekday.WED)
+        self.assertEqual(Weekday.from_days(" monday, FRIDAY ,sun"), Weekday.MON | Weekday.FRI | Weekday.SUN)
+        self.assertEqual(Weekday.from_days("Mon,Funday,,Mon"), Weekday.MON)
+        self.assertEqual(Weekday.from_days(""), 0)
+
+    def test_for_date(self):
+        # 2026-10-19 - понедельник
+        self.assertEqual([Weekday.for_date(date(2026, 10, 19) + timedelta(days=i)) for i in range(7)], list(Weekday))
+
+    def test_weekdays_follow_days_of_week(self):
+        project_theme = ProjectTheme.objects.create(name="theme", system_prompt="")
+        schedule = ActivitySchedule.objects.create(
+            project_theme=project_theme, days_of_week="Mon,Wed", start_time=time(9), end_time=time(18)
+        )
+        self.assertEqual(schedule.weekdays, Weekday.MON | Weekday.WED)
+        schedule.days_of_week = "Fri"
+        schedule.save(update_fields=["days_of_week"])
+        self.assertEqual(ActivitySchedule.objects.get(id=schedule.id).weekdays, Weekday.FRI)
+        # Запись в обход save()
+        ActivitySchedule.objects.filter(id=schedule.id).update(days_of_week="Tue,Thu")
+        self.assertEqual(ActivitySchedule.objects.get(id=schedule.id).weekdays, Weekday.TUE | Weekday.THU)
+        schedule.days_of_week = "Sat"
+        ActivitySchedule.objects.bulk_update([schedule], ["days_of_week"])
+        self.assertEqual(ActivitySchedule.objects.get(id=schedule.id).weekdays, Weekday.SAT)
+        (created,) = ActivitySchedule.objects.bulk_create(
+            [ActivitySchedule(project_theme=project_theme, days_of_week="Sun", start_time=time(9), end_time=time(18))]
+        )
+        self.assertEqual(created.weekdays, Weekday.SUN)
+
+
+@mock.patch("schedule_service.tasks.dispatch_tasks")
+@mock.patch("django.utils.timezone.localdate", return_value=date(2026, 10, 19))
+class ScheduleAITasksTest(SchedulerTestCase):
+    """Планирование на вторник-четверг 2026-10-20..22"""
+
+    def create_schedule(self, days_of_week: str, count_runs: int) -> ActivitySchedule:
+        return ActivitySchedule.objects.create(
+            project_theme=self.project_theme,
+            days_of_week=days_of_week,
+            start_time=time(9),
+            end_time=time(18),
+            count_runs=count_runs,
+        )
+
+    def planned(self) -> dict[tuple[int, date], int]:
+        counts = {}
+        for schedule_id, scheduled_time in AIAgentTask.objects.values_list("activity_schedule_id", "scheduled_time"):
+            key = (schedule_id, timezone.localtime(scheduled_time).date())
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def test_multi_day_planning_is_idempotent(self, localdate, dispatch_tasks):
+        tue_thu = self.create_schedule("Tue,Thu", count_runs=2)
+        every_day = self.create_schedule("Tue,Wed,Thu", count_runs=1)
+        self.create_schedule("Mon", count_runs=3)
+        self.create_schedule("Wed", count_runs=0)
+        # Одинаковое число запросов при любом числе расписаний: проверка масок, расписания, счётчики, bulk_create
+        for i in range(10):
+            self.create_schedule("Fri,Sat", count_runs=1)
+
+        with self.assertNumQueries(4):
+            self.assertEqual(schedule_ai_tasks(days_ahead=3), 7)
+        self.assertEqual(
+            self.planned(),
+            {
+                (tue_thu.id, date(2026, 10, 20)): 2,
+                (tue_thu.id, date(2026, 10, 22)): 2,
+                (every_day.id, date(2026, 10, 20)): 1,
+                (every_day.id, date(2026, 10, 21)): 1,
+                (every_day.id, date(2026, 10, 22)): 1,
+            },
+        )
+
+        # Повторный запуск и запуск с пересекающимся периодом не создают задач на уже спланированные дни
+        with self.assertNumQueries(3):
+            self.assertEqual(schedule_ai_tasks(days_ahead=3), 0)
+        self.assertEqual(schedule_ai_tasks(days_ahead=4), 10)
+        self.assertEqual(AIAgentTask.objects.count(), 17)
+        self.assertEqual(dispatch_tasks.call_count, 3)
+
+    def test_stale_weekdays_are_recalculated(self, localdate, dispatch_tasks):
+        schedule = self.create_schedule("Tue", count_runs=1)
+        broken = self.create_schedule("Funday", count_runs=1)
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {ActivitySchedule._meta.db_table} SET weekdays = 0")
+
+        with self.assertLogs("schedule_service.tasks", level="WARNING") as logs:
+            self.assertEqual(schedule_ai_tasks(days_ahead=3), 1)
+        self.assertIn(f"schedules [{schedule.id}] were out of sync", "\n".join(logs.output))
+        self.assertIn(f"schedule {broken.id} has no known days in 'Funday'", "\n".join(logs.output))
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.weekdays, Weekday.TUE)
+
+
+class FillWeekdaysMigrationTest(MigrationTestCase):
+    migrate_from = [("schedule_service", "0001_initial")]
+
+    def test_weekdays_are_filled(self):
+        project_theme = self.old_apps.get_model("github_integration", "ProjectTheme").objects.create(name="theme", system_prompt="")
+        activity_schedule = self.old_apps.get_model("schedule_service", "ActivitySchedule")
+        for days_of_week in ("Mon,Wed", "friday, Sunday", "", "Funday"):
+            activity_schedule.objects.create(
+                project_theme_id=project_theme.id, days_of_week=days_of_week, start_time=time(9), end_time=time(18)
+            )
+
+        self.migrate_to_latest()
+
+        self.assertEqual(
+            dict(ActivitySchedule.objects.values_list("days_of_week", "weekdays")),
+            {
+                days_of_week: Weekday.from_days(days_of_week)
+                for days_of_week in ("Mon,Wed", "friday, Sunday", "", "Funday")
+            },
+        )
+
+
+@override_settings(AI_AGENT_QUEUED_GRACE=30, AI_AGENT_TIME_LIMIT=2400)
+class RecoveryTest(SchedulerTestCase):
+    def test_requeue_lost_tasks_after_grace(self):
+        grace = timedelta(minutes=30)
+        (lost,) = self.create_tasks(
+            1, status=StatusesAIAgentTask.QUEUED, scheduled_time=self.now - grace - timedelta(minutes=1),
+            claim_token="00000000-0000-0000-0000-000000000001", claimed_at=self.now - grace - timedelta(minutes=5),
+        )
+        (in_grace,) = self.create_tasks(
+            1, status=StatusesAIAgentTask.QUEUED, scheduled_time=self.now - grace + timedelta(minutes=1),
+            claim_token="00000000-0000-0000-0000-000000000001", claimed_at=self.now - grace - timedelta(minutes=5),
+        )
+        # Повтор после ошибки ждёт в QUEUED: claimed_at - время повтора
+        (retrying,) = self.create_tasks(
+            1, status=StatusesAIAgentTask.QUEUED, scheduled_time=self.now - timedelta(hours=2),
+            claim_token="00000000-0000-0000-0000-000000000002", claimed_at=self.now - grace + timedelta(minutes=10),
+        )
+        (running,) = self.create_tasks(
+            1, status=StatusesAIAgentTask.RUNNING, scheduled_time=self.now - timedelta(hours=2), claimed_at=self.now - timedelta(hours=2),
+        )
+
+        self.assertEqual(requeue_lost_tasks(self.now), 1)
+
+        self.assertEqual(
+            AIAgentTask.objects.filter(id=lost.id).values_list("status", "claim_token", "claimed_at").get(),
+            (StatusesAIAgentTask.PENDING.value, None, None),
+        )
+        statuses = self.statuses()
+        self.assertEqual(statuses[in_grace.id], StatusesAIAgentTask.QUEUED.value)
+        self.assertEqual(statuses[retrying.id], StatusesAIAgentTask.QUEUED.value)
+        self.assertEqual(statuses[running.id], StatusesAIAgentTask.RUNNING.value)
+        # Срок повтора + grace прошёл
+        self.assertEqual(requeue_lost_tasks(self.now + timedelta(minutes=11)), 2)
+
+    def test_fail_stuck_tasks(self):
+        limit = timedelta(seconds=2400, minutes=30)
+        (stuck,) = self.create_tasks(1, status=StatusesAIAgentTask.RUNNING, claimed_at=self.now - limit - timedelta(seconds=1))
+        (running,) = self.create_tasks(1, status=StatusesAIAgentTask.RUNNING, claimed_at=self.now - limit + timedelta(minutes=1))
+        (queued,) = self.create_tasks(1, status=StatusesAIAgentTask.QUEUED, claimed_at=self.now - limit - timedelta(hours=1))
+
+        self.assertEqual(fail_stuck_tasks(self.now), 1)
+        statuses = self.statuses()
+        self.assertEqual(statuses[stuck.id], StatusesAIAgentTask.ERROR.value)
+        self.assertEqual(statuses[running.id], StatusesAIAgentTask.RUNNING.value)
+        self.assertEqual(statuses[queued.id], StatusesAIAgentTask.QUEUED.value)
+
+
+class SendClaimedTest(SchedulerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_ai_agent, self.run_ai_agents_async = self.broker()
+        other_repository = Repository.objects.create(name="other", url="https://github.com/user/other", github_token="t")
+        self.other_theme = ProjectTheme.objects.create(name="other", system_prompt="", repository=other_repository)
+
+    def claim(self):
+        claim_token, claimed = claim_due_tasks(self.now + timedelta(minutes=30), limit=100, now=self.now)
+        return claim_token, claimed, _send_claimed(claim_token, claimed, self.now)
+
+    @override_settings(AI_AGENT_SESSIONS_PER_WORKER=1, AI_AGENT_QUEUE_SHARDS=1)
+    def test_single_sessions(self):
+        (late,) = self.create_tasks(1, scheduled_time=self.now - timedelta(minutes=5))
+        (future,) = self.create_tasks(1, scheduled_time=self.now + timedelta(minutes=10))
+
+        claim_token, _, sent = self.claim()
+
+        self.assertEqual(sent, 2)
+        self.run_ai_agents_async.assert_not_called()
+        self.assertEqual(
+            [(call.kwargs["kwargs"], call.kwargs["eta"], call.kwargs["queue"]) for call in self.run_ai_agent.call_args_list],
+            [
+                # Задача с прошедшим сроком стартует сразу, будущая - точно в срок
+                ({"project_theme_id": self.project_theme.id, "ai_agent_task_id": late.id, "claim_token": str(claim_token)}, self.now, None),
+                ({"project_theme_id": self.project_theme.id, "ai_agent_task_id": future.id, "claim_token": str(claim_token)}, future.scheduled_time, None),
+            ],
+        )
+        # Все сообщения пачки - через одно соединение с брокером
+        self.assertEqual(len({call.kwargs["producer"] for call in self.run_ai_agent.call_args_list}), 1)
+
+    @override_settings(AI_AGENT_SESSIONS_PER_WORKER=2, AI_AGENT_QUEUE_SHARDS=2)
+    def test_batched_async_sessions(self):
+        (first,) = self.create_tasks(1, scheduled_time=self.now - timedelta(minutes=1))
+        (second,) = self.create_tasks(1, scheduled_time=self.now + timedelta(minutes=20))
+        (third,) = self.create_tasks(1, scheduled_time=self.now + timedelta(minutes=25))
+        (other,) = self.create_tasks(1, scheduled_time=self.now + timedelta(minutes=5), project_theme=self.other_theme)
+
+        claim_token, _, sent = self.claim()
+
+        self.assertEqual(sent, 4)
+        self.run_ai_agent.assert_not_called()
+        queue = f"ai_agent_{self.repository.id % 2}"
+        other_queue = f"ai_agent_{self.other_theme.repository_id % 2}"
+        self.assertEqual(
+            sorted(
+                (call.kwargs["queue"], call.kwargs["kwargs"]["ai_agent_task_ids"], call.kwargs["eta"])
+                for call in self.run_ai_agents_async.call_args_list
+            ),
+            sorted(
+                [
+                    # Пачка стартует по самой поздней задаче, чтобы ни одна не началась раньше срока
+                    (queue, [first.id, second.id], self.now + timedelta(minutes=20)),
+                    (queue, [third.id], self.now + timedelta(minutes=25)),
+                    (other_queue, [other.id], self.now + timedelta(minutes=5)),
+                ]
+            ),
+        )
+        self.assertEqual({call.kwargs["kwargs"]["claim_token"] for call in self.run_ai_agents_async.call_args_list}, {str(claim_token)})
+
+
+@override_settings(AI_AGENT_SESSIONS_PER_WORKER=1, AI_AGENT_DISPATCH_HORIZON=30, SCHEDULER_CLAIM_BATCH=2)
+class DispatchTasksTest(SchedulerTestCase):
+    def test_dispatch_in_batches_within_horizon(self):
+        due = self.create_tasks(5, scheduled_time=self.now + timedelta(minutes=10))
+        (beyond,) = self.create_tasks(1, scheduled_time=self.now + timedelta(minutes=31))
+        apply_async, _ = self.broker()
+
+        self.assertEqual(dispatch_tasks(self.now), 5)
+
+        self.assertEqual(
+            sorted(call.kwargs["kwargs"]["ai_agent_task_id"] for call in apply_async.call_args_list),
+            sorted(task.id for task in due),
+        )
+        # Пачки по SCHEDULER_CLAIM_BATCH - каждая со своим claim_token
+        self.assertEqual(len({call.kwargs["kwargs"]["claim_token"] for call in apply_async.call_args_list}), 3)
+        self.assertEqual(self.statuses()[beyond.id], StatusesAIAgentTask.PENDING.value)
+        self.assertEqual(dispatch_tasks(self.now), 0)
+
+    def test_run_scheduled_ai_tasks(self):
+        self.create_tasks(
+            1, status=StatusesAIAgentTask.QUEUED, scheduled_time=self.now - timedelta(hours=2), claimed_at=self.now - timedelta(hours=2)
+        )
+        self.create_tasks(1, status=StatusesAIAgentTask.RUNNING, claimed_at=self.now - timedelta(days=1))
+        self.broker()
+        with mock.patch("django.utils.timezone.now", return_value=self.now):
+            # Потерянная задача возвращается в PENDING и сразу отправляется заново
+            self.assertEqual(run_scheduled_ai_tasks(), {"requeued": 1, "failed": 1, "dispatched": 1})
+
+
+class StaleClaimTest(SchedulerTestCase):
+    """Сообщение, задачу которого сверка уже отправила заново, воркер пропускает"""
+
+    def setUp(self):
+        super().setUp()
+        for patcher in (
+            mock.patch("ai_integration.tasks._build_ai_service", return_value=mock.Mock()),
+            mock.patch("ai_integration.tasks._lease_for", lambda *args: Lease(["repo"], backend=LocalLeaseBackend())),
+            mock.patch("ai_integration.tasks._agent_events", side_effect=lambda *args, **kwargs: (event for event in [{"type": "llm_message"}])),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_message(self, task: AIAgentTask, claim_token) -> str:
+        return run_ai_agent.apply(
+            kwargs={"project_theme_id": self.project_theme.id, "ai_agent_task_id": task.id, "claim_token": str(claim_token)}
+        ).result
+
+    @override_settings(AI_AGENT_QUEUED_GRACE=30, AI_AGENT_SESSIONS_PER_WORKER=1)
+    def test_stale_message_is_skipped(self):
+        (task,) = self.create_tasks(1, scheduled_time=self.now - timedelta(hours=1))
+        self.broker()
+        old_token, _ = claim_due_tasks(self.now, limit=10, now=self.now - timedelta(hours=1))
+        requeue_lost_tasks(self.now)
+        new_token, _ = claim_due_tasks(self.now, limit=10, now=self.now)
+
+        self.assertEqual(self.run_message(task, old_token), "Сообщение устарело, задача уже отправлена заново или выполнена")
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.claim_token), (StatusesAIAgentTask.QUEUED.value, new_token))
+
+        self.run_message(task, new_token)
+        task.refresh_from_db()
+        self.assertEqual(task.status, StatusesAIAgentTask.DONE.value)
+        # Повторная доставка того же сообщения после выполнения
+        self.assertEqual(self.run_message(task, new_token), "Задача в статусе Done, пропускаем выполнение")
+
+    def test_cancelled_task_is_skipped(self):
+        (task,) = self.create_tasks(1)
+        claim_token, _ = claim_due_tasks(self.now, limit=10, now=self.now)
+        self.assertTrue(task.cancel())
+        self.assertEqual(self.run_message(task, claim_token), "Сообщение устарело, задача уже отправлена заново или выполнена")
+        task.refresh_from_db()
+        self.assertEqual(task.status, StatusesAIAgentTask.CANCELLED.value)
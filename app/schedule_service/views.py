@@ -23,8 +23,7 @@ class TestView(APIView):
             github_token="***",
             todo_list_storage=DjangoDBDict.db_dict_factory(
                 record_id="chat_id", table_name=AIStateDefault
-            )(),
-            rate_limit=10
+            )()
         )
         tools.update_todo_list({"test":123})
         return Response({})
\ No newline at end of file
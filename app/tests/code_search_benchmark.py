@@ -0,0 +1,115 @@
+"""
+Поиск find_in_files на синтетическом большом репозитории: построчный обход всех файлов (как было),
+разовый поиск без индекса (scan) в одном процессе и в пуле по числу ядер, триграммный индекс CodeSearchIndex.
+Репозиторий создаётся во временной папке и коммитится в git.
+
+Запуск из папки app (по умолчанию 100000 файлов):
+    python -m tests.code_search_benchmark
+    python -m tests.code_search_benchmark 20000
+"""
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from ai_integration.helpers.code_search import CodeSearchIndex, scan as scan_files
+
+RARE_FILES = 10
+QUERIES = [
+    ("редкий литерал", r"rare_marker_\d+", 100),
+    ("частый литерал, первые 100", r"def handler_", 100),
+    ("литералы в двух ветках", r"(parse|render)_payload_7", 100),
+]
+
+
+def make_repo(path: str, files: int):
+    words = [f"word{i}" for i in range(5000)]
+    rare = set(random.Random(1).sample(range(files), RARE_FILES))
+    rnd = random.Random(0)
+    for i in range(files):
+        directory = os.path.join(path, f"pkg{i % 100}", f"sub{i // 100 % 100}")
+        os.makedirs(directory, exist_ok=True)
+        lines = []
+        for j in range(20):
+            lines.append(f"def handler_{i}_{j}({rnd.choice(words)}):")
+            lines.append(f"    return {rnd.choice(words)} + {rnd.choice(words)}  # parse_payload_{j}")
+        if i in rare:
+            lines.append(f"rare_marker_{i} = True")
+        with open(os.path.join(directory, f"module_{i}.py"), "w") as file:
+            file.write("\n".join(lines) + "\n")
+    git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com"]
+    subprocess.run([*git, "init", "-q"], cwd=path, check=True)
+    subprocess.run([*git, "add", "-A"], cwd=path, check=True)
+    subprocess.run([*git, "commit", "-q", "-m", "synthetic"], cwd=path, check=True)
+
+
+def walk(path: str, pattern: str) -> list[str]:
+    """Прежний find_in_files: os.walk и regex по каждой строке каждого .py файла, без предела"""
+    results = []
+    regex = re.compile(pattern)
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(".py"):
+                file_path = os.path.join(root, name)
+                with open(file_path, "r", encoding="utf-8") as f:
+                    for i, line in enumerate(f, 1):
+                        if regex.search(line):
+                            results.append(f"{os.path.relpath(file_path, path)}:{i}: {line.strip()}")
+    return results
+
+
+def measure(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    workers = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        make_repo(path, files)
+        print(f"{files} files generated and committed in {time.perf_counter() - start:.1f} s")
+
+        index = CodeSearchIndex(path)
+        start = time.perf_counter()
+        index.refresh()
+        print(f"index build: {time.perf_counter() - start:.1f} s, {len(index.postings)} trigrams")
+        index.save()
+        print(f"index size: {os.path.getsize(index.index_path) / 1024 / 1024:.1f} MB")
+        start = time.perf_counter()
+        loaded = CodeSearchIndex.load(path)
+        loaded.refresh()
+        print(f"index load and git sync: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        # Запуск пула процессов - один раз на процесс воркера, в замеры не входит
+        scan_files(path, "warmup", workers=workers)
+
+        print(f"{'query':<30} {'walk':>10} {'scan x1':>10} {f'scan x{workers}':>10} {'index':>10}")
+        for title, pattern, max_results in QUERIES:
+            expected = set(walk(path, pattern))
+            # scan и индекс находят те же строки, что и полный обход, но останавливаются на max_results
+            for search in (
+                lambda: scan_files(path, pattern, max_results=max_results, workers=workers),
+                lambda: loaded.search(pattern, max_results=max_results),
+            ):
+                found = [line for line in search() if not line.startswith("…")]
+                assert set(found) <= expected and len(found) == min(len(expected), max_results), title
+            timings = [
+                measure(lambda: walk(path, pattern), repeat=1),
+                measure(lambda: scan_files(path, pattern, max_results=max_results), repeat=3),
+                measure(lambda: scan_files(path, pattern, max_results=max_results, workers=workers), repeat=3),
+                measure(lambda: loaded.search(pattern, max_results=max_results)),
+            ]
+            print(f"{title:<30}" + "".join(f" {timing * 1000:>7.1f} ms" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Сравнение форматов хранения состояния агента: размер и время encode/decode.
+
+Запуск из папки app:
+    python -m tests.serializer_benchmark
+"""
+import pickle
+import time
+import uuid
+from pathlib import Path
+
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from ai_integration.helpers.state_serializer import (
+    CompressedSerializer,
+    StateSerializer,
+    zstandard,
+)
+
+ROUNDS = 20
+
+
+def build_messages(turns: int = 40) -> list:
+    """История в духе run_ai_agent: запрос, вызовы read_file с содержимым файлов проекта, ответы"""
+    sources = [path.read_text(encoding="utf-8") for path in sorted(Path(".").rglob("*.py")) if "migrations" not in path.parts]
+    messages = []
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"Продолжи работу над задачей {i}", id=str(uuid.uuid4())))
+        call_id = str(uuid.uuid4())
+        messages.append(
+            AIMessage(
+                content="",
+                tool_calls=[{"name": "read_file", "args": {"path": f"file_{i}.py"}, "id": call_id}],
+                id=str(uuid.uuid4()),
+            )
+        )
+        messages.append(
+            ToolMessage(content=sources[i % len(sources)], tool_call_id=call_id, name="read_file", id=str(uuid.uuid4()))
+        )
+        messages.append(AIMessage(content=f"Файл {i} прочитан, обновляю todo_list", id=str(uuid.uuid4())))
+    return messages
+
+
+def measure(name: str, dumps, loads, value):
+    data = dumps(value)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        data = dumps(value)
+    encode_ms = (time.perf_counter() - start) / ROUNDS * 1000
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        loads(data)
+    decode_ms = (time.perf_counter() - start) / ROUNDS * 1000
+    size = len(data[1]) if isinstance(data, tuple) else len(data)
+    print(f"{name:<28} {size:>12,} B {encode_ms:>10.2f} ms {decode_ms:>10.2f} ms")
+
+
+def main():
+    messages = build_messages()
+    todo_list = {
+        f"task_{i}": {f"step_{j}": {"desc": "Добавить логгер и обновить документацию " * 3, "done": j % 2 == 0} for j in range(5)}
+        for i in range(10)
+    }
+    jsonplus = JsonPlusSerializer()
+
+    print(f"messages channel: {len(messages)} messages")
+    print(f"{'format':<28} {'bytes':>14} {'encode':>13} {'decode':>13}")
+    measure("pickle", pickle.dumps, pickle.loads, messages)
+    measure("jsonplus msgpack", jsonplus.dumps_typed, jsonplus.loads_typed, messages)
+    for compression in ("zlib", "zstd"):
+        if compression == "zstd" and zstandard is None:
+            continue
+        serde = CompressedSerializer(compression=compression)
+        measure(f"msgpack+{compression}", serde.dumps_typed, serde.loads_typed, messages)
+
+    print()
+    print("todo_list (DjangoDBDict value)")
+    measure("pickle", pickle.dumps, pickle.loads, todo_list)
+    for codec in ("msgpack", "json"):
+        for compression in ("none", "zlib", "zstd"):
+            if compression == "zstd" and zstandard is None:
+                continue
+            serializer = StateSerializer(codec=codec, compression=compression)
+            measure(f"{codec}+{compression}", serializer.dumps, serializer.loads, todo_list)
+
+
+if __name__ == "__main__":
+    main()
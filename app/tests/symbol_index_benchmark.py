@@ -0,0 +1,83 @@
+"""
+Структура кода через SymbolIndex против ast.parse на каждый вызов (как было в get_function_defs и
+get_class_structure): холодный разбор всех файлов, повторные запросы и загрузка индекса с диска.
+
+Запуск из папки app (по умолчанию 5000 файлов):
+    python -m tests.symbol_index_benchmark
+    python -m tests.symbol_index_benchmark 20000
+"""
+import ast
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from ai_integration.helpers.symbol_index import SymbolIndex
+
+MODULE = '''
+class Handler{i}(Base):
+    def get(self, request, *args, **kwargs) -> Response:
+        return self.render(request)
+
+    async def post(self, request) -> Response:
+        data = await request.json()
+        return self.save(data)
+
+    def save(self, data: dict) -> Response:
+        return Response(data)
+
+
+def build_handler_{i}(config: dict) -> Handler{i}:
+    return Handler{i}(**config)
+'''
+
+
+def make_repo(path: str, files: int):
+    for i in range(files):
+        directory = os.path.join(path, f"pkg{i % 50}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"handlers_{i}.py"), "w") as file:
+            file.write(MODULE.format(i=i) * 5)
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+
+
+def parse_every_time(path: str, files: list[str]) -> int:
+    """Прежние инструменты: чтение и ast.parse файла при каждом вызове"""
+    count = 0
+    for relative_path in files:
+        with open(os.path.join(path, relative_path), "r", encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        count += sum(1 for node in ast.walk(tree) if isinstance(node, ast.FunctionDef))
+    return count
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as path:
+        make_repo(path, files)
+        index = SymbolIndex(path)
+        paths = sorted({relative_path for relative_path, _ in index.directory_symbols()})
+        sample = paths[:200]
+
+        print(f"{files} files")
+        print(f"list_symbols cold (index built): {timed(lambda: SymbolIndex(path).directory_symbols()):.2f} s")
+        print(f"list_symbols warm: {timed(index.directory_symbols):.2f} s")
+        index.save()
+        print(f"index size: {os.path.getsize(index.index_path) / 1024 / 1024:.1f} MB")
+        print(f"load from disk + list_symbols: {timed(lambda: SymbolIndex.load(path).directory_symbols()):.2f} s")
+        print(f"find_symbol warm: {timed(lambda: index.find('save')) * 1000:.0f} ms")
+
+        parse = timed(lambda: parse_every_time(path, sample))
+        cached = timed(lambda: [index.symbols(relative_path) for relative_path in sample])
+        print(f"get_function_defs x{len(sample)}: ast.parse {parse * 1000:.0f} ms, index {cached * 1000:.1f} ms ({parse / cached:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
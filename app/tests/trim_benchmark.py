@@ -0,0 +1,77 @@
+"""
+Стоимость обрезки истории перед вызовом модели: trim_messages против MessageTrimmer с кэшем токенов.
+Эмулирует 100 шагов ReAct цикла (recursion_limit) поверх истории заданной длины.
+
+Запуск из папки app:
+    python -m tests.trim_benchmark
+"""
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+
+from ai_integration.helpers.message_trimmer import MessageTrimmer
+
+STEPS = 100
+MAX_TOKENS = 100000
+
+
+def make_turn(i: int) -> list:
+    call_id = str(uuid.uuid4())
+    return [
+        HumanMessage(content=f"Продолжи задачу {i}", id=str(uuid.uuid4())),
+        AIMessage(content="", tool_calls=[{"name": "read_file", "args": {"path": f"f{i}.py"}, "id": call_id}], id=str(uuid.uuid4())),
+        ToolMessage(content="x = 1\n" * (50 + i % 200), tool_call_id=call_id, id=str(uuid.uuid4())),
+        AIMessage(content=f"Готово {i}", id=str(uuid.uuid4())),
+    ]
+
+
+def baseline_trim(messages: list) -> list:
+    return trim_messages(
+        messages,
+        strategy="last",
+        token_counter=count_tokens_approximately,
+        max_tokens=MAX_TOKENS,
+        start_on="human",
+        end_on=("human", "tool"),
+        include_system=True,
+    )
+
+
+def run(history_size: int):
+    history = [message for i in range(history_size // 4) for message in make_turn(i)]
+    turns = [make_turn(history_size + step)[:3] for step in range(STEPS)]
+    trimmer = MessageTrimmer(max_tokens=MAX_TOKENS)
+
+    start = time.perf_counter()
+    messages = list(history)
+    expected = []
+    for turn in turns:
+        expected.append(baseline_trim(messages))
+        messages.extend(turn)
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    messages = list(history)
+    results = []
+    for turn in turns:
+        results.append(trimmer.trim(messages))
+        messages.extend(turn)
+    cached = time.perf_counter() - start
+
+    # На каждом шаге окна результат должен совпадать с trim_messages
+    for step, (result, trimmed) in enumerate(zip(results, expected)):
+        assert [m.id for m in result] == [m.id for m in trimmed], f"step {step}"
+    print(f"{history_size:>8} {baseline * 1000:>14.1f} ms {cached * 1000:>14.1f} ms {baseline / cached:>8.1f}x")
+
+
+def main():
+    print(f"{STEPS} steps per run")
+    print(f"{'history':>8} {'trim_messages':>17} {'MessageTrimmer':>17} {'speedup':>9}")
+    for history_size in (1000, 2000, 5000, 10000):
+        run(history_size)
+
+
+if __name__ == "__main__":
+    main()